@@ -42,10 +42,12 @@ class BMP280:
     # 測定値を受信
     def read(self):
         try:
-            # 測定値の生データを受信
-            data = []
-            for i in range (0xF7, 0xF7+8):
-                data.append(self.bus.read_byte_data(self.I2C_ADDRESS,i))
+            # 測定値の生データを受信 (0xF7~0xFE)
+            self._bus_time = 0.0
+            self._bus_transactions = 0
+            data = self._read_regs(0xF7, 8)
+            self.bus_time = self._bus_time  # 今回の測定でI2C通信にかかった時間[s]
+            self.bus_transactions = self._bus_transactions  # 今回の測定でのI2C通信の回数
             
             pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
             temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
@@ -59,15 +61,16 @@ class BMP280:
             # 高度を算出
             altitude = self._get_altitude(temperature, pressure)
 
-            self._logger.info(f"pressure : {pressure:4.3f} hPa, temperature : {temperature: 2.2f} ℃, humidity : {humidity:3.0f} %, altitude : {altitude: 4.2f} m")
-            # (f文字列の:の後のスペースには意味があります  https://docs.python.org/ja/3/library/string.html#formatspec )
+            self._logger.info("pressure : %4.3f hPa, temperature : % 2.2f ℃, humidity : %3.0f %%, altitude : % 4.2f m, bus_time : %.2f ms (%d transactions)",
+                              pressure, temperature, humidity, altitude, self.bus_time*1000, self.bus_transactions)
+            # (%の後のスペースには意味があります  https://docs.python.org/ja/3/library/stdtypes.html#printf-style-string-formatting )
 
             return temperature, pressure, humidity, altitude
         except Exception as e:
             self._logger.exception("An error occured in read bmp280")
 
     # BMP280の起動時の処理
-    def __init__(self, logger = None):
+    def __init__(self, logger = None, burst = True):
         # もしloggerが渡されなかったら，ログの記録先を標準出力に設定
         if logger is None:
             logger = getLogger(__name__)
@@ -78,6 +81,15 @@ class BMP280:
         self.BUS_NUMBER  = 1  # I2C1を使用(デフォルト)
         self.I2C_ADDRESS = 0x76  # BMP280のI2Cアドレス．通信先のセンサの電話番号のようなもの．0x76(デフォルト)または0x77
         self.bus = SMBus(self.BUS_NUMBER)  # I2Cを扱うsmbusを定義
+        self._burst = burst  # Trueなら連続したレジスタを1回の通信でまとめて読む (Falseなら1バイトずつ読む)
+
+        # I2C通信にかかった時間の記録 (BNO055と同じバスを使うので，どれだけバスを占有しているかを確認する)
+        self.bus_time = 0.0  # 直近の1回の測定での通信時間[s]
+        self.bus_transactions = 0  # 直近の1回の測定での通信回数
+        self.total_bus_time = 0.0  # 起動してからの通信時間の合計[s]
+        self.total_bus_transactions = 0  # 起動してからの通信回数の合計
+        self._bus_time = 0.0
+        self._bus_transactions = 0
 
         self._setup()  # 測定方法や補正方法を設定
         self._get_calib_param()  # 補正用パラメータの読み取りと保存
@@ -112,6 +124,25 @@ class BMP280:
         except Exception as e:
             self._logger.exception("An error occured in setup bmp280")
     
+    # I2CにてBME280の連続したレジスタからデータを受信
+    def _read_regs(self, reg_address, length):
+        start = time.perf_counter()
+        if self._burst:
+            # 1回の通信でまとめて受信 (SMBusのブロック読み込みは32バイトまで)
+            data = self.bus.read_i2c_block_data(self.I2C_ADDRESS, reg_address, length)
+            transactions = 1
+        else:
+            # 1バイトずつ受信 (1バイトごとに1回通信する)
+            data = [self.bus.read_byte_data(self.I2C_ADDRESS, i) for i in range(reg_address, reg_address + length)]
+            transactions = length
+        elapsed = time.perf_counter() - start
+
+        self._bus_time += elapsed
+        self._bus_transactions += transactions
+        self.total_bus_time += elapsed
+        self.total_bus_transactions += transactions
+        return data
+
     # I2CにてBME280にデータを送信
     def _writeReg(self, reg_address, data):
         try:
@@ -131,11 +162,15 @@ class BMP280:
             calib = []  # 受信した補正用生データをここに格納
         
             # 補正用パラメータを受信
-            for i in range (0x88,0x88+24):
-                calib.append(self.bus.read_byte_data(self.I2C_ADDRESS,i))
-            calib.append(self.bus.read_byte_data(self.I2C_ADDRESS,0xA1))
-            for i in range (0xE1,0xE1+7):
-                calib.append(self.bus.read_byte_data(self.I2C_ADDRESS,i))
+            if self._burst:
+                # 0x88~0xA1 (0xA0は予約領域なので捨てる) と 0xE1~0xE7 の2回の通信で受信
+                block = self._read_regs(0x88, 26)
+                calib.extend(block[:24])
+                calib.append(block[25])
+            else:
+                calib.extend(self._read_regs(0x88, 24))
+                calib.extend(self._read_regs(0xA1, 1))
+            calib.extend(self._read_regs(0xE1, 7))
 
             # 受信した補正用生データを加工して保存
             self._digT[0] = ((calib[1] << 8) | calib[0])  # 気温補正データ
@@ -260,10 +295,24 @@ class BMP280:
         return humidity
     
     # ずっと測定し続ける
-    def get_forever(self, data):
+    def update(self, data, stream=None, t=None):
+        """1回だけ測定してdataに書き込む (SensorSchedulerから一定の周期で呼ぶ)
+
+        stream: FlightRecorderの"bmp"のストリームを渡すと，測定値をバイナリでも記録する
+        t: 測定した時刻 (time.monotonic())  省略すると記録した時刻
+        """
+        temperature, pressure, _, altitude = self.read()
+        data.update({"temp": temperature, "press": pressure, "alt": altitude})  # 3つを同時に書き込む
+        if stream is not None:
+            stream.append(temperature, pressure, altitude, t=t)
+        return temperature, pressure, altitude
+
+    def get_forever(self, data, recorder=None):
+        """recorder: FlightRecorderを渡すと，測定値をバイナリでも記録する"""
+        stream = recorder.stream("bmp") if recorder is not None else None
         while True:
             try:
-                data["temp"], data["press"], _, data["alt"] = self.read()
+                self.update(data, stream)
                 time.sleep(0.1)
             except Exception as e:
                 self._logger.exception(f"An error occured in bmp280 get_forever: {e}")
@@ -41,9 +41,11 @@
 
 
 # import binascii  # UARTによる通信を行うときのみ使用
+from collections import deque
 from logging import getLogger, StreamHandler  # ログを記録するため
 import time
 
+import numpy as np
 import pigpio
 # import serial  # UARTによる通信を行うときに使用
 
@@ -127,6 +129,38 @@ BNO055_GRAVITY_DATA_Z_MSB_ADDR       = 0X33
 # Temperature data register
 BNO055_TEMP_ADDR                     = 0X34
 
+# 0x08~0x33 (加速度~重力加速度) は連続しているので1回の通信でまとめて読める
+BNO055_FUSION_BLOCK_ADDR             = BNO055_ACCEL_DATA_X_LSB_ADDR
+BNO055_FUSION_BLOCK_LENGTH           = BNO055_TEMP_ADDR - BNO055_ACCEL_DATA_X_LSB_ADDR  # 44バイト
+
+# まとめて読んだデータの並び (名前, 先頭アドレス, 値の数, 単位への換算の割り算)  データシート 3.6.4, 3.6.5
+BNO055_FUSION_BLOCK_LAYOUT = (
+    ("accel",      BNO055_ACCEL_DATA_X_LSB_ADDR,        3, 100.0),      # m/s^2
+    ("mag",        BNO055_MAG_DATA_X_LSB_ADDR,          3, 16.0),       # μT
+    ("gyro",       BNO055_GYRO_DATA_X_LSB_ADDR,         3, 900.0),
+    ("euler",      BNO055_EULER_H_LSB_ADDR,             3, 16.0),       # deg (heading, roll, pitch)
+    ("quaternion", BNO055_QUATERNION_DATA_W_LSB_ADDR,   4, 1 << 14),    # (w, x, y, z)
+    ("line_accel", BNO055_LINEAR_ACCEL_DATA_X_LSB_ADDR, 3, 100.0),      # m/s^2
+    ("grav",       BNO055_GRAVITY_DATA_X_LSB_ADDR,      3, 100.0),      # m/s^2
+)
+
+# まとめて読んだ1サンプルを表す構造化配列の型  (各項目はfloat64のベクトルで，並びはレジスタの順と同じ)
+BNO055_SAMPLE_DTYPE = np.dtype([(name, np.float64, (count,)) for name, _, count, _ in BNO055_FUSION_BLOCK_LAYOUT])
+# 16bit整数の各チャンネル(22個)に掛ける換算係数
+_FUSION_SCALE = np.concatenate([np.full(count, 1.0 / scale) for _, _, count, scale in BNO055_FUSION_BLOCK_LAYOUT])
+
+
+def decode_fusion_block(buffers):
+    """BNO055_FUSION_BLOCK_ADDRからまとめて読んだ生データを，BNO055_SAMPLE_DTYPEの構造化配列に変換
+
+    buffers: 1サンプル分のbytes，またはそのリスト (履歴をまとめて変換できる)
+    """
+    if not isinstance(buffers, (bytes, bytearray, memoryview)):
+        buffers = b"".join(buffers)
+    raw = np.frombuffer(buffers, dtype='<i2').reshape(-1, _FUSION_SCALE.size)  # 16bit符号付き整数(リトルエンディアン)
+    # 換算後の(N, 22)の配列は，そのままBNO055_SAMPLE_DTYPEのN個の並びと同じメモリ配置になる
+    return (raw * _FUSION_SCALE).view(BNO055_SAMPLE_DTYPE).reshape(-1)
+
 # Status registers
 BNO055_CALIB_STAT_ADDR               = 0X35
 BNO055_SELFTEST_RESULT_ADDR          = 0X36
@@ -231,7 +265,7 @@ OPERATION_MODE_NDOF                  = 0X0C
 
 
 class BNO055(object):
-    def __init__(self, rst=None, address=BNO055_ADDRESS_A, i2c_bus=1, serial_port=None, serial_timeout_sec=5, logger=None):
+    def __init__(self, rst=None, address=BNO055_ADDRESS_A, i2c_bus=1, serial_port=None, serial_timeout_sec=5, logger=None, history=1000):
         """BNO055のセットアップ"""
 
         # もしloggerが渡されなかったら，ログの記録先を標準出力に設定
@@ -241,6 +275,10 @@ class BNO055(object):
             logger.setLevel(10)
         self._logger = logger
 
+        # read_allで読んだ生データの履歴 (時刻, bytes)  get_historyでまとめて変換できる
+        self._history = deque(maxlen=history)
+        self._next_log_time = 0.0  # updateで次にログを記録する時刻
+
         self.pi = pigpio.pi()  # pigpioでI2Cを扱う
         if not self.pi.connected:
             raise RuntimeError("Failed to connect to pigpio daemon")
@@ -686,12 +724,7 @@ class BNO055(object):
         # Read count number of 16-bit signed values starting from the provided
         # address. Returns a tuple of the values that were read.
         data = self._read_bytes(address, count*2)
-        result = [0]*count
-        for i in range(count):
-            result[i] = ((data[i*2+1] << 8) | data[i*2]) & 0xFFFF
-            if result[i] > 32767:
-                result[i] -= 65536
-        return result
+        return np.frombuffer(data, dtype='<i2').tolist()
 
     def read_euler(self):
         try:
@@ -699,7 +732,7 @@ class BNO055(object):
             and pitch euler angles in degrees.
             """
             heading, roll, pitch = self._read_vector(BNO055_EULER_H_LSB_ADDR)
-            self._logger.debug(f"euler: {heading/16.0}, {roll/16.0}, {pitch/16.0}")
+            self._logger.debug("euler: %s, %s, %s", heading/16.0, roll/16.0, pitch/16.0)
             return (heading/16.0, roll/16.0, pitch/16.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading euler")
@@ -710,7 +743,7 @@ class BNO055(object):
             in micro-Teslas.
             """
             x, y, z = self._read_vector(BNO055_MAG_DATA_X_LSB_ADDR)
-            self._logger.debug(f"mag: {x/16.0}, {y/16.0}, {z/16.0}")
+            self._logger.debug("mag: %s, %s, %s", x/16.0, y/16.0, z/16.0)
             return (x/16.0, y/16.0, z/16.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading magnetometer")
@@ -721,7 +754,7 @@ class BNO055(object):
             X, Y, Z values in degrees per second.
             """
             x, y, z = self._read_vector(BNO055_GYRO_DATA_X_LSB_ADDR)
-            self._logger.debug(f"gyro: {x/900.0}, {y/900.0}, {z/900.0}")
+            self._logger.debug("gyro: %s, %s, %s", x/900.0, y/900.0, z/900.0)
             return (x/900.0, y/900.0, z/900.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading gyroscope")
@@ -732,7 +765,7 @@ class BNO055(object):
             in meters/second^2.
             """
             x, y, z = self._read_vector(BNO055_ACCEL_DATA_X_LSB_ADDR)
-            self._logger.debug(f"accel: {x/100.0}, {y/100.0}, {z/100.0}")
+            self._logger.debug("accel: %s, %s, %s", x/100.0, y/100.0, z/100.0)
             return (x/100.0, y/100.0, z/100.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading accelerometer")
@@ -743,7 +776,7 @@ class BNO055(object):
             not from gravity) reading as a tuple of X, Y, Z values in meters/second^2.
             """
             x, y, z = self._read_vector(BNO055_LINEAR_ACCEL_DATA_X_LSB_ADDR)
-            self._logger.debug(f"liner_accel: {x/100.0}, {y/100.0}, {z/100.0}")
+            self._logger.debug("liner_accel: %s, %s, %s", x/100.0, y/100.0, z/100.0)
             return (x/100.0, y/100.0, z/100.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading linear acceleration")
@@ -754,7 +787,7 @@ class BNO055(object):
             values in meters/second^2.
             """
             x, y, z = self._read_vector(BNO055_GRAVITY_DATA_X_LSB_ADDR)
-            self._logger.debug(f"grav: {x/100.0}, {y/100.0}, {z/100.0}")
+            self._logger.debug("grav: %s, %s, %s", x/100.0, y/100.0, z/100.0)
             return (x/100.0, y/100.0, z/100.0)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading gravity")
@@ -767,37 +800,88 @@ class BNO055(object):
             w, x, y, z = self._read_vector(BNO055_QUATERNION_DATA_W_LSB_ADDR, 4)
             # Scale values, see 3.6.5.5 in the datasheet.
             scale = (1.0 / (1<<14))
-            self._logger.debug(f"quaternion: {x*scale}, {y*scale}, {z*scale}")
+            self._logger.debug("quaternion: %s, %s, %s", x*scale, y*scale, z*scale)
             return (x*scale, y*scale, z*scale, w*scale)
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading quaternion")
 
+    def read_all(self):
+        """加速度・地磁気・ジャイロ・オイラー角・クォータニオン・線形加速度・重力加速度を1回の通信でまとめて読む
+
+        BNO055_SAMPLE_DTYPE の1サンプルを返す  sample["mag"] -> [x, y, z], sample["quaternion"] -> [w, x, y, z] (単位はread_*と同じ)
+        1回の読み込みごとにログは出さない
+        """
+        data = self._read_bytes(BNO055_FUSION_BLOCK_ADDR, BNO055_FUSION_BLOCK_LENGTH)
+        self._history.append((time.time(), bytes(data)))
+        return decode_fusion_block(data)[0]
+
+    def get_history(self):
+        """read_allで読んだ過去のサンプルをまとめて変換して (時刻の配列, BNO055_SAMPLE_DTYPEの配列) を返す"""
+        history = list(self._history)
+        times = np.array([t for t, _ in history], dtype=np.float64)
+        return times, decode_fusion_block([buffer for _, buffer in history])
+
     def read_temp(self):
         try:
             """Return the current temperature in Celsius."""
             temperature = self._read_signed_byte(BNO055_TEMP_ADDR)
-            self._logger.debug(f"bno_temp: {temperature}")
+            self._logger.debug("bno_temp: %s", temperature)
             return temperature
         except Exception as e:
             self._logger.exception("An error occured in bno055 reading temperture")
     
     # ずっと測定し続ける
-    def get_forever(self, data):
+    def update(self, data, stream=None, t=None, log_interval=1.0):
+        """全ての値を1回の通信で読み，dataに書き込む (SensorSchedulerから一定の周期で呼ぶ)
+
+        stream: FlightRecorderの"bno"のストリームを渡すと，全ての値をバイナリでも記録する
+        t: 読み込んだ時刻 (time.monotonic())  省略すると記録した時刻
+        ログはlog_interval秒に1回だけ記録する
+        """
+        values = self.read_all()
+        # 読み込み途中の値が他のスレッドから見えないよう，全ての値をまとめて書き込む
+        data.update({
+            "mag": values["mag"],
+            "gyro": values["gyro"],
+            "accel": values["accel"],
+            "line_accel": values["line_accel"],
+            "grav": values["grav"],
+            "euler": values["euler"],
+        })
+        if stream is not None:
+            stream.append(values["mag"], values["gyro"], values["accel"], values["line_accel"], values["grav"],
+                          values["euler"], t=t)
+        # calc_goal.calc_goal(data)  # ゴールまでの距離と向きを計算
+
+        now = time.monotonic()
+        if now >= self._next_log_time:
+            self._logger.debug("mag: %s, gyro: %s, accel: %s, line_accel: %s, grav: %s",
+                               values["mag"], values["gyro"], values["accel"], values["line_accel"], values["grav"])
+            self._next_log_time = now + log_interval
+        return values
+
+    def get_forever(self, data, period=0.01, log_interval=1.0, recorder=None):
+        """period秒(デフォルト: 100Hz)ごとに全ての値を1回の通信で読み，dataに書き込む
+
+        ログはlog_interval秒に1回だけ記録する
+        recorder: FlightRecorderを渡すと，全ての値を毎回バイナリで記録する
+        """
+        stream = recorder.stream("bno") if recorder is not None else None
+        next_time = time.monotonic()
         while True:
             try:
-                # self.read_euler()
-                data["mag"][0], data["mag"][1], data["mag"][2] = self.read_magnetometer()
-                data["gyro"][0], data["gyro"][1], data["gyro"][2] = self.read_gyroscope()
-                data["accel"][0], data["accel"][1], data["accel"][2] = self.read_accelerometer()
-                data["line_accel"][0], data["line_accel"][1], data["line_accel"][2] = self.read_linear_acceleration()
-                data["grav"][0], data["grav"][1], data["grav"][2] = self.read_gravity()
-                # self.read_quaternion()
-                # self.read_temp()
-                # calc_goal.calc_goal(data)  # ゴールまでの距離と向きを計算
-                time.sleep(0.2)
+                self.update(data, stream, log_interval=log_interval)
             except Exception as e:
                 self._logger.exception(f"An error occured in bno055 get_forever: {e}")
 
+            # 処理にかかった時間を差し引いて，一定の周期で読み込む (遅れたら次の周期に合わせる)
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+
 if __name__ == "__main__":
     try:
         # データ取得のサンプル
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import math
 import numpy as np
 
@@ -14,23 +15,201 @@ def calc_goal(data):
         return
     
     #1.ゴールの緯度経度をCanSat中心のxy座標で表す。
-    goal_xy = _calc_xy(goal_latitude,goal_longitude,now_latitude,now_longitude)
+    goal_xy = goal_vector(goal_latitude, goal_longitude, now_latitude, now_longitude)
 
-    #2.緯度経度→→→ゴールと機体の距離を求める
-    distance = float(np.sqrt((goal_xy[1])**2 + (goal_xy[0])**2))
+    #2~4. 距離と向きを求める (1回分の計算なのでNumPyを使わずmathで計算)
+    distance = goal_distance(goal_xy)
+    cansat_to_goal_angle_degree = goal_angle(goal_xy, north_angle_from_mag(mag))
 
+    data.update({"goal_distance": distance, "goal_angle": cansat_to_goal_angle_degree})
+
+
+def goal_vector(goal_lat, goal_lon, now_lat, now_lon):
+    """ゴールの緯度経度をCanSat中心のxy座標[m]で表す
+
+    ゴールを原点とした座標系でCanSatの位置を求め，符号を反転する (ゴール側の計算は使い回せる)
+    """
+    cansat_xy = goal_projection(goal_lat, goal_lon).project(now_lat, now_lon)
+    return (-cansat_xy[0], -cansat_xy[1])
+
+
+def goal_distance(goal_xy):
+    """緯度経度→→→ゴールと機体の距離[m]を求める"""
+    return math.sqrt((goal_xy[1])**2 + (goal_xy[0])**2)
+
+
+def north_angle_from_mag(mag):
+    """地磁気から，機体から見た北の向き[rad]を求める
+
+    north_angle_rad - math.piは、平面直交座標のx軸(西)と北の向きを表すときのx軸(機体の正面)が何度ずれているかを表している
+    """
+    return math.atan2(mag[0], mag[1])  ##############<==##########要確認#############################
+
+
+def north_angle_from_heading(heading):
+    """BNO055のオイラー角のheading[度]から，機体から見た北の向き[rad]を求める
+
+    機体の正面が北を向いているとき(heading=0)に地磁気から求めた場合と同じπ/2になり，時計回りに回ると増える ##要確認##
+    """
+    return math.pi / 2 + math.radians(heading)
+
+
+def goal_angle(goal_xy, north_angle_rad):
+    """CanSat中心のゴールの座標と北の向きから，ゴールの向き[度]を求める (1点用，mathのみ)"""
     #3.機体の正面と北の向きの関係＋北の向きとゴールの向きの関係→→→機体の正面とゴールの向きの関係を求める
     #やってることとしては東西南北の基底→CanSatの基底に座標変換するために回転行列を使ってる感じ
-    #north_angle_rad - math.piは、平面直交座標のx軸(西)と北の向きを表すときのx軸(機体の正面)が何度ずれているかを表している
-    north_angle_rad = np.arctan2(mag[0], mag[1])  ##############<==##########要確認#############################
     cansat_to_goal = _rotation_clockwise_xy(goal_xy,north_angle_rad)
-    
+
     #4.CanSatの正面とゴールの向きの関係を角度で表現している(radian→degreeの変換も行う)。ただし、角度の定義域は(0<=degree<=360)。正面は0と360で真後ろが180。
-    cansat_to_goal_angle = np.arctan2(cansat_to_goal[1],cansat_to_goal[0])
-    cansat_to_goal_angle_degree = float(math.degrees(cansat_to_goal_angle) + 180)
+    cansat_to_goal_angle = math.atan2(cansat_to_goal[1],cansat_to_goal[0])
+    return math.degrees(cansat_to_goal_angle) + 180
+
+
+def calc_goal_batch(goal_lat, goal_lon, lats, lons, mags):
+    """calc_goalの配列版 (記録したGNSSの軌跡と地磁気をまとめて計算する用)
+
+    lats, lons: 緯度・経度の配列 (N,)
+    mags: 地磁気の配列 (N, 3)
+    戻り値: (距離の配列, 向きの配列)
+    """
+    mags = np.asarray(mags, dtype=np.float64)
+    cansat_x, cansat_y = goal_projection(goal_lat, goal_lon).project(np.asarray(lats), np.asarray(lons))
+    goal_x, goal_y = -cansat_x, -cansat_y
+    distance = np.hypot(goal_x, goal_y)
+    north_angle_rad = np.arctan2(mags[:, 0], mags[:, 1])
+    cansat_to_goal = _rotation_clockwise_xy((goal_x, goal_y), north_angle_rad)
+    angle = np.degrees(np.arctan2(cansat_to_goal[1], cansat_to_goal[0])) + 180
+    return distance, angle
+
+
+# 定数 (a, F: 世界測地系-測地基準系1980（GRS80）楕円体)
+M0 = 0.9999
+A = 6378137.
+F = 298.257222101
+
+
+def _A_array(n):
+    A0 = 1 + (n**2)/4. + (n**4)/64.
+    A1 = -     (3./2)*( n - (n**3)/8. - (n**5)/64. )
+    A2 =     (15./16)*( n**2 - (n**4)/4. )
+    A3 = -   (35./48)*( n**3 - (5./16)*(n**5) )
+    A4 =   (315./512)*( n**4 )
+    A5 = -(693./1280)*( n**5 )
+    return np.array([A0, A1, A2, A3, A4, A5])
+
 
-    data["goal_distance"] = distance
-    data["goal_angle"] = cansat_to_goal_angle_degree
+def _alpha_array(n):
+    a0 = np.nan # dummy
+    a1 = (1./2)*n - (2./3)*(n**2) + (5./16)*(n**3) + (41./180)*(n**4) - (127./288)*(n**5)
+    a2 = (13./48)*(n**2) - (3./5)*(n**3) + (557./1440)*(n**4) + (281./630)*(n**5)
+    a3 = (61./240)*(n**3) - (103./140)*(n**4) + (15061./26880)*(n**5)
+    a4 = (49561./161280)*(n**4) - (179./168)*(n**5)
+    a5 = (34729./80640)*(n**5)
+    return np.array([a0, a1, a2, a3, a4, a5])
+
+
+# (1) n, A_i, alpha_iの計算  (楕円体だけで決まるので起動時に1回だけ計算)
+_N = 1.0 / (2*F - 1)
+_A_ARRAY = _A_array(_N)
+_ALPHA_ARRAY = _alpha_array(_N)
+_A_ = ( (M0*A)/(1.+_N) )*_A_ARRAY[0] # [m]
+_K = np.arange(1, 6)
+_T_COEF = (2*np.sqrt(_N)) / (1+_N)
+
+# 1点だけ変換するときに使うPythonのfloatの係数 (NumPyの呼び出しのオーバーヘッドを避ける)
+_ALPHA = tuple(float(a) for a in _ALPHA_ARRAY[1:])
+_A_F = float(_A_)
+_T_COEF_F = float(_T_COEF)
+
+
+class GaussKruger:
+    """平面直角座標系原点を固定した，緯度経度から平面直角座標への変換
+
+    原点だけで決まる値(子午線弧長S_など)は作成時に1回だけ計算しておく．
+    project()には1点の緯度経度も，緯度経度の配列(GNSSの軌跡全体など)も渡せる．
+    """
+    def __init__(self, phi0_deg, lambda0_deg):
+        """(phi0_deg, lambda0_deg): 平面直角座標系原点の緯度・経度[度]（分・秒でなく小数であることに注意）"""
+        self.phi0_deg = phi0_deg
+        self.lambda0_deg = lambda0_deg
+        phi0_rad = np.deg2rad(phi0_deg)
+        self._lambda0_rad = np.deg2rad(lambda0_deg)
+
+        # (2), S, Aの計算
+        self._S_ = ( (M0*A)/(1.+_N) )*( _A_ARRAY[0]*phi0_rad + np.dot(_A_ARRAY[1:], np.sin(2*phi0_rad*_K)) ) # [m]
+        self._S_f = float(self._S_)
+        self._lambda0_rad_f = float(self._lambda0_rad)
+
+    def project(self, phi_deg, lambda_deg):
+        """緯度経度を平面直角座標に変換する
+        - input:
+            (phi_deg, lambda_deg): 変換したい緯度・経度[度]  (数値または同じ形の配列)
+        - output:
+            x: 変換後の平面直角座標[m] (北向きが正)
+            y: 変換後の平面直角座標[m] (東向きが正)
+        1点だけのときはmathだけで計算するproject_scalarを使う
+        """
+        if isinstance(phi_deg, (float, int)) and isinstance(lambda_deg, (float, int)):
+            return self.project_scalar(phi_deg, lambda_deg)
+        return self.project_array(phi_deg, lambda_deg)
+
+    def project_scalar(self, phi_deg, lambda_deg):
+        """1点の緯度経度を平面直角座標に変換する (mathのみ．計算式はproject_arrayと同じ)"""
+        phi_rad = math.radians(phi_deg)
+        d_lambda = math.radians(lambda_deg) - self._lambda0_rad_f
+
+        # (3) lambda_c, lambda_sの計算
+        lambda_c = math.cos(d_lambda)
+        lambda_s = math.sin(d_lambda)
+
+        # (4) t, t_の計算
+        sin_phi = math.sin(phi_rad)
+        t = math.sinh( math.atanh(sin_phi) - _T_COEF_F*math.atanh(_T_COEF_F * sin_phi) )
+        t_ = math.sqrt(1 + t*t)
+
+        # (5) xi', eta'の計算
+        xi2  = math.atan(t / lambda_c) # [rad]
+        eta2 = math.atanh(lambda_s / t_)
+
+        # (6) x, yの計算
+        sum_x = sum_y = 0.0
+        for k, alpha in enumerate(_ALPHA, start=1):
+            sum_x += alpha * math.sin(2*k*xi2) * math.cosh(2*k*eta2)
+            sum_y += alpha * math.cos(2*k*xi2) * math.sinh(2*k*eta2)
+        x = _A_F * (xi2 + sum_x) - self._S_f # [m]
+        y = _A_F * (eta2 + sum_y) # [m]
+        return (x, y)  # [m]
+
+    def project_array(self, phi_deg, lambda_deg):
+        """緯度経度(配列)を平面直角座標に変換する (NumPyでまとめて計算)"""
+        # 緯度経度をラジアンに直す
+        phi_rad = np.deg2rad(np.asarray(phi_deg, dtype=np.float64))
+        lambda_rad = np.deg2rad(np.asarray(lambda_deg, dtype=np.float64))
+
+        # (3) lambda_c, lambda_sの計算
+        lambda_c = np.cos(lambda_rad - self._lambda0_rad)
+        lambda_s = np.sin(lambda_rad - self._lambda0_rad)
+
+        # (4) t, t_の計算
+        t = np.sinh( np.arctanh(np.sin(phi_rad)) - _T_COEF*np.arctanh(_T_COEF * np.sin(phi_rad)) )
+        t_ = np.sqrt(1 + t*t)
+
+        # (5) xi', eta'の計算
+        xi2  = np.arctan(t / lambda_c)[..., np.newaxis] # [rad]
+        eta2 = np.arctanh(lambda_s / t_)[..., np.newaxis]
+
+        # (6) x, yの計算  (最後の軸が1~5の級数)
+        x = _A_ * (xi2[..., 0] + np.sum(_ALPHA_ARRAY[1:] * np.sin(2*xi2*_K) * np.cosh(2*eta2*_K), axis=-1)) - self._S_ # [m]
+        y = _A_ * (eta2[..., 0] + np.sum(_ALPHA_ARRAY[1:] * np.cos(2*xi2*_K) * np.sinh(2*eta2*_K), axis=-1)) # [m]
+        if x.ndim == 0:
+            return (float(x), float(y))
+        return (x, y)  # [m]
+
+
+@lru_cache(maxsize=4)
+def goal_projection(goal_lat, goal_lon):
+    """ゴールを原点とするGaussKruger (ゴールが変わらない限り作り直さない)"""
+    return GaussKruger(goal_lat, goal_lon)
 
 
 def _calc_xy(phi_deg, lambda_deg, phi0_deg, lambda0_deg):
@@ -42,74 +221,48 @@ def _calc_xy(phi_deg, lambda_deg, phi0_deg, lambda0_deg):
         x: 変換後の平面直角座標[m]
         y: 変換後の平面直角座標[m]
     """
-    # 緯度経度・平面直角座標系原点をラジアンに直す
-    phi_rad = np.deg2rad(phi_deg)
-    lambda_rad = np.deg2rad(lambda_deg)
-    phi0_rad = np.deg2rad(phi0_deg)
-    lambda0_rad = np.deg2rad(lambda0_deg)
-
-    # 補助関数
-    def A_array(n):
-        A0 = 1 + (n**2)/4. + (n**4)/64.
-        A1 = -     (3./2)*( n - (n**3)/8. - (n**5)/64. ) 
-        A2 =     (15./16)*( n**2 - (n**4)/4. )
-        A3 = -   (35./48)*( n**3 - (5./16)*(n**5) )
-        A4 =   (315./512)*( n**4 )
-        A5 = -(693./1280)*( n**5 )
-        return np.array([A0, A1, A2, A3, A4, A5])
-
-    def alpha_array(n):
-        a0 = np.nan # dummy
-        a1 = (1./2)*n - (2./3)*(n**2) + (5./16)*(n**3) + (41./180)*(n**4) - (127./288)*(n**5)
-        a2 = (13./48)*(n**2) - (3./5)*(n**3) + (557./1440)*(n**4) + (281./630)*(n**5)
-        a3 = (61./240)*(n**3) - (103./140)*(n**4) + (15061./26880)*(n**5)
-        a4 = (49561./161280)*(n**4) - (179./168)*(n**5)
-        a5 = (34729./80640)*(n**5)
-        return np.array([a0, a1, a2, a3, a4, a5])
-
-    # 定数 (a, F: 世界測地系-測地基準系1980（GRS80）楕円体)
-    M0 = 0.9999 
-    A = 6378137.
-    F = 298.257222101
-
-    # (1) n, A_i, alpha_iの計算
-    n = 1.0 / (2*F - 1)
-    A_array = A_array(n)
-    alpha_array = alpha_array(n)
-
-    # (2), S, Aの計算
-    A_ = ( (M0*A)/(1.+n) )*A_array[0] # [m]
-    S_ = ( (M0*A)/(1.+n) )*( A_array[0]*phi0_rad + np.dot(A_array[1:], np.sin(2*phi0_rad*np.arange(1,6))) ) # [m]
-
-    # (3) lambda_c, lambda_sの計算
-    lambda_c = np.cos(lambda_rad - lambda0_rad)
-    lambda_s = np.sin(lambda_rad - lambda0_rad)
-
-    # (4) t, t_の計算
-    t = np.sinh( np.arctanh(np.sin(phi_rad)) - ((2*np.sqrt(n)) / (1+n))*np.arctanh(((2*np.sqrt(n)) / (1+n)) * np.sin(phi_rad)) )
-    t_ = np.sqrt(1 + t*t)
-
-    # (5) xi', eta'の計算
-    xi2  = np.arctan(t / lambda_c) # [rad]
-    eta2 = np.arctanh(lambda_s / t_)
-
-    # (6) x, yの計算
-    x = A_ * (xi2 + np.sum(np.multiply(alpha_array[1:],
-                                       np.multiply(np.sin(2*xi2*np.arange(1,6)),
-                                                   np.cosh(2*eta2*np.arange(1,6)))))) - S_ # [m]
-    y = A_ * (eta2 + np.sum(np.multiply(alpha_array[1:],
-                                        np.multiply(np.cos(2*xi2*np.arange(1,6)),
-                                                    np.sinh(2*eta2*np.arange(1,6)))))) # [m]
-    # return
-    return (x, y)  # [m]
+    return GaussKruger(phi0_deg, lambda0_deg).project(phi_deg, lambda_deg)
 
 
 def _rotation_clockwise_xy(vec_xy,radian):
     """平面直角座標系におけるゴール座標と機体からみた北の向きから，機体の座標系におけるゴール座標を計算"""
-    sin_rad = np.sin(radian)
-    cos_rad = np.cos(radian)
+    if isinstance(radian, float):
+        sin_rad = math.sin(radian)
+        cos_rad = math.cos(radian)
+    else:
+        sin_rad = np.sin(radian)
+        cos_rad = np.cos(radian)
     new_vector_x = vec_xy[0]*cos_rad + vec_xy[1]*sin_rad
     new_vector_y = vec_xy[1]*cos_rad - vec_xy[0]*sin_rad
     new_vector = (new_vector_x,new_vector_y)
 
-    return new_vector
\ No newline at end of file
+    return new_vector
+
+
+if __name__ == "__main__":
+    # 1点ずつ計算する場合(math)と，NumPyで計算する場合の速さを比べる
+    import timeit
+
+    GOAL_LAT, GOAL_LON = 40.1426274282454, 139.987655687316
+    data = {"goal_lat": GOAL_LAT, "goal_lon": GOAL_LON, "lat": 40.1430, "lon": 139.9870, "mag": [10.0, -20.0, 3.0]}
+    projection = goal_projection(GOAL_LAT, GOAL_LON)
+    number = 20000
+
+    def numpy_single():
+        """以前と同じくNumPyで1点を計算"""
+        x, y = projection.project_array(data["lat"], data["lon"])
+        goal_xy = (-x, -y)
+        np.sqrt(goal_xy[0]**2 + goal_xy[1]**2)
+        north = np.arctan2(data["mag"][0], data["mag"][1])
+        rotated = _rotation_clockwise_xy(goal_xy, north)
+        np.arctan2(rotated[1], rotated[0])
+
+    for name, func in (("calc_goal (math)", lambda: calc_goal(data)), ("calc_goal (numpy)", numpy_single)):
+        seconds = timeit.timeit(func, number=number)
+        print(f"{name:20s}: {number / seconds:10.0f} calls/s")
+
+    lats = np.full(number, data["lat"]) + np.linspace(0, 1e-3, number)
+    lons = np.full(number, data["lon"])
+    mags = np.tile(data["mag"], (number, 1))
+    seconds = timeit.timeit(lambda: calc_goal_batch(GOAL_LAT, GOAL_LON, lats, lons, mags), number=1)
+    print(f"{'calc_goal_batch':20s}: {number / seconds:10.0f} fixes/s")
@@ -1,46 +1,240 @@
 from logging import getLogger, StreamHandler
+from threading import Condition, Thread
+import time
+
 import cv2
-import numpy as np
 from picamera2 import Picamera2
 
+from color_lut import RedLUT, split_yuv420
+from detect_pipeline import DetectPipeline
+from detection_ring import cone_order
+from hsv_profile import ProfileStore
+from preview_sink import PreviewSink
+
+
+# camera_orderごとの表示
+_ORDER_NAMES = {0: "not found", 1: "center", 2: "right", 3: "left", 4: "close"}
+_ORDER_MESSAGES = {
+    0: "The red object is too minimum",
+    1: "The red object is in the center",  # 直進
+    2: "The red object is in the right",  # 右へ
+    3: "The red object is in the left",  # 左へ
+    4: "Close enough to red",
+}
+
 
 class Camera:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, show=False, save=False, size=(320, 240), continuous=True, format="RGB888", track=True, track_pad=0.5,
+                 headless=None, preview=None, profiles=None, profile_interval=1.0):
+        """
+        show: Trueなら認識結果を画面に表示
+        save: Trueなら10枚に1枚，認識結果を描き込んだ画像を camera.jpg に書き出す (previewを渡した場合はそちらを使う)
+        size: 画像認識に使う画像の大きさ (幅, 高さ)
+        continuous: Trueならカメラを1回だけ起動し，撮影スレッドが撮り続けた最新の画像を使う
+                    Falseなら以前と同じく毎回 start() してから撮影する (速さの比較用)
+        format: 撮影する画像の形式  "RGB888" (BGRの並び) または "YUV420" (色の変換をせずにYUVのまま赤色を判定する)
+        track: Trueなら前の画像でコーンが見つかった範囲の周りだけを探す (見失ったら画像全体を探し直す)
+        track_pad: 前の外接矩形の周りに広げる幅 (外接矩形の大きさに対する割合)
+        headless: Trueなら画像への描き込みと標準出力への表示を全くしない (省略するとshowでなければTrue)
+                  プレビューを書き出す画像にだけは描き込む
+        preview: 認識結果を書き出すPreviewSink
+        profiles: 明るさごとの赤色の値域を保存したJSONのパス (hsv_profile.py で作る) またはProfileStore
+                  カメラの露光時間とゲインに合う値域をprofile_interval秒ごとに選び直す
+                  (省略すると hsv_profiles.json を読み込み，ファイルがなければこれまでの値域だけを使う)
+        """
         if logger is None:
             logger = getLogger(__name__)
             logger.addHandler(StreamHandler())
             logger.setLevel(10)  # DEBUGレベル
         self._logger = logger
 
+        self._show = show
+        self._save = save
+        self._headless = (not show) if headless is None else headless
+        if preview is None and save:
+            preview = PreviewSink("camera.jpg", every=10, logger=logger)
+        self._preview = preview
+        self._continuous = continuous
+        if format not in ("RGB888", "YUV420"):
+            raise ValueError(f"format must be 'RGB888' or 'YUV420': {format}")
+        self._format = format
+        self._size = size
+
         self._picam2 = Picamera2()
-    
+        # 画像認識用の小さい画像を撮り続ける設定にしておく (RGB888はOpenCVと同じBGRの並び)
+        config = self._picam2.create_video_configuration(main={"size": size, "format": format})
+        self._picam2.configure(config)
+
+        # 赤色の判定表 (YUVの場合はカメラの色空間に合わせた変換式で作る)
+        colour_space = str(config.get("colour_space", "")).lower()
+        if colour_space not in ("sycc", "smpte170m", "rec709"):
+            colour_space = "smpte170m"
+        self._colour_space = colour_space
+        # プロファイルごとの判定表は起動時に全て作っておき，実行中は切り替えるだけにする
+        if profiles is None:
+            profiles = ProfileStore()  # hsv_profiles.json
+        elif isinstance(profiles, str):
+            profiles = ProfileStore(profiles)
+        self._profiles = profiles
+        self._luts = {}
+        for profile in profiles.profiles:
+            lut = RedLUT(profile["hsv_ranges"], colour_space=colour_space)
+            if format == "YUV420":
+                lut.build_yuv_lut()
+            else:
+                lut.build_bgr_lut()
+            self._luts[profile["name"]] = lut
+        self.profile = profiles.select()
+        self._lut = self._luts[self.profile["name"]]
+        self._profile_interval = profile_interval
+        self._next_profile_time = 0.0
+
+        # 撮影スレッドが撮った画像を入れるダブルバッファ
+        # 撮影スレッドは最新でない方に書き込み，書き終わったら最新の方を切り替える
+        # (make_arrayは毎回新しい配列を返すので，画像認識側が持っている配列が書き換えられることはない)
+        self._frames = [None, None]
+        self._frame_times = [0.0, 0.0]
+        self._frame_metadata = [{}, {}]  # 撮影したときの露光時間やゲインなど
+        self.last_metadata = {}  # get_frameで返した画像のメタデータ
+        self._latest = 0  # 最新の画像が入っている方
+        self._frame_seq = 0  # 撮影した画像の通し番号
+        self._frame_cond = Condition()
+        self._capture_thread = None
+
+        # 追跡モード
+        self._track = track
+        self._track_pad = track_pad
+        self._last_rect = None  # 前の画像で見つかったコーンの外接矩形 (x, y, w, h)
+
+        # 直近の画像の認識結果 (DetectionRingに書き込む)
+        self.last_detection = None  # {"center": (x, y), "rect": (x, y, w, h), "area": 面積}  見つからなければNone
+        self.last_capture_time = 0.0  # 撮影した時刻 (time.monotonic())
+        self._last_seq = 0  # 直近に処理した画像の通し番号
+
+        # get_foreverの処理速度
+        self.fps = 0.0
+        self.capture_fps = 0.0
+        self.timings = {"capture": 0.0, "segment": 0.0, "contour": 0.0}  # 直近の画像の各段階の処理時間[s]
+        self.roi_hits = 0  # 追跡範囲の中だけでコーンが見つかった回数
+        self.full_searches = 0  # 画像全体を探した回数
+
     def start(self):
         """カメラを起動"""
         self._picam2.start()
+        if self._continuous and self._capture_thread is None:
+            self._capture_thread = Thread(target=self._capture_forever, daemon=True)
+            self._capture_thread.start()
         self._logger.info("Camera started")
 
-    def red_detect(self, frame):
-        # HSV色空間に変換
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    def _capture_forever(self):
+        """最新の画像をダブルバッファに撮り続ける"""
+        window_start = time.monotonic()
+        window_frames = 0
+        while True:
+            try:
+                # 画像と，その画像を撮ったときのメタデータを一緒に受け取る
+                request = self._picam2.capture_request()
+                try:
+                    frame = request.make_array("main")
+                    metadata = request.get_metadata()
+                finally:
+                    request.release()
+                capture_time = time.monotonic()
+                back = 1 - self._latest
+                self._frames[back] = frame
+                self._frame_times[back] = capture_time
+                self._frame_metadata[back] = metadata
+                with self._frame_cond:
+                    self._latest = back
+                    self._frame_seq += 1
+                    self._frame_cond.notify_all()
+
+                window_frames += 1
+                if capture_time - window_start >= 1.0:
+                    self.capture_fps = window_frames / (capture_time - window_start)
+                    window_start, window_frames = capture_time, 0
+            except Exception as e:
+                self._logger.exception(f"An error occured in camera capture: {e}")
+                time.sleep(0.1)
+
+    def get_frame(self, last_seq=0, timeout=1.0):
+        """last_seqより新しい画像が撮れるまで待ち，(通し番号, 撮影時刻, 画像) を返す
+
+        撮影し直すことはしないので，処理が撮影より遅い場合は間の画像は飛ばされる
+        """
+        if not self._continuous:
+            # 以前と同じく毎回startしてから撮影
+            self._picam2.start()
+            frame = self._picam2.capture_array()
+            self._frame_seq += 1
+            return self._frame_seq, time.monotonic(), frame
 
-        # 赤色のHSVの値域1
-        hsv_min = np.array([0, 117, 104])
-        hsv_max = np.array([11, 255, 255])
-        mask1 = cv2.inRange(hsv, hsv_min, hsv_max)
+        with self._frame_cond:
+            if not self._frame_cond.wait_for(lambda: self._frame_seq > last_seq, timeout):
+                raise TimeoutError("No new frame from camera")
+            latest = self._latest
+            self.last_metadata = self._frame_metadata[latest]
+            return self._frame_seq, self._frame_times[latest], self._frames[latest]
 
-        # 赤色のHSVの値域2
-        hsv_min = np.array([169, 117, 104])
-        hsv_max = np.array([179, 255, 255])
-        mask2 = cv2.inRange(hsv, hsv_min, hsv_max)
+    def red_detect(self, frame, roi=None):
+        """赤色のマスクを返す (roi=(x, y, w, h) を指定するとその範囲だけのマスク)
 
-        return mask1 + mask2
+        今のプロファイルのHSVの値域から作った判定表(color_lut.RedLUT)を引く
+        (プロファイルがなければ (0~11, 117~255, 104~255) と (169~179, 117~255, 104~255))
+        YUV420の場合は縦横1/2で判定してから元の大きさに戻す
+        """
+        width, height = self._size
+        x, y, w, h = roi if roi is not None else (0, 0, width, height)
+        if self._format == "YUV420":
+            luma, u, v = split_yuv420(frame, width, height)
+            mask = self._lut.yuv(luma[y:y + h:2, x:x + w:2],
+                                 u[y // 2:(y + h) // 2, x // 2:(x + w) // 2],
+                                 v[y // 2:(y + h) // 2, x // 2:(x + w) // 2])
+            return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+        return self._lut.bgr(frame[y:y + h, x:x + w])
 
+    def update_profile(self, metadata):
+        """メタデータの露光時間とゲインに合うプロファイルを選び，判定表を切り替える"""
+        profile = self._profiles.select(metadata)
+        if profile["name"] != self.profile["name"]:
+            self._logger.info(f"HSV profile: {self.profile['name']} -> {profile['name']} (exposure: {metadata.get('ExposureTime')}, gain: {metadata.get('AnalogueGain')})")
+            self.profile = profile
+            self._lut = self._luts[profile["name"]]
 
-    def analyze_red(self, frame, mask):
+    def _track_roi(self):
+        """前の外接矩形をtrack_padの割合だけ広げた範囲 (YUV420の色差と揃うように偶数に丸める)"""
+        if not self._track or self._last_rect is None:
+            return None
+        width, height = self._size
+        x, y, w, h = self._last_rect
+        pad_x = int(w * self._track_pad) + 8
+        pad_y = int(h * self._track_pad) + 8
+        x0 = max(x - pad_x, 0) & ~1
+        y0 = max(y - pad_y, 0) & ~1
+        x1 = min(x + w + pad_x + 1, width) & ~1
+        y1 = min(y + h + pad_y + 1, height) & ~1
+        if (x1 - x0) * (y1 - y0) >= width * height // 2:
+            return None  # 画像の半分以上なら全体を探すのと変わらない
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def find_contours(self, frame, roi=None):
+        """赤色の領域の外側の輪郭を画像全体の座標で返す"""
+        start = time.perf_counter()
+        mask = self.red_detect(frame, roi)
+        segmented = time.perf_counter()
+        offset = roi[:2] if roi is not None else (0, 0)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        self.timings["segment"] += segmented - start
+        self.timings["contour"] += time.perf_counter() - segmented
+        return contours
+
+
+    def analyze_red(self, frame, contours, annotate=True):
+        """最大の赤い領域からcamera_orderを決める  annotateがTrueなら結果をframeに描き込む"""
         camera_order = 0
-        # 画像の中にある領域を検出する
-        contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            
+        self._last_rect = None
+        self.last_detection = None
+
         #画像の中に赤の領域があるときにループ
         if 0 < len(contours):
                         
@@ -53,56 +247,42 @@ class Camera:
             # #最大の領域の中心座標を取得する
             center_x = (rect[0] + rect[2] // 2)
             center_y = (rect[1] + rect[3] // 2)
-            csv.print('camera_center', [center_x, center_y])
+            self._logger.debug("camera_center: [%d, %d]", center_x, center_y)
 
             # 最大の領域の面積を取得する-
             area = cv2.contourArea(biggest_contour)
-            csv.print('camera_area', area)
+            self._logger.debug("camera_area: %s", area)
+            if area > 10:
+                self._last_rect = rect  # 次の画像ではこの周りだけを探す
+                self.last_detection = {"center": (center_x, center_y), "rect": rect, "area": area}
 
-            # 最大の領域の長方形を表示する
-            cv2.rectangle(frame, (rect[0], rect[1]), (rect[0] + rect[2], rect[1] + rect[3]), (0, 0, 255), 2)
+            if annotate:
+                # 最大の領域の長方形を表示する
+                cv2.rectangle(frame, (rect[0], rect[1]), (rect[0] + rect[2], rect[1] + rect[3]), (0, 0, 255), 2)
 
-            # 最大の領域の中心座標を表示する
-            cv2.circle(frame, (center_x, center_y), 5, (0, 255, 0), -1)
+                # 最大の領域の中心座標を表示する
+                cv2.circle(frame, (center_x, center_y), 5, (0, 255, 0), -1)
 
-            # 最大の領域の面積を表示する
-            cv2.putText(frame, str(area), (rect[0], rect[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 1)
+                # 最大の領域の面積を表示する
+                cv2.putText(frame, str(area), (rect[0], rect[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 1)
 
-            # cv2.putText(frame, str(center_x), (center_x, center_y - 20), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 1)
+                # cv2.putText(frame, str(center_x), (center_x, center_y - 20), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 1)
 
 
-            frame_center_x = frame.shape[1] // 2
-            csv.print('camera_frame_size_x', frame.shape[1])
+            self._logger.debug("camera_frame_size_x: %d", self._size[0])
 
-            # 中心座標のx座標が画像の中心より大きいか小さいか判定
-            if area > 7000:
-                print("Close enough to red")
-                csv.print('camera_order', 'close')
-                camera_order = 4
-
-            elif area > 10:
-                if frame_center_x -  50 <= center_x <= frame_center_x + 50:
-                    print("The red object is in the center")#直進
-                    csv.print('camera_order', 'center')
-                    camera_order = 1
-                elif center_x > frame_center_x + 50:
-                    print("The red object is in the right")#右へ
-                    csv.print('camera_order', 'right')
-                    camera_order = 2
-                elif center_x < frame_center_x - 50:
-                    print("The red object is in the left")#左へ
-                    csv.print('camera_order', 'left')
-                    camera_order = 3
-
-            else:
-                print("The red object is too minimum")
-                csv.print('camera_order', 'not found')
+            # 面積と中心座標のx座標が画像の中心より大きいか小さいかで判定 (しきい値は640x480での値を画像の大きさに合わせる)
+            camera_order = cone_order(center_x, area, *self._size)
+            if not self._headless:
+                print(_ORDER_MESSAGES[camera_order])
+            self._logger.debug("camera_order: %s", _ORDER_NAMES[camera_order])
 
             # red_result = cv2.drawContours(mask, [biggest_contour], -1, (0, 255, 0), 2)
         
         else:
-            print("The red object is None")
-            csv.print('camera_order', 'none')
+            if not self._headless:
+                print("The red object is None")
+            self._logger.debug("camera_order: none")
             
         # cv2.imshow("Frame", frame)
         # cv2.imshow("Mask", mask)
@@ -110,24 +290,125 @@ class Camera:
         return frame, camera_order
     
     def judge_cone(self, show=False):
-        """コーンの検出と判定"""
-        self._picam2.start()
-        frame = self._picam2.capture_array()
-        mask = self.red_detect(frame)
-        frame, camera_order = self.analyze_red(frame, mask)
-        
-        if show:
+        """コーンの検出と判定 (前回より新しい画像を使う)"""
+        timings = self.timings
+        start = time.perf_counter()
+        self._last_seq, self.last_capture_time, frame = self.get_frame(self._last_seq)
+        timings["capture"] = time.perf_counter() - start
+        timings["segment"] = timings["contour"] = 0.0
+
+        # 明るさが変わっていれば赤色の値域を切り替える (毎フレームではなくprofile_interval秒ごと)
+        if len(self._luts) > 1 and time.monotonic() >= self._next_profile_time:
+            self.update_profile(self.last_metadata)
+            self._next_profile_time = time.monotonic() + self._profile_interval
+
+        # 前の画像でコーンが見つかっていれば，その周りだけを探す
+        roi = self._track_roi()
+        contours = self.find_contours(frame, roi) if roi is not None else ()
+        if roi is not None and any(cv2.contourArea(contour) > 10 for contour in contours):
+            self.roi_hits += 1
+        else:
+            # 見失った(または追跡していない)ので画像全体を探す
+            contours = self.find_contours(frame)
+            self.full_searches += 1
+
+        # 表示するか，プレビューを書き出す番の画像にだけ結果を描き込む (headlessなら描き込みも色の変換もしない)
+        start = time.perf_counter()
+        preview = self._preview is not None and self._preview.due()
+        annotate = (show and not self._headless) or preview
+        if self._format == "YUV420" and annotate:
+            frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+        frame, camera_order = self.analyze_red(frame, contours, annotate)
+        timings["contour"] += time.perf_counter() - start
+
+        if preview:
+            self._preview.submit(frame)
+        if show and not self._headless:
             cv2.imshow("Frame", frame)
             # cv2.imshow("Mask", mask)
             cv2.waitKey(1)
-        
+
         return camera_order
 
-    def get_forever(self, devices, camera_order, show=False):
-        """カメラを起動し、コーンの検出を継続的に行う"""
+    @staticmethod
+    def _record_detection(stream, seq, capture_time, detection, order):
+        """1枚分の認識結果をフライトレコーダーに記録 (見つからなければ中心・外接矩形はNaN，面積は0)"""
+        if detection is None:
+            stream.append(seq, None, None, [None] * 4, 0, order, t=capture_time)
+        else:
+            stream.append(seq, *detection["center"], detection["rect"], detection["area"], order, t=capture_time)
+
+    def get_forever(self, devices, camera_order, show=False, ring=None, recorder=None):
+        """カメラを起動し、コーンの検出を継続的に行う
+
+        ring: DetectionRingを渡すと，1枚ごとの認識結果(中心・外接矩形・面積・撮影時刻)も書き込む
+        recorder: FlightRecorderを渡すと，1枚ごとの認識結果をバイナリでも記録する (このプロセスで作ったものを渡すこと)
+        """
+        stream = recorder.stream("camera") if recorder is not None else None
         devices["servo1"].set_angle(0)
         devices["servo2"].set_angle(0)
+        window_start = time.monotonic()
+        window_frames = 0
+        window_timings = dict.fromkeys(self.timings, 0.0)
         while True:
-            camera_order.value = self.judge_cone(show)
+            try:
+                order = self.judge_cone(show)
+                camera_order.value = order
+                if ring is not None:
+                    ring.write(self._last_seq, self.last_capture_time, self.last_detection, order, self._size)
+                if stream is not None:
+                    self._record_detection(stream, self._last_seq, self.last_capture_time, self.last_detection, order)
+            except Exception as e:
+                self._logger.exception(f"An error occured in judge cone: {e}")
+                continue
+
+            # 1秒ごとに処理できた枚数と各段階の平均処理時間を記録
+            window_frames += 1
+            for stage, elapsed in self.timings.items():
+                window_timings[stage] += elapsed
+            now = time.monotonic()
+            if now - window_start >= 1.0:
+                self.fps = window_frames / (now - window_start)
+                stages = ", ".join(f"{stage}: {total / window_frames * 1e3:.2f} ms" for stage, total in window_timings.items())
+                self._logger.debug("camera fps: %.1f (capture: %.1f), %s, roi hits: %d, full searches: %d",
+                                   self.fps, self.capture_fps, stages, self.roi_hits, self.full_searches)
+                window_start, window_frames = now, 0
+                window_timings = dict.fromkeys(self.timings, 0.0)
             # devices["servo1"].set_angle(-15)
             # devices["servo2"].set_angle(-15)
+
+    def get_forever_parallel(self, devices, camera_order, ring=None, segment_workers=2, contour_workers=1, recorder=None):
+        """赤色の抽出と輪郭の検出を別々のプロセスで並列に行い，コーンの検出を継続的に行う (detect_pipeline.DetectPipeline)
+
+        1枚あたりの処理が撮影の間隔より長い(解像度が大きい)場合に速くなる．結果を画面に表示する機能はない．
+        """
+        stream = recorder.stream("camera") if recorder is not None else None
+        devices["servo1"].set_angle(0)
+        devices["servo2"].set_angle(0)
+        # プロファイルは起動したときのものを使い続ける
+        pipeline = DetectPipeline(self._size, self._format, self._colour_space, self.profile["hsv_ranges"],
+                                  segment_workers=segment_workers, contour_workers=contour_workers, logger=self._logger)
+        pipeline.start(self.get_frame)
+        window_start = time.monotonic()
+        window_frames = 0
+        window_latency = 0.0
+        for seq, capture_time, detection, order in pipeline.results():
+            try:
+                camera_order.value = order
+                if ring is not None:
+                    ring.write(seq, capture_time, detection, order, self._size)
+                if stream is not None:
+                    self._record_detection(stream, seq, capture_time, detection, order)
+
+                # 1秒ごとに結果の数と撮影からの遅れを記録
+                now = time.monotonic()
+                window_frames += 1
+                window_latency += now - capture_time
+                if now - window_start >= 1.0:
+                    self.fps = window_frames / (now - window_start)
+                    self._logger.debug("camera fps: %.1f (capture: %.1f), latency: %.2f ms, busy dropped: %d, stale dropped: %d",
+                                       self.fps, self.capture_fps, window_latency / window_frames * 1e3,
+                                       pipeline.busy_dropped, pipeline.stale_dropped)
+                    window_start, window_frames, window_latency = now, 0, 0.0
+            except Exception as e:
+                self._logger.exception(f"An error occured in judge cone: {e}")
@@ -0,0 +1,155 @@
+# 色の判定表(LUT)による赤色の抽出
+#
+# 以前のCamera.red_detectは毎回 BGR→HSV変換 + inRange 2回 + マスクの足し算 をしていた．
+# ここでは起動時に「量子化した画素値 → 赤かどうか(255/0)」の表を1回だけ作っておき，
+# 画像認識のときは画素値から表の番号を計算して引くだけにする (HSVの値域がいくつあっても1回で済む)．
+#   - BGR画像用: B, G, R を上位bgr_bitsビットに量子化した表
+#   - YUV画像用: Y を上位y_bitsビット，U, V をそのまま使う表  (YUV420で撮ればBGRやHSVへの変換そのものが要らない)
+# 表はHSVの値域から作るので，しきい値はこれまでと同じHSVで指定する．
+
+import cv2
+import numpy as np
+
+
+# Camera.red_detect で使っていた赤色のHSVの値域 (最小値, 最大値)
+CAMERA_RED_HSV_RANGES = (
+    ((0, 117, 104), (11, 255, 255)),
+    ((169, 117, 104), (179, 255, 255)),
+)
+
+# testcode/camera の検出器(Color_detect.py, Integration_camera.py)の low_color / high_color
+TESTCODE_RED_HSV_RANGES = (
+    ((0, 50, 50), (6, 255, 255)),
+    ((174, 50, 50), (180, 255, 255)),
+)
+
+# YUV → RGB の変換式  (Kr, Kb, 限定範囲(16~235)かどうか)
+# picamera2 の colour_space (libcamera.ColorSpace) の名前で選ぶ
+_YUV_MATRICES = {
+    "sycc": (0.299, 0.114, False),  # JPEG と同じ BT.601 フルレンジ (cv2.COLOR_YUV2BGR と同じ)
+    "smpte170m": (0.299, 0.114, True),  # BT.601 限定範囲
+    "rec709": (0.2126, 0.0722, True),  # BT.709 限定範囲
+}
+
+
+def _hsv_mask(bgr, hsv_ranges):
+    """BGR画像(N, 1, 3)のうち，いずれかのHSVの値域に入る画素を255にしたマスクを返す"""
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+    mask = np.zeros(bgr.shape[:2], np.uint8)
+    for low, high in hsv_ranges:
+        mask |= cv2.inRange(hsv, np.array(low), np.array(high))
+    return mask
+
+
+def yuv_to_bgr(y, u, v, colour_space="sycc"):
+    """Y, U, V (uint8の配列) をBGR画像(uint8)に変換する"""
+    kr, kb, limited = _YUV_MATRICES[colour_space.lower()]
+    kg = 1 - kr - kb
+    y = np.asarray(y, np.float32)
+    u = np.asarray(u, np.float32) - 128
+    v = np.asarray(v, np.float32) - 128
+    if limited:
+        y = (y - 16) * (255 / 219)
+        u = u * (255 / 224)
+        v = v * (255 / 224)
+    r = y + 2 * (1 - kr) * v
+    b = y + 2 * (1 - kb) * u
+    g = (y - kr * r - kb * b) / kg
+    bgr = np.stack([b, g, r], axis=-1)
+    return np.clip(np.rint(bgr), 0, 255).astype(np.uint8)
+
+
+class RedLUT:
+    """HSVの値域から作った赤色の判定表
+
+    bgr(frame): BGR画像 → マスク
+    yuv420(frame, width, height): picamera2のYUV420画像 → 縦横1/2のマスク
+    表は初めて使うときに作る (BGR用は2^(3*bgr_bits)バイト，YUV用は2^(y_bits+16)バイト)
+    """
+    def __init__(self, hsv_ranges=CAMERA_RED_HSV_RANGES, bgr_bits=6, y_bits=5, colour_space="sycc"):
+        self.hsv_ranges = tuple(hsv_ranges)
+        self._bgr_bits = bgr_bits
+        self._y_bits = y_bits
+        self._colour_space = colour_space
+        self._bgr_lut = None
+        self._yuv_lut = None
+
+    # ---------- 表の作成 ----------
+    def build_bgr_lut(self):
+        """量子化したBGRの各区間の中央の色で判定した表を作る"""
+        bits = self._bgr_bits
+        levels = (np.arange(1 << bits) << (8 - bits)) + (1 << (7 - bits))  # 区間の中央の値
+        b, g, r = np.meshgrid(levels, levels, levels, indexing="ij")
+        bgr = np.stack([b, g, r], axis=-1).reshape(-1, 1, 3).astype(np.uint8)
+        self._bgr_lut = _hsv_mask(bgr, self.hsv_ranges).ravel()
+        return self._bgr_lut
+
+    def build_yuv_lut(self):
+        """量子化したYと全てのU, Vの組み合わせで判定した表を作る"""
+        bits = self._y_bits
+        y_levels = (np.arange(1 << bits) << (8 - bits)) + (1 << (7 - bits))
+        y, u, v = np.meshgrid(y_levels, np.arange(256), np.arange(256), indexing="ij")
+        bgr = yuv_to_bgr(y, u, v, self._colour_space).reshape(-1, 1, 3)
+        self._yuv_lut = _hsv_mask(bgr, self.hsv_ranges).ravel()
+        return self._yuv_lut
+
+    # ---------- 判定 ----------
+    def bgr(self, frame):
+        """BGR画像(H, W, 3)の赤色のマスク(H, W)を返す"""
+        lut = self._bgr_lut if self._bgr_lut is not None else self.build_bgr_lut()
+        bits = self._bgr_bits
+        shift = 8 - bits
+        b, g, r = cv2.split(frame)
+        index = np.left_shift(b >> shift, 2 * bits, dtype=np.uint32)
+        index |= np.left_shift(g >> shift, bits, dtype=np.uint32)
+        index |= r >> shift
+        return np.take(lut, index)
+
+    def yuv(self, y, u, v):
+        """同じ大きさのY, U, V平面から赤色のマスクを返す"""
+        lut = self._yuv_lut if self._yuv_lut is not None else self.build_yuv_lut()
+        index = np.left_shift(y >> (8 - self._y_bits), 16, dtype=np.uint32)
+        index |= np.left_shift(u, 8, dtype=np.uint32)
+        index |= v
+        return np.take(lut, index)
+
+    def yuv420(self, frame, width, height):
+        """picamera2のYUV420画像(高さ×1.5, 幅)の赤色のマスクを，U, Vと同じ縦横1/2の大きさで返す"""
+        y, u, v = split_yuv420(frame, width, height)
+        return self.yuv(y[::2, ::2], u, v)
+
+
+def split_yuv420(frame, width, height):
+    """YUV420(I420)の画像をY平面と縦横1/2のU, V平面に分ける (コピーしない)"""
+    quarter = (height // 2) * (width // 2)
+    chroma = frame[height:height + height // 2].reshape(-1)
+    u = chroma[:quarter].reshape(height // 2, width // 2)
+    v = chroma[quarter:2 * quarter].reshape(height // 2, width // 2)
+    return frame[:height], u, v
+
+
+if __name__ == "__main__":
+    # 以前のHSV変換+inRangeとの一致率と速さを確認する
+    import sys
+    import time
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "../testcode/camera/cone_1.jpg"
+    img = cv2.resize(cv2.imread(path), (320, 240))
+    lut = RedLUT(colour_space="smpte170m")  # cv2.COLOR_BGR2YUV_I420 は BT.601 限定範囲
+
+    def hsv_detect(frame):
+        return _hsv_mask(frame, CAMERA_RED_HSV_RANGES)
+
+    yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+    reference = hsv_detect(img)
+    reference_half = reference[::2, ::2]
+    print(f"bgr lut agreement: {np.mean(lut.bgr(img) == reference) * 100:.2f} %")
+    print(f"yuv lut agreement: {np.mean(lut.yuv420(yuv, 320, 240) == reference_half) * 100:.2f} % (1/2 size)")
+
+    for name, func, arg in (("hsv + inRange", hsv_detect, img),
+                            ("bgr lut", lut.bgr, img),
+                            ("yuv420 lut", lambda f: lut.yuv420(f, 320, 240), yuv)):
+        start = time.perf_counter()
+        for _ in range(500):
+            func(arg)
+        print(f"{name}: {(time.perf_counter() - start) / 500 * 1e3:.3f} ms/frame")
@@ -0,0 +1,266 @@
+# 複数のプロセスでコーンの検出を流れ作業にする
+#
+# Camera.get_foreverは 撮影 → 赤色の抽出 → 輪郭の検出 を1つのスレッドで順番に行うため，Piの4コアのうち1コアしか使っていなかった．
+# ここでは各段階を別々の作業者に分け，共有メモリの画像スロットを受け渡して並列に処理する．
+#   撮影(スレッド) → 赤色の抽出(プロセス×segment_workers) → 輪郭の検出(プロセス×contour_workers) → 結果(スレッド)
+# キューで受け渡すのはスロットの番号と撮影時刻だけで，画像そのものは共有メモリ(RawArray)に置いたままにする．
+# 結果は画像の通し番号(seq)の順に出す．先に新しい画像の結果が出た場合はそれをすぐに出し，後から届いた古い画像の結果は捨てる
+# (古い結果を待たないので，最新の結果までの遅れは1枚ずつ処理する場合と変わらない)．
+# また，既に新しい画像の結果が出ている画像や，後ろに新しい画像が作業者の数以上待っている画像は，途中の段階でも処理せずに捨てる
+# (キューで待つ間に古くなった画像を処理して，最新の結果が遅れないようにする)．
+
+from logging import getLogger, StreamHandler
+from multiprocessing import Process, Queue, RawArray, RawValue, Value
+from queue import Empty
+from threading import Thread
+import time
+
+import cv2
+import numpy as np
+
+from color_lut import CAMERA_RED_HSV_RANGES, RedLUT
+from detection_ring import cone_order
+
+
+def _frame_shape(size, format):
+    width, height = size
+    if format == "YUV420":
+        return (height * 3 // 2, width)
+    return (height, width, 3)
+
+
+def _slot_view(buffer, slot, shape):
+    """共有メモリのslot番目の領域をnumpyの配列として見る (コピーしない)"""
+    length = int(np.prod(shape))
+    return np.frombuffer(buffer, np.uint8, length, slot * length).reshape(shape)
+
+
+def _drop(dropped):
+    with dropped.get_lock():
+        dropped.value += 1
+
+
+def _segment_worker(frames, masks, size, format, colour_space, hsv_ranges, in_queue, out_queue, free_queue, newest,
+                    captured, workers, dropped):
+    """赤色の抽出: スロットの画像から赤色のマスクを作り，同じスロットのマスクに書き込む"""
+    width, height = size
+    frame_shape = _frame_shape(size, format)
+    lut = RedLUT(hsv_ranges, colour_space=colour_space)
+    if format == "YUV420":
+        lut.build_yuv_lut()
+    else:
+        lut.build_bgr_lut()
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        slot, seq, capture_time = item
+        # 既に新しい画像の結果が出ている，または新しい画像だけで全ての作業者が埋まる
+        if seq <= newest.value or seq <= captured.value - workers:
+            free_queue.put(slot)
+            _drop(dropped)
+            continue
+        frame = _slot_view(frames, slot, frame_shape)
+        mask = _slot_view(masks, slot, (height, width))
+        if format == "YUV420":
+            mask[:] = cv2.resize(lut.yuv420(frame, width, height), (width, height), interpolation=cv2.INTER_NEAREST)
+        else:
+            mask[:] = lut.bgr(frame)
+        out_queue.put(item)
+
+
+def _contour_worker(masks, size, in_queue, result_queue, free_queue, newest, dropped):
+    """輪郭の検出: マスクの最大の赤い領域を探し，(seq, 撮影時刻, 結果, camera_order) を結果のキューに入れる"""
+    width, height = size
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        slot, seq, capture_time = item
+        if seq <= newest.value:
+            free_queue.put(slot)
+            _drop(dropped)
+            continue
+        mask = _slot_view(masks, slot, (height, width))
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        free_queue.put(slot)  # 輪郭はコピーなので，ここでスロットを返してよい
+
+        detection = None
+        order = 0
+        if contours:
+            biggest_contour = max(contours, key=cv2.contourArea)
+            rect = cv2.boundingRect(biggest_contour)
+            area = cv2.contourArea(biggest_contour)
+            center = (rect[0] + rect[2] // 2, rect[1] + rect[3] // 2)
+            order = cone_order(center[0], area, width, height)
+            if area > 10:
+                detection = {"center": center, "rect": rect, "area": area}
+        result_queue.put((seq, capture_time, detection, order))
+
+
+class DetectPipeline:
+    """撮影・赤色の抽出・輪郭の検出を別々の作業者で並列に行う検出器"""
+    def __init__(self, size=(320, 240), format="RGB888", colour_space="smpte170m", hsv_ranges=CAMERA_RED_HSV_RANGES,
+                 segment_workers=2, contour_workers=1, slots=None, logger=None):
+        """
+        size, format: Cameraと同じ画像の大きさと形式
+        hsv_ranges: 赤色のHSVの値域 (作業者を起動した後は変えられない)
+        segment_workers: 赤色の抽出を行うプロセスの数
+        contour_workers: 輪郭の検出を行うプロセスの数
+        slots: 共有メモリの画像スロットの数 (同時に処理中にできる画像の数)  省略すると作業者の数+1
+        """
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)  # DEBUGレベル
+        self._logger = logger
+
+        self._size = size
+        self._format = format
+        self._frame_shape = _frame_shape(size, format)
+        if slots is None:
+            slots = segment_workers + contour_workers + 1
+        self._slots = slots
+
+        # 画像とマスクのスロット (プロセスを作る前に確保して共有する)
+        width, height = size
+        self._frames = RawArray('B', slots * int(np.prod(self._frame_shape)))
+        self._masks = RawArray('B', slots * width * height)
+
+        self._free_queue = Queue()
+        for slot in range(slots):
+            self._free_queue.put(slot)
+        self._segment_queue = Queue()
+        self._contour_queue = Queue()
+        self._result_queue = Queue()
+        self._newest = RawValue('q', 0)  # 結果を出した最新の画像のseq
+        self._captured = RawValue('q', 0)  # 赤色の抽出に渡した最新の画像のseq
+        self._stale = Value('q', 0)  # 途中で捨てた古い画像の数
+
+        self._workers = (
+            [Process(target=_segment_worker, daemon=True,
+                     args=(self._frames, self._masks, size, format, colour_space, hsv_ranges, self._segment_queue,
+                           self._contour_queue, self._free_queue, self._newest, self._captured, segment_workers,
+                           self._stale))
+             for _ in range(segment_workers)]
+            + [Process(target=_contour_worker, daemon=True,
+                       args=(self._masks, size, self._contour_queue, self._result_queue, self._free_queue,
+                             self._newest, self._stale))
+               for _ in range(contour_workers)]
+        )
+        self._segment_workers = segment_workers
+        self._contour_workers = contour_workers
+
+        self.captured = 0  # 撮影スレッドが受け取った画像の数
+        self.busy_dropped = 0  # 空いているスロットがなく処理しなかった画像の数
+        self.emitted = 0  # 結果を出した画像の数
+        self._running = False
+
+    @property
+    def stale_dropped(self):
+        """新しい画像の結果が先に出たため，途中で捨てた・結果を捨てた画像の数"""
+        return self._stale.value
+
+    def start(self, get_frame):
+        """作業者のプロセスと撮影スレッドを起動する
+
+        get_frame(last_seq): last_seqより新しい画像の (seq, 撮影時刻, 画像) を返す関数 (Camera.get_frame)
+        """
+        for worker in self._workers:
+            worker.start()
+        self._running = True
+        self._capture_thread = Thread(target=self._capture_forever, args=(get_frame,), daemon=True)
+        self._capture_thread.start()
+
+    def _capture_forever(self, get_frame):
+        """撮影: 新しい画像を空いているスロットにコピーして，赤色の抽出に渡す"""
+        last_seq = 0
+        while self._running:
+            try:
+                seq, capture_time, frame = get_frame(last_seq)
+                last_seq = seq
+                self.captured += 1
+                try:
+                    slot = self._free_queue.get_nowait()
+                except Empty:
+                    self.busy_dropped += 1  # 全ての作業者が処理中なのでこの画像は飛ばす
+                    continue
+                np.copyto(_slot_view(self._frames, slot, self._frame_shape), frame.reshape(self._frame_shape))
+                self._captured.value = seq
+                self._segment_queue.put((slot, seq, capture_time))
+            except Exception as e:
+                self._logger.exception(f"An error occured in detect pipeline capture: {e}")
+                time.sleep(0.1)
+
+    def results(self, timeout=None):
+        """結果を (seq, 撮影時刻, 結果, camera_order) としてseqの順に返し続ける
+
+        結果は {"center": (x, y), "rect": (x, y, w, h), "area": 面積} (見つからなければNone)
+        """
+        while True:
+            try:
+                seq, capture_time, detection, order = self._result_queue.get(timeout=timeout)
+            except Empty:
+                return
+            if seq <= self._newest.value:
+                _drop(self._stale)  # 新しい画像の結果を先に出したので捨てる
+                continue
+            self._newest.value = seq
+            self.emitted += 1
+            yield seq, capture_time, detection, order
+
+    def stop(self):
+        """撮影スレッドと作業者のプロセスを止める"""
+        self._running = False
+        self._capture_thread.join(timeout=1.0)
+        for _ in range(self._segment_workers):
+            self._segment_queue.put(None)
+        for _ in range(self._contour_workers):
+            self._contour_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1.0)
+
+
+if __name__ == "__main__":
+    # 1スレッドで順番に処理する場合と，作業者の数を変えた場合の 1秒あたりの結果の数 と 撮影からの遅れ を比べる
+    import sys
+
+    size = (640, 480) if len(sys.argv) < 2 else tuple(int(v) for v in sys.argv[1].split("x"))
+    fps = 120 if len(sys.argv) < 3 else float(sys.argv[2])  # カメラの代わりに画像を出す速さ
+    frame = cv2.resize(cv2.imread("../testcode/camera/cone_1.jpg"), size)
+
+    def make_source():
+        start = time.monotonic()
+
+        def source(last_seq):
+            seq = last_seq + 1
+            time.sleep(max(start + seq / fps - time.monotonic(), 0))
+            return seq, time.monotonic(), frame
+        return source
+
+    # 1スレッドで順番に処理 (Camera.get_foreverと同じ)
+    lut = RedLUT()
+    source = make_source()
+    seq, count, latencies = 0, 0, []
+    start = time.monotonic()
+    while time.monotonic() - start < 3:
+        seq, capture_time, image = source(seq)
+        contours, _ = cv2.findContours(lut.bgr(image), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        max(contours, key=cv2.contourArea)
+        latencies.append(time.monotonic() - capture_time)
+        count += 1
+    print(f"single thread: {count / (time.monotonic() - start):.1f} results/s, latency {np.mean(latencies) * 1e3:.2f} ms")
+
+    for segment_workers, contour_workers in ((1, 1), (2, 1), (3, 1)):
+        pipeline = DetectPipeline(size, segment_workers=segment_workers, contour_workers=contour_workers)
+        pipeline.start(make_source())
+        latencies = []
+        start = time.monotonic()
+        for seq, capture_time, detection, order in pipeline.results(timeout=1.0):
+            latencies.append(time.monotonic() - capture_time)
+            if time.monotonic() - start > 3:
+                break
+        elapsed = time.monotonic() - start
+        print(f"workers {segment_workers}+{contour_workers}: {pipeline.emitted / elapsed:.1f} results/s, "
+              f"latency {np.mean(latencies) * 1e3:.2f} ms, busy dropped {pipeline.busy_dropped}, stale {pipeline.stale_dropped}")
+        pipeline.stop()
@@ -0,0 +1,123 @@
+# カメラのプロセスから画像認識の結果を渡すための共有メモリのリングバッファ
+#
+# 以前はカメラのプロセスから camera_order (Value('i')) の1つの整数しか渡しておらず，
+# analyze_redで求めたコーンの中心・外接矩形・面積や，画像を撮影した時刻は捨てていた．
+# ここでは固定長のレコードを共有メモリ(RawArray)に並べ，スロットごとのシーケンス番号(seqlock)で一貫性を確かめる．
+#   - 書き込み側(カメラのプロセス): seqを奇数にする → 値を書く → seqを偶数に戻す → 最新の番号を更新
+#   - 読み込み側(short_phase): 最新のスロットをコピーし，コピー前後でseqが同じ偶数ならその値を使う
+# pickleやパイプを使わないので，読み書きとも数μsで終わる．
+# 撮影時刻はtime.monotonic()  (Linuxではプロセスが違っても同じ時計)
+
+from multiprocessing import RawArray, RawValue
+import math
+import time
+
+
+# レコードの項目 (この順に並ぶ)
+FIELDS = (
+    "seq",  # 画像の通し番号
+    "capture_time",  # 撮影した時刻 (time.monotonic())
+    "center_x", "center_y",  # 最大の赤い領域の外接矩形の中心[px]
+    "x", "y", "w", "h",  # 外接矩形[px]
+    "area",  # 面積[px]
+    "confidence",  # 外接矩形のうち赤い領域が占める割合 (0~1)  見つからなければ0
+    "order",  # camera_order と同じ値 (0: なし, 1: 正面, 2: 右, 3: 左, 4: 十分近い)
+    "frame_width", "frame_height",  # 画像の大きさ[px]
+)
+_RECORD = len(FIELDS)
+_INDEX = {name: i for i, name in enumerate(FIELDS)}
+_NAN = float("nan")
+
+
+class DetectionRing:
+    """画像認識の結果のリングバッファ (プロセスを作る前に作って，両方のプロセスに渡す)"""
+    def __init__(self, slots=8):
+        self._slots = slots
+        self._records = RawArray('d', slots * _RECORD)
+        self._slot_seq = RawArray('q', slots)  # スロットごとのseq (奇数: 書き込み中)
+        self._head = RawValue('q', 0)  # 書き込んだレコードの数 (最新のレコードは (head - 1) % slots)
+
+    def write(self, seq, capture_time, detection, order, frame_size):
+        """1枚分の結果を書き込む (書き込み側は1つのプロセス・スレッドだけにすること)
+
+        detection: {"center": (x, y), "rect": (x, y, w, h), "area": 面積} (見つからなければNone)
+        """
+        if detection is not None:
+            (center_x, center_y), rect, area = detection["center"], detection["rect"], detection["area"]
+            confidence = min(area / max(rect[2] * rect[3], 1), 1.0)
+        else:
+            center_x = center_y = _NAN
+            rect = (_NAN,) * 4
+            area = confidence = 0.0
+        values = (seq, capture_time, center_x, center_y, *rect, area, confidence, order, *frame_size)
+
+        head = self._head.value
+        slot = head % self._slots
+        start = slot * _RECORD
+        self._slot_seq[slot] += 1  # 奇数: 書き込み中
+        self._records[start:start + _RECORD] = values
+        self._slot_seq[slot] += 1  # 偶数: 書き込み完了
+        self._head.value = head + 1
+
+    def _read_slot(self, slot):
+        start = slot * _RECORD
+        while True:
+            seq_before = self._slot_seq[slot]
+            values = self._records[start:start + _RECORD]
+            if seq_before == self._slot_seq[slot] and not seq_before & 1:
+                return dict(zip(FIELDS, values))
+            time.sleep(0)  # 書き込み側に処理を譲る
+
+    @property
+    def count(self):
+        """これまでに書き込まれたレコードの数"""
+        return self._head.value
+
+    def latest(self, max_age=None):
+        """最新の結果をdictで返す (まだない，またはmax_age秒より古ければNone)
+
+        dictには FIELDS の項目と，撮影してからの経過時間 age[s] が入る
+        """
+        head = self._head.value
+        if head == 0:
+            return None
+        record = self._read_slot((head - 1) % self._slots)
+        record["age"] = time.monotonic() - record["capture_time"]
+        if max_age is not None and record["age"] > max_age:
+            return None
+        return record
+
+    def recent(self, n=None):
+        """新しい順に最大n個(省略すると全スロット)の結果を返す"""
+        head = self._head.value
+        n = min(head, self._slots if n is None else n, self._slots)
+        return [self._read_slot((head - 1 - i) % self._slots) for i in range(n)]
+
+
+def cone_order(center_x, area, frame_width, frame_height, close_area=7000, min_area=10, center_band=50,
+               reference_size=(640, 480)):
+    """コーンの中心と面積から camera_order を決める (0: なし, 1: 正面, 2: 右, 3: 左, 4: 十分近い)
+
+    close_area, min_area[px²] と center_band[px] は reference_size (幅, 高さ) の画像での値で，
+    実際の画像の大きさに合わせて面積は画素数の比，center_bandは幅の比で変換する (解像度を変えても判定が変わらないように)
+    """
+    area_scale = frame_width * frame_height / (reference_size[0] * reference_size[1])
+    if area > close_area * area_scale:
+        return 4
+    if area <= min_area * area_scale:
+        return 0
+    frame_center_x = frame_width // 2
+    band = center_band * frame_width / reference_size[0]
+    if center_x > frame_center_x + band:
+        return 2
+    if center_x < frame_center_x - band:
+        return 3
+    return 1
+
+
+def offset_x(record):
+    """コーンの中心が画像の中心からどれだけ横にずれているか (-1: 左端 ~ 1: 右端)  見つかっていなければNone"""
+    if record is None or record["area"] <= 0 or math.isnan(record["center_x"]):
+        return None
+    half = record["frame_width"] / 2
+    return (record["center_x"] - half) / half
@@ -0,0 +1,217 @@
+# 飛行中のセンサーの値をバイナリで記録するフライトレコーダー
+#
+# これまでセンサーの値はログのメッセージ(文字列)としてしか残らず，RotatingFileHandlerの100kBで上書きされて
+# 飛行のほとんどの間の値が失われていた．ここでは，センサーごとの「ストリーム」に固定長のレコードを追記する．
+#   - レコード: 時刻 t (time.monotonic()) と，ストリームごとに決めた数値の項目 (numpyの構造化配列の1行)
+#   - セグメント: name.000000.bin, name.000001.bin, ... の順に作るファイル
+#     先頭の HEADER_SIZE バイトはJSONのヘッダ(項目の型・作成時刻)で，その後ろにレコードが並ぶ
+#     ファイルは作るときに全体の大きさを確保(fallocate)し，メモリマップして書き込むので，1レコードの追記はメモリへの代入だけで終わる
+#   - 書き込んだ内容は別スレッドで flush_interval 秒ごとにディスクへ書き出す(msync)
+#     電源が落ちても，最後に書き出したところまでは残る (tが0の行は未書き込みとして読み込み時に捨てる)
+#   - 再起動して同じフォルダで記録を始めると，既存のセグメントの後ろに新しいセグメントを作る (上書きしない)
+# 飛行後は load_flight(フォルダ) でストリームごとのnumpyの配列として一度に読み込める．
+#
+# 確認用:  python flight_recorder.py フォルダ  でストリームごとのレコードの数と時間を表示する
+
+from logging import getLogger, StreamHandler
+from threading import Event, Lock, Thread
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+
+HEADER_SIZE = 4096  # ヘッダの大きさ (レコードの先頭をページの境界に揃える)
+
+# ストリームの項目 (名前, 型, 要素数)  時刻 t は自動で先頭に付く
+STREAMS = {
+    "bmp": (("temp", "f4", 1), ("press", "f4", 1), ("alt", "f4", 1)),
+    "bno": (("mag", "f4", 3), ("gyro", "f4", 3), ("accel", "f4", 3), ("line_accel", "f4", 3), ("grav", "f4", 3),
+            ("euler", "f4", 3)),
+    "gnss": (("receiver", "i1", 1),  # 0: 全受信機をまとめた値, 1~: 受信機の番号
+             ("lat", "f8", 1), ("lon", "f8", 1)),
+    "camera": (("seq", "i8", 1), ("center_x", "f4", 1), ("center_y", "f4", 1), ("rect", "f4", 4), ("area", "f4", 1),
+               ("order", "i1", 1)),
+    "motor": (("right", "f4", 1), ("left", "f4", 1)),
+}
+
+
+def _dtype(fields):
+    return np.dtype([("t", "f8")] + [(name, kind, (count,)) if count > 1 else (name, kind)
+                                     for name, kind, count in fields])
+
+
+def _segment_path(directory, name, index):
+    return os.path.join(directory, f"{name}.{index:06d}.bin")
+
+
+def _segments(directory, name=None):
+    """フォルダにあるセグメントを {ストリーム名: [(番号, パス)]} で返す (番号の順)"""
+    found = {}
+    if not os.path.isdir(directory):
+        return found
+    for file_name in os.listdir(directory):
+        match = re.fullmatch(r"(.+)\.(\d{6})\.bin", file_name)
+        if match and (name is None or match.group(1) == name):
+            found.setdefault(match.group(1), []).append((int(match.group(2)), os.path.join(directory, file_name)))
+    return {key: sorted(value) for key, value in found.items()}
+
+
+class Stream:
+    """1つのセンサーのレコードを追記するストリーム (FlightRecorder.stream で作る)"""
+    def __init__(self, directory, name, fields, segment_bytes):
+        self.name = name
+        self.dtype = _dtype(fields)
+        self._directory = directory
+        self._fields = [list(field) for field in fields]
+        self._records = max((segment_bytes - HEADER_SIZE) // self.dtype.itemsize, 1)  # 1セグメントのレコードの数
+        existing = _segments(directory, name).get(name, [])
+        self._segment = existing[-1][0] + 1 if existing else 0
+        self._lock = Lock()
+        self._next = None  # 先に作っておいた次のセグメント
+        self._map = self._open(self._segment)
+        self._index = 0  # 今のセグメントで次に書き込む行
+        self.count = 0  # 書き込んだレコードの数
+
+    def _open(self, index):
+        """セグメントのファイルを作り，全体を確保してメモリマップする"""
+        path = _segment_path(self._directory, self.name, index)
+        header = json.dumps({
+            "name": self.name,
+            "segment": index,
+            "fields": self._fields,
+            "records": self._records,
+            "created": time.time(),  # 作成時の時刻 (monotonicの t を時刻に直すのに使う)
+            "monotonic": time.monotonic(),
+        }).encode()
+        size = HEADER_SIZE + self._records * self.dtype.itemsize
+        with open(path, "wb") as f:
+            f.write(header.ljust(HEADER_SIZE, b" "))
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)  # 書き込み中に容量不足にならないよう先に確保
+            except OSError:
+                f.truncate(size)  # fallocateに対応していないファイルシステム
+        return np.memmap(path, self.dtype, "r+", offset=HEADER_SIZE, shape=(self._records,))
+
+    def append(self, *values, t=None):
+        """レコードを1つ追記する (valuesはSTREAMSの項目の順，tを省略すると今の時刻)"""
+        with self._lock:
+            if self._index == self._records:
+                self._roll()
+            self._map[self._index] = (time.monotonic() if t is None else t, *values)
+            self._index += 1
+            self.count += 1
+
+    def _roll(self):
+        self._map.flush()
+        self._segment += 1
+        if self._next is None:
+            self._next = self._open(self._segment)
+        self._map, self._next = self._next, None
+        self._index = 0
+
+    def flush(self):
+        """書き込んだ内容をディスクに書き出し，セグメントが半分を超えていれば次のセグメントを作っておく"""
+        self._map.flush()
+        with self._lock:
+            prepare = self._next is None and self._index > self._records // 2
+            segment = self._segment + 1
+        if prepare:
+            next_map = self._open(segment)  # ファイルを作るのに時間がかかるので，ロックの外で作る
+            with self._lock:
+                if self._segment + 1 == segment:
+                    self._next = next_map
+
+
+class FlightRecorder:
+    """センサーごとのストリームを管理し，定期的にディスクへ書き出す"""
+    def __init__(self, directory="flight_record", segment_bytes=4 * 1024 * 1024, flush_interval=1.0, logger=None):
+        """
+        directory: セグメントを置くフォルダ
+        segment_bytes: 1つのセグメントのファイルの大きさ
+        flush_interval: ディスクへ書き出す間隔[s]
+        """
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)  # DEBUGレベル
+        self._logger = logger
+
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._flush_interval = flush_interval
+        self._streams = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._flush_forever, daemon=True)
+        self._thread.start()
+
+    def stream(self, name, fields=None):
+        """名前がnameのストリームを返す (なければ作る)  fieldsを省略するとSTREAMSの項目を使う"""
+        with self._lock:
+            if name not in self._streams:
+                self._streams[name] = Stream(self._directory, name, STREAMS[name] if fields is None else fields,
+                                             self._segment_bytes)
+            return self._streams[name]
+
+    def flush(self):
+        """全てのストリームをディスクに書き出す"""
+        for stream in list(self._streams.values()):
+            try:
+                stream.flush()
+            except Exception as e:
+                self._logger.exception(f"An error occured in flight recorder flush {stream.name}: {e}")
+
+    def _flush_forever(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def close(self):
+        """書き出しのスレッドを止め，最後に全て書き出す"""
+        self._stop.set()
+        self._thread.join(timeout=self._flush_interval + 1.0)
+        self.flush()
+
+
+def _read_segment(path):
+    with open(path, "rb") as f:
+        header = json.loads(f.read(HEADER_SIZE))
+    records = np.fromfile(path, _dtype(header["fields"]), offset=HEADER_SIZE)
+    return header, records[records["t"] != 0]  # tが0の行はまだ書き込んでいない(または書き出す前に電源が落ちた)
+
+
+def load_flight(directory, with_wall_time=False):
+    """フォルダの全てのセグメントを読み込み，{ストリーム名: レコードの配列} を返す
+
+    配列はセグメントの順につないだもので，arr["t"], arr["mag"] のように項目ごとに取り出せる
+    with_wall_time: Trueなら {ストリーム名: (レコードの配列, 時刻(UNIX時間)の配列)} を返す
+                    (tは起動ごとに0から数え直すので，再起動をまたいで比べるときに使う)
+    """
+    flight = {}
+    for name, segments in _segments(directory).items():
+        arrays, wall_times = [], []
+        for _, path in segments:
+            header, records = _read_segment(path)
+            arrays.append(records)
+            wall_times.append(records["t"] - header["monotonic"] + header["created"])
+        records = np.concatenate(arrays) if arrays else np.empty(0)
+        flight[name] = (records, np.concatenate(wall_times)) if with_wall_time else records
+    return flight
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: python flight_recorder.py フォルダ")
+        sys.exit(1)
+    for name, (records, wall_times) in sorted(load_flight(sys.argv[1], with_wall_time=True).items()):
+        if len(records) == 0:
+            print(f"{name}: 0 records")
+            continue
+        duration = wall_times[-1] - wall_times[0]
+        print(f"{name}: {len(records)} records, {duration:.1f} s, "
+              f"{len(records) / duration if duration > 0 else 0:.1f} records/s, fields {records.dtype.names}")
@@ -1,5 +1,5 @@
-import copy
 import os
+from logging import getLogger
 from threading import Thread
 from multiprocessing import Process, Value
 import time
@@ -9,23 +9,45 @@ import pigpio
 from bmp280 import BMP280
 from bno055 import BNO055
 from camera import Camera
+from detection_ring import DetectionRing, offset_x
+from flight_recorder import FlightRecorder
 from gnss import GNSS
+from gnss_pipeline import GNSSPipeline
 from gnss_soft import GNSS_Soft
 from sg90 import SG90
 import sc_logging
 from motor import Motor
+from navigation import Navigator
+from phase import Phase, PhaseMachine, Transition
+from scheduler import SensorScheduler
+from telemetry import Telemetry
 # from speaker import Speaker
 import shutil
 
-logger = sc_logging.get_logger(__name__)
+# ログの記録先(ファイルのハンドラ)は import したときではなく，実行したとき(__main__)に設定する
+logger = getLogger(__name__)
 
 NICR_PIN = 6  # ニクロム線のGPIO番号
 
 GOAL_LAT = 40.1426274282454  # ゴールの緯度(2025/03/08/08:27)
 GOAL_LON = 139.987655687316  # ゴールの経度(2025/03/08/08:27)
 
+# 赤色の抽出を並列に行うプロセスの数 (0なら1スレッドで順番に処理)
+# 320x240では1枚の処理が1ms未満で並列にしても速くならないので，解像度を上げたときだけ2~3にする
+CAMERA_SEGMENT_WORKERS = 0
+
+# 明るさごとの赤色の値域 (hsv_profile.py で校正して作る)  ファイルがなければ決め打ちの値域を使う
+HSV_PROFILES = "hsv_profiles.json"
+
+# I2Cバス1のセンサーを読み込む周期[Hz]と，周期の中で読み込む位置[s] (2つの読み込みが同じ時刻にならないようにずらす)
+BNO_RATE, BNO_OFFSET = 100, 0.0
+BMP_RATE, BMP_OFFSET = 10, 0.005
+
+# センサーの値・認識結果・モーターの指令値をバイナリで記録するフォルダ (再起動しても上書きせずに続きから記録する)
+FLIGHT_RECORD_DIR = "flight_record"
+
 # 各デバイスのセットアップ devices引数の中身を変更します
-def setup(devices):
+def setup(devices, recorder=None):
     try:
         # BMPをセットアップ
         devices["bmp"] = BMP280(logger=logger)
@@ -39,10 +61,17 @@ def setup(devices):
         devices["gnss"] = GNSS(logger=logger)
 
         # GNSS (BE-180) をセットアップ
-        devices["gnss_soft"] = GNSS_Soft(tx_pin=16, rx_pi=26, logger=logger)
+        devices["gnss_soft"] = GNSS_Soft(tx_pin=16, rx_pin=26, logger=logger)
+
+        # 2つのGNSSの測位結果をまとめる
+        # (ゴールの向きはNavigatorがBNO055の更新ごとに計算するので，ここでは計算しない)
+        devices["gnss_pipeline"] = GNSSPipeline([devices["gnss"], devices["gnss_soft"]], update_goal=False, logger=logger)
+
+        # ゴールまでの距離と向きを計算
+        devices["navigator"] = Navigator(heading_source="mag", logger=logger)
 
         # モーターをセットアップ
-        devices["motor"] = Motor(right_pin1=18, right_pin2=12, left_pin1=13, left_pin2=19, logger=logger)
+        devices["motor"] = Motor(right_pin1=18, right_pin2=12, left_pin1=13, left_pin2=19, logger=logger, recorder=recorder)
 
         # サーボモーターのセットアップ
         devices["servo1"] = SG90(pin=20, min_angle=-90, max_angle=90, ini_angle=0, freq=50, logger=logger)
@@ -60,162 +89,174 @@ def setup(devices):
         logger.exception(f"An error occured in setup device: {e}")
 
 # カメラの処理が重いので，カメラだけ完全に分離してセットアップ+撮影
-def camera_setup_and_start(camera_order, show=False):
+def camera_setup_and_start(camera_order, ring=None, show=False):
     try:
-        camera = Camera(logger, show=show, save=True)  # セットアップ
+        camera = Camera(logger, show=show, save=True, profiles=HSV_PROFILES)  # セットアップ
         camera.start()  # 起動
+        # 認識結果はこのプロセスで作ったフライトレコーダーに記録する (親プロセスのものは書き出しのスレッドが引き継がれない)
+        recorder = FlightRecorder(FLIGHT_RECORD_DIR, logger=logger)
         # カメラで画像認識し続ける
-        camera_thread = Thread(target=camera.get_forever, args=(devices, camera_order, show,))
+        if CAMERA_SEGMENT_WORKERS > 0:
+            camera_thread = Thread(target=camera.get_forever_parallel, args=(devices, camera_order, ring, CAMERA_SEGMENT_WORKERS, 1, recorder,))
+        else:
+            camera_thread = Thread(target=camera.get_forever, args=(devices, camera_order, show, ring, recorder,))
         camera_thread.start()
         
     except Exception as e:
         logger.exception(f"An error occured in setup and start camera: {e}")
 
+def _total(vec):
+    """ベクトルの各成分の絶対値の和 (未取得ならNone)"""
+    if vec is None or None in vec:
+        return None
+    return sum(abs(xyz) for xyz in vec)
+
 # 待機フェーズ
 def wait_phase(devices, data):
-    try:
-        logger.info("Entered wait phase")
-        data["phase"] = "wait"
+    """高度が十分高くなったら終了"""
+    def is_high(now):
+        return now["alt"] is not None and 15 < now["alt"]  # ⚠️15mに変更
 
-    except Exception as e:
-        logger.exception(f"An error occured in Entering wait phase:{e}")
-    
-    # 高度が高くなるまで待つ
-    while True:
-        try:
-            time.sleep(0.1)
-            # ここに待機フェーズの処理を書いて
-            # 高度が十分高い場合
-            if 15 < data["alt"]:  # ⚠️15mに変更
-                prev_alt = data["alt"]
-                time.sleep(5)
-                # ある程度時間が経過後も高度が十分高く、かつ少しでも高度が変化している場合、待機フェーズを終了
-                if 15 < data["alt"] and prev_alt != data["alt"]:  # ⚠️15mに変更
-                    print("\n\n")
-                    logger.info("Ended wait phase")
-                    print("\n\n")
-                    # input("Ended wait phase")  # ⚠️後で消す
-                    break
-        except Exception as e:
-            logger.exception(f"An error occured in wait phase:{e}")
+    # ある程度時間が経過後も高度が十分高く、かつ少しでも高度が変化している場合、待機フェーズを終了
+    def still_high_and_changed(start, now):
+        return is_high(now) and start["alt"] != now["alt"]
+
+    # 以前と同じく最初と5秒後だけを確認する (途中で一時的に15m以下になっても数え直さない)
+    return Phase("wait", watch=("alt",), transitions=[
+        Transition("high_altitude", is_high, hold=5, hold_condition=lambda now: True, confirm=still_high_and_changed),
+    ])
 
 # 落下フェーズ
 def fall_phase(devices, data):
-    try:
-        logger.info("Entered fall phase")
-        data["phase"] = "fall"
+    """地面近くで静止したらNiCr線を焼き切って終了"""
+    def on_enter(data):
         # shutil.copy("./phase_pic/camera_fall.jpg", "./camera_fall_temp.jpg")
         # os.rename("./camera_fall_temp.jpg", "camera.jpg")
         # devices["speaker"].audio_play("totsugeki_rappa.wav")
-    except Exception as e:
-        logger.exception(f"An error occured in Entering fall phase: {e}")
-                         
-    # 落下して静止するまで待つ
-    while True:
-        try:
-            time.sleep(0.1)
-            # ここに落下フェーズの処理を書いて
-            # 地面近くで静止している場合
-            if data["alt"] < 5 and sum(abs(line_accel_xyz) for line_accel_xyz in data["line_accel"]) < 0.5 and sum(abs(gyro_xyz) for gyro_xyz in data["gyro"]) < 0.025:
-                prev_line_accel, prev_gyro = copy.copy(data["line_accel"]), copy.copy(data["gyro"])
-                time.sleep(5)
-                # ある程度時間が経過後も地面近くで静止し、かつ少しでも高度が変化している場合、NiCr線を焼き切る
-                if sum(abs(line_accel_xyz) for line_accel_xyz in data["line_accel"]) < 0.6 and sum(abs(gyro_xyz) for gyro_xyz in data["gyro"]) < 0.1 and prev_line_accel != data["line_accel"] and prev_gyro != data["gyro"]:
-                    logger.info("Turn on to cut nicr")
-                    devices["raspi"].write(NICR_PIN, 1) # ⚠️後でオンにする！⚠️NiCr線に電流を流す(ON)
-                    time.sleep(8)
-                    devices["raspi"].write(NICR_PIN, 0) # NiCr線に電流を流すのをストップ(OFF)
-                    logger.info("Turn off nicr")
-                    print("\n\n")
-                    logger.info("Ended fall phase")
-                    print("\n\n")
-                    # input("Ended fall phase")  # ⚠️後で消す
-                    break
-        except Exception as e:
-            logger.exception(f"An error occured in fall phase: {e}")
-            devices["raspi"].write(NICR_PIN, 0)
+        pass
+
+    # 地面近くで静止している場合
+    def is_landed(now):
+        line_accel, gyro = _total(now["line_accel"]), _total(now["gyro"])
+        return now["alt"] is not None and now["alt"] < 5 and line_accel is not None and line_accel < 0.5 and gyro is not None and gyro < 0.025
+
+    # 5秒後は少し緩い条件で判定
+    def is_still(now):
+        line_accel, gyro = _total(now["line_accel"]), _total(now["gyro"])
+        return line_accel is not None and line_accel < 0.6 and gyro is not None and gyro < 0.1
+
+    # 5秒後も静止していて，少しでも値が変化している(センサが止まっていない)場合
+    def still_and_alive(start, now):
+        return is_still(now) and start["line_accel"] != now["line_accel"] and start["gyro"] != now["gyro"]
+
+    def cut_nicr(data, transition):
+        logger.info("Turn on to cut nicr")
+        devices["raspi"].write(NICR_PIN, 1) # ⚠️後でオンにする！⚠️NiCr線に電流を流す(ON)
+        time.sleep(8)
+        devices["raspi"].write(NICR_PIN, 0) # NiCr線に電流を流すのをストップ(OFF)
+        logger.info("Turn off nicr")
+
+    def nicr_off(e):
+        devices["raspi"].write(NICR_PIN, 0)
+
+    return Phase("fall", watch=("alt", "line_accel", "gyro"), transitions=[
+        # 以前と同じく最初と5秒後だけを確認する (途中のノイズで数え直してNiCr線を焼き切るのが遅れないように)
+        Transition("landed", is_landed, hold=5, hold_condition=lambda now: True, confirm=still_and_alive),
+    ], on_enter=on_enter, on_exit=cut_nicr, on_error=nicr_off)
 
 # 遠距離フェーズ
 def long_phase(devices, data):
-    try:
-        logger.info("Entered long phase")
-        data["phase"] = "long"
+    """ゴールに向かって進み，ゴールに近づいたら(またはGPSがタイムアウトしたら)終了"""
+    def on_enter(data):
         # shutil.copy("./phase_pic/camera_long.jpg", "./camera_long_temp.jpg")
         # os.rename("./camera_long_temp.jpg", "camera.jpg")
         # devices["speaker"].audio_play("starwars.wav")
-        long_start_time = time.time()
 
-    except Exception as e:
-        logger.exception(f"An error occured in Entering long phase: {e}")
-
-    # 機体がひっくり返っていたら回る
-    try:
-        # ここに機体の向きを判定する処理を書く
-        if data["grav"][2] < 0:
-            start_time = time.time()
-            devices["motor"].turn(0) # 0度(前進)に向く
-            logger.info("muki_hantai")
-            while data["grav"][2] < 0 and time.time() - start_time < 5:
-                pass
-            devices["motor"].turn(0) # 0度(前進)に向く
-    except Exception as e:
-        logger.exception(f"An error occured in muki_hantai: {e}")
-    
-    # ゴールから離れている間，ゴールに向かって進む
-    while True:
+        # 機体がひっくり返っていたら回る
         try:
-            time.sleep(0.1)
-            print(f"goal_angle: {data["goal_angle"]}")
-            if data["goal_angle"] is None:
-                devices["motor"].turn(0)
-            else:
-                devices["motor"].turn(data["goal_angle"]) # 回転する
-            
-            # GPSがタイムアウト
-            if time.time() - long_start_time > 360 and data["goal_angle"] is None:
-                break
-            
-            # ゴールが近づいたら遠距離フェーズを終了
-            if data["goal_distance"] < 5:
-                print("\n\n")
-                logger.info("Ended long phase")
-                print("\n\n")
+            # ここに機体の向きを判定する処理を書く
+            grav = data["grav"]
+            if grav[2] is not None and grav[2] < 0:
+                start_time = time.monotonic()
+                devices["motor"].turn(0) # 0度(前進)に向く
+                logger.info("muki_hantai")
+                grav_seq = data.seq("grav")
+                while data["grav"][2] < 0 and time.monotonic() - start_time < 5:
+                    grav_seq = data.wait_new("grav", grav_seq, timeout=0.1) or grav_seq
+                devices["motor"].turn(0) # 0度(前進)に向く
         except Exception as e:
-            logger.exception(f"An error occured in long phase approaching: {e}")
+            logger.exception(f"An error occured in muki_hantai: {e}")
+
+    # ゴールから離れている間，ゴールに向かって進む
+    def steer(now):
+        logger.debug("goal_angle: %s", now["goal_angle"])
+        if now["goal_angle"] is None:
+            devices["motor"].turn(0)
+        else:
+            devices["motor"].turn(now["goal_angle"]) # 回転する
+
+    # ゴールが近づいたら遠距離フェーズを終了
+    def is_near(now):
+        return now["goal_distance"] is not None and now["goal_distance"] < 5
+
+    # GPSがタイムアウト
+    def no_gnss(now):
+        return now["goal_angle"] is None
+
+    return Phase("long", watch=("goal_angle", "goal_distance"), transitions=[
+        Transition("near_goal", is_near),
+        Transition("gnss_timeout", no_gnss, after=360),
+    ], on_enter=on_enter, on_sample=steer)
 
 # 近距離フェーズ
-def short_phase(devices, data, camera_order):
-    try:
-        logger.info("Entered short phase")
-        data["phase"] = "short"        
+def short_phase(devices, data, camera_order, ring=None, max_age=0.5, gain=60):
+    """カメラでコーンを探して近づき，コーンが十分大きく見えたら終了
+
+    ring: DetectionRingを渡すと，コーンの横方向のずれに比例して曲がる (max_age秒より古い結果は使わない)
+    gain: コーンが画像の端にあるときに曲がる角度[度]
+    """
+    def on_enter(data):
         # shutil.copy("./phase_pic/camera_short.jpg", "./camera_short_temp.jpg")
         # os.rename("./camera_short_temp.jpg", "camera.jpg")
         # devices["speaker"].audio_play("Harry_Potter.wav")
-    except Exception as e:
-        logger.exception(f"An error occured in entering short phase: {e}")
-
-    while True:
-        try:
-            time.sleep(0.1)
-            # ここに近距離フェーズの処理を書いて
-            if camera_order.value == 0: # コーンが見つからなかった場合
-                devices["motor"].turn(90)
-                time.sleep(0.3)
-                devices["motor"].stop()
-                time.sleep(0.7)
-            elif camera_order.value == 1: # コーンが正面にあった場合
-                devices["motor"].turn(0)
-            elif camera_order.value == 2: # コーンが右にあった場合
-                devices["motor"].turn(90)
-            elif camera_order.value == 3: # コーンが左にあった場合
-                devices["motor"].turn(270)
-            elif camera_order.value == 4: #コーンが十分に大きく見えた場合、近距離フェーズを終了
-                print("\n\n")
-                logger.info("Ended short phase")
-                print("\n\n")
-                break
-        except Exception as e:
-            logger.exception(f"An error occured in short phase moving: {e}")
+        pass
+
+    def steer_proportional(now):
+        record = ring.latest(max_age)
+        offset = offset_x(record)
+        if offset is None: # コーンが見つからない，または結果が古い場合はその場で探す
+            devices["motor"].turn(90)
+            time.sleep(0.3)
+            devices["motor"].stop()
+            time.sleep(0.7)
+        else: # ずれに比例して曲がる (右にずれていれば右へ)
+            devices["motor"].turn(offset * gain)
+
+    def steer(now):
+        # ここに近距離フェーズの処理を書いて
+        if camera_order.value == 0: # コーンが見つからなかった場合
+            devices["motor"].turn(90)
+            time.sleep(0.3)
+            devices["motor"].stop()
+            time.sleep(0.7)
+        elif camera_order.value == 1: # コーンが正面にあった場合
+            devices["motor"].turn(0)
+        elif camera_order.value == 2: # コーンが右にあった場合
+            devices["motor"].turn(90)
+        elif camera_order.value == 3: # コーンが左にあった場合
+            devices["motor"].turn(270)
+
+    #コーンが十分に大きく見えた場合、近距離フェーズを終了
+    def is_close(now):
+        if ring is not None:
+            record = ring.latest(max_age)
+            return record is not None and record["order"] == 4
+        return camera_order.value == 4
+
+    # カメラの結果は別プロセスから届くので，Telemetryの更新は待たずに0.1秒ごとに確認
+    return Phase("short", period=0.1, transitions=[
+        Transition("cone_close", is_close),
+    ], on_enter=on_enter, on_sample=steer if ring is None else steer_proportional)
 
 
 # ゴールフェーズ
@@ -232,6 +273,13 @@ def goal_phase(devices, data):
 
 
 if __name__ == "__main__":
+    # センサーやモーターのスレッドがファイルへの書き込みを待たないように，ログはキューに入れて別スレッドでまとめて書き込む
+    # INFO以下のログは呼び出し箇所ごとに1秒あたり2行までに間引く (WARNING以上は全て記録する)
+    # ログは /boot/firmware/sc26_log/ (書き込めなければ ./log/) に，あらかじめ確保したセグメントに分けて記録する (電源が落ちても壊れにくい)
+    sc_logging.get_logger(__name__, queued=True, rate_limit=2.0, log_dir=sc_logging.default_log_dir())
+
+    # センサーの値などをバイナリで記録する  飛行後は flight_recorder.load_flight(FLIGHT_RECORD_DIR) で読み込める
+    recorder = FlightRecorder(FLIGHT_RECORD_DIR, logger=logger)
 
     try:
         # 使用するデバイス  変数の中身をこの後変更する
@@ -240,6 +288,8 @@ if __name__ == "__main__":
             "bno": None,
             "gnss": None,
             "gnss_soft": None,
+            "gnss_pipeline": None,
+            "navigator": None,
             "motor": None,
             "servo1": None,
             "servo2": None,
@@ -247,52 +297,62 @@ if __name__ == "__main__":
         }
 
         # 各デバイスのセットアップ  devicesの中に各デバイスのインスタンスを入れる
-        setup(devices)
+        setup(devices, recorder)
 
         # 取得したデータ  新たなデータを取得し次第，中身を更新する
-        data = {"phase": None, "lat": None, "lon": None, "datetime_gnss": None, "lat2": None, "lon2": None, "datetime_gnss2": None, "alt": None, "temp": None, "press": None, "accel": [None, None, None], "line_accel": [None, None, None], "mag": [None, None, None], "gyro": [None, None, None], "grav": [None, None, None], "goal_distance": None, "goal_angle": None, "goal_lat": GOAL_LAT, "goal_lon": GOAL_LON}
+        # 項目の一覧は telemetry.FIELDS / TEXT_FIELDS を参照 (未取得の値はNone)
+        data = Telemetry()
+        data.update({"goal_lat": GOAL_LAT, "goal_lon": GOAL_LON})
 
         # 風で適当に取った位置の仮のGPS情報
         # data["lat"] = 30.374499
         # data["lon"] = 130.960034
 
-        # 並行処理でBMP280による測定をし続け，dataに代入し続ける
-        bmp_thread = Thread(target=devices["bmp"].get_forever, args=(data,))
-        bmp_thread.start()  # BMP280による測定をスタート
-        
-        # 並行処理でBNO055による測定をし続け，dataに代入し続ける
-        bno_thread = Thread(target=devices["bno"].get_forever, args=(data,))
-        bno_thread.start()  # BNO055による測定をスタート
-
-        # 並行処理でGNSSによる測定をし続け，dataに代入し続ける
-        gnss_thread = Thread(target=devices["gnss"].get_forever, args=(data,))
-        gnss_thread.start()  # GNSSによる測定をスタート
-
-        # 並行処理でGNSSによる測定をし続け，dataに代入し続ける
-        gnss_thread = Thread(target=devices["gnss_soft"].get_forever, args=(data,))
+        # BMP280とBNO055は同じI2Cバスを使うので，1つのスレッドで決まった時刻に交互に読み込み，dataに代入し続ける
+        # (読み込みの遅れと処理時間の統計は10秒ごとにログに記録される)
+        bmp_stream = recorder.stream("bmp")
+        bno_stream = recorder.stream("bno")
+        scheduler = SensorScheduler(logger=logger)
+        scheduler.add("bno", lambda t: devices["bno"].update(data, bno_stream, t), rate=BNO_RATE, offset=BNO_OFFSET)
+        scheduler.add("bmp", lambda t: devices["bmp"].update(data, bmp_stream, t), rate=BMP_RATE, offset=BMP_OFFSET)
+        sensor_thread = Thread(target=scheduler.run_forever)
+        sensor_thread.start()  # BMP280とBNO055による測定をスタート
+
+        # 並行処理で2つのGNSSの測位結果をまとめ続け，dataに代入し続ける
+        gnss_thread = Thread(target=devices["gnss_pipeline"].get_forever, args=(data, recorder))
         gnss_thread.start()  # GNSSによる測定をスタート
 
-        # 待機フェーズを実行
-        wait_phase(devices, data)  # ⚠️後でコメントアウトを解除
+        # 並行処理で測位結果とBNO055の値からゴールの向きを計算し続け，dataに代入し続ける
+        navigator_thread = Thread(target=devices["navigator"].get_forever, args=(data,))
+        navigator_thread.start()
 
-        # 落下フェーズを実行
-        fall_phase(devices, data)  # ⚠️後でコメントアウトを解除
+        # フェーズの遷移を管理  遷移の時刻と遅れは machine.transitions とログに残る
+        machine = PhaseMachine(data, logger=logger)
 
-        # 遠距離フェーズを実行
-        long_phase(devices, data)
+        # 待機フェーズ → 落下フェーズ → 遠距離フェーズを実行
+        machine.run(
+            wait_phase(devices, data),  # ⚠️後でコメントアウトを解除
+            fall_phase(devices, data),  # ⚠️後でコメントアウトを解除
+            long_phase(devices, data),
+        )
 
         # 並列処理でカメラをセットアップして撮影開始（並行処理ではない）
         # 画像認識の結果を camera_order.value ，colorcone_xに代入し続ける
         # 別のプロセスとデータをやり取りするcamera_oederとcolorcone_xは特殊な扱い
         camera_order = Value('i', 0)
-        camera_process = Process(target=camera_setup_and_start, args=(camera_order, True))
+        # 中心・外接矩形・面積・撮影時刻は共有メモリのリングバッファで受け取る
+        detection_ring = DetectionRing()
+        # 飛行中は画面に表示しない (認識結果は10枚に1枚 camera.jpg に書き出される)
+        camera_process = Process(target=camera_setup_and_start, args=(camera_order, detection_ring, False))
         camera_process.start()  # 画像認識スタート
 
         # 短距離フェーズを実行
-        short_phase(devices, data, camera_order)
+        machine.run(short_phase(devices, data, camera_order, detection_ring))
 
         # ゴールフェーズを実行
         goal_phase(devices, data)
 
     except Exception as e:
-        logger.exception("An unexpected error occured")
\ No newline at end of file
+        logger.exception("An unexpected error occured")
+    finally:
+        recorder.close()  # 最後に書き込んだ値までディスクに書き出す
\ No newline at end of file
@@ -5,10 +5,47 @@ from threading import Thread
 import time
 from micropyGPS import MicropyGPS
 import serial
-import calc_goal
 
-class GNSS:
-    def __init__(self, logger=None):
+class ByteRing:
+    """受信した生のバイト列を直近size バイトだけ保存するリングバッファ (後からNMEA文を確認するため)"""
+    def __init__(self, size=4096):
+        self._buf = bytearray(size)
+        self._size = size
+        self._pos = 0  # 次に書き込む位置
+        self._filled = False
+
+    def write(self, data):
+        data = data[-self._size:]
+        end = self._pos + len(data)
+        if end <= self._size:
+            self._buf[self._pos:end] = data
+        else:
+            first = self._size - self._pos
+            self._buf[self._pos:] = data[:first]
+            self._buf[:end - self._size] = data[first:]
+        if end >= self._size:
+            self._filled = True
+        self._pos = end % self._size
+
+    def read(self):
+        """保存されているバイト列を古い順に返す"""
+        if not self._filled:
+            return bytes(self._buf[:self._pos])
+        return bytes(self._buf[self._pos:] + self._buf[:self._pos])
+
+
+class GNSSReceiver:
+    """GNSSモジュールからバイト列を受け取り，NMEA文を解析して測位結果(fix)を作る共通部分
+
+    バイト列の受け取り方(_read_chunk)だけを受信機ごとに実装する (ハードウェアUART，pigpioのソフトUART，記録ファイルの再生)．
+    新しい測位結果が出るたびに add_listener で登録した関数が fix(dict) を引数に呼ばれる．
+    """
+    def __init__(self, name, logger=None, ring_size=4096, echo=False):
+        """
+        name: 受信機の名前 (ログと測位結果に付く)
+        ring_size: 生のNMEA文を保存しておくバイト数
+        echo: Trueなら受信したNMEA文を標準出力に表示
+        """
         # ログ設定
         if logger is None:
             logger = getLogger(__name__)
@@ -16,58 +53,169 @@ class GNSS:
             logger.setLevel(10)  # DEBUGレベル
         self._logger = logger
 
-        # シリアル通信設定（GNSSモジュールと接続）
-        self._uart = serial.Serial('/dev/serial0', 9600, timeout=10)
+        self.name = name
+        self._echo = echo
 
         # GPSパーサの設定（MicropyGPS）
         self._pygps = MicropyGPS(9, 'dd')  # JST（UTC+9）、度（dd）表記
 
-        # GNSSデータ読み取りスレッド開始
+        # 受信した生データと，受信量の統計
+        self.ring = ByteRing(ring_size)
+        self.total_bytes = 0  # 起動してから受信したバイト数
+        self.total_sentences = 0  # 起動してから解析できたNMEA文の数
+        self.bytes_per_sec = 0.0  # 直近1秒あたりの受信バイト数
+        self.sentences_per_sec = 0.0  # 直近1秒あたりの解析できたNMEA文の数
+
+        # 最新の測位結果
+        self.fix = None
+        self._last_epoch = None  # 最後に測位結果を出したNMEA文の時刻 (同じ時刻のRMCとGGAで2回出さないため)
+        self._listeners = []
+
+    def start(self):
+        """GNSSデータ読み取りスレッド開始"""
         self._read_thread = Thread(target=self._update, daemon=True)
         self._read_thread.start()
 
+    def add_listener(self, listener):
+        """新しい測位結果が出るたびに listener(fix) を呼ぶ"""
+        self._listeners.append(listener)
+
+    def _read_chunk(self):
+        """受信したバイト列を返す (受信するまで待つ)  受信機ごとに実装する"""
+        raise NotImplementedError
+
     def _update(self):
         """GNSSモジュールからのデータをリアルタイムで読み取り、MicropyGPSに渡す"""
+        window_start = time.monotonic()
+        window_bytes = 0
+        window_sentences = 0
         while True:
-            read_str = self._uart.read(self._uart.in_waiting).decode('utf-8', errors='ignore')
-            print(read_str, end='')  # NMEA文を確認できるように表示
-            for char in read_str:
-                if 10 <= ord(char) <= 126:
-                    # print(char, end='')  # NMEA文を確認できるように表示
-                    self._pygps.update(char)
-
-    def get_forever(self, data: dict):
-        """常に最新の位置情報をdata辞書に格納"""
+            try:
+                read_bytes = self._read_chunk()
+                if read_bytes:
+                    if self._echo:
+                        print(read_bytes.decode('utf-8', errors='ignore'), end='')  # NMEA文を確認できるように表示
+                    self.ring.write(read_bytes)
+                    parsed = self._pygps.feed(read_bytes)  # 受信したバイト列をまとめて解析
+
+                    self.total_bytes += len(read_bytes)
+                    self.total_sentences += len(parsed)
+                    window_bytes += len(read_bytes)
+                    window_sentences += len(parsed)
+
+                    if any(sentence[2:] in ('RMC', 'GGA') for sentence in parsed):
+                        self._new_fix()
+
+                # 1秒ごとに受信量を集計
+                now = time.monotonic()
+                if now - window_start >= 1.0:
+                    self.bytes_per_sec = window_bytes / (now - window_start)
+                    self.sentences_per_sec = window_sentences / (now - window_start)
+                    window_start, window_bytes, window_sentences = now, 0, 0
+            except Exception as e:
+                self._logger.exception(f"Error in GNSS read loop ({self.name}): {e}")
+                time.sleep(0.1)  # 読み込みエラーが続く場合にCPUを使い切らないように
+
+    def _new_fix(self):
+        """測位できていれば測位結果を作り，listenerに渡す (NMEA文の時刻1つにつき1回だけ)"""
+        pygps = self._pygps
+        if not (pygps.valid or pygps.fix_stat):
+            return
+        epoch = tuple(pygps.timestamp)
+        if epoch == self._last_epoch:
+            return
+        self._last_epoch = epoch
+
+        lat = pygps.latitude[0]
+        lon = pygps.longitude[0]
+        if lat == 0 and lon == 0:
+            return
+        date = pygps.date
+        time_ = pygps.timestamp
+        offset = pygps.local_offset
+        self.fix = {
+            "receiver": self.name,
+            "lat": lat,
+            "lon": lon,
+            "hdop": pygps.hdop,
+            "satellites": pygps.satellites_in_use,
+            "datetime_gnss": f"20{date[2]:02}-{date[1]:02}-{date[0]:02}T{time_[0]:02}:{time_[1]:02}:{time_[2]:05.2f}{offset:+03}:00",
+            "time": time.monotonic(),  # 測位結果を受信した時刻
+        }
+        for listener in self._listeners:
+            listener(self.fix)
+
+    def get_forever(self, data: dict, keys=("lat", "lon", "datetime_gnss")):
+        """新しい測位結果が出るたびにdata辞書に格納 (1台だけで使うとき用．複数台を使うときはGNSSPipelineを使う)"""
+        last_fix = None
         while True:
             try:
-                if self._pygps.parsed_sentences > 0:
-                    lat = self._pygps.latitude[0]
-                    lon = self._pygps.longitude[0]
-                    date = self._pygps.date
-                    time_ = self._pygps.timestamp
-                    offset = self._pygps.local_offset
-                    datetime_gnss = f"20{date[2]:02}-{date[1]:02}-{date[0]:02}T{time_[0]:02}:{time_[1]:02}:{time_[2]:05.2f}{offset:+03}:00"
-
-                    self._logger.debug(f"lat: {lat}, lon: {lon}, alt: {self._pygps.altitude}, speed: {self._pygps.speed}, gnss_datetime: {datetime_gnss}")
-
-                    data.update({
-                        "lat": lat,
-                        "lon": lon,
-                        "datetime_gnss": datetime_gnss
-                    })
-
-                    # 目標地点までの計算
-                    calc_goal.calc_goal(data)
-                time.sleep(1)
+                fix = self.fix
+                if fix is not None and fix is not last_fix:
+                    last_fix = fix
+                    self._logger.debug("%s lat: %s, lon: %s, alt: %s, speed: %s, gnss_datetime: %s, bytes/s: %.0f, sentences/s: %.1f",
+                                       self.name, fix["lat"], fix["lon"], self._pygps.altitude, self._pygps.speed,
+                                       fix["datetime_gnss"], self.bytes_per_sec, self.sentences_per_sec)
+                    data.update(dict(zip(keys, (fix["lat"], fix["lon"], fix["datetime_gnss"]))))
+                time.sleep(0.1)
             except Exception as e:
                 self._logger.exception(f"Error in GNSS loop: {e}")
 
+
+class GNSS(GNSSReceiver):
+    """ハードウェアUART (/dev/serial0) に接続したGNSSモジュール"""
+    def __init__(self, logger=None, port='/dev/serial0', baudrate=9600, read_timeout=0.5, chunk_size=256, ring_size=4096, echo=False, name="gnss"):
+        """
+        read_timeout: 1回の読み込みで待つ最大の時間[s]
+        chunk_size: 1回の読み込みで受け取る最大のバイト数 (改行を受信した時点でも読み込みを終える)
+        """
+        super().__init__(name, logger=logger, ring_size=ring_size, echo=echo)
+
+        # シリアル通信設定（GNSSモジュールと接続）
+        # timeoutを短くしておき，データが来るまでは読み込みの中で待つ (CPUを使わずに待てる)
+        self._uart = serial.Serial(port, baudrate, timeout=read_timeout)
+        self._chunk_size = chunk_size
+
+        self.start()
+
+    def _read_chunk(self):
+        """改行(NMEA文の終わり)かchunk_sizeバイトを受信するまで待って読む  タイムアウトしたら受信済みの分だけ返す"""
+        return self._uart.read_until(b'\n', self._chunk_size)
+
+
+class GNSSReplay(GNSSReceiver):
+    """記録したNMEAのファイルを受信機の代わりに再生する (地上での動作確認用)"""
+    def __init__(self, path, logger=None, baudrate=9600, loop=False, ring_size=4096, echo=False, name="replay"):
+        """
+        path: NMEA文を記録したファイル (ByteRing.read() で保存したものなど)
+        baudrate: 再生する速さ (実際の受信機と同じくらいの間隔で1行ずつ返す)
+        loop: Trueならファイルの最後まで再生したら最初に戻る
+        """
+        super().__init__(name, logger=logger, ring_size=ring_size, echo=echo)
+        self._file = open(path, 'rb')
+        self._bytes_per_sec = baudrate / 10  # 1バイト = スタートビット + 8bit + ストップビット
+        self._loop = loop
+
+        self.start()
+
+    def _read_chunk(self):
+        line = self._file.readline()
+        if not line:
+            if not self._loop:
+                time.sleep(1)
+                return b''
+            self._file.seek(0)
+            line = self._file.readline()
+        time.sleep(len(line) / self._bytes_per_sec)
+        return line
+
+
 if __name__ == "__main__":
     try:
-        gnss = GNSS()
+        gnss = GNSS(echo=True)
         data = {"lat": None, "lon": None}
         gnss.get_forever(data)
     except KeyboardInterrupt:
         print("終了します。最終データ:", data)
     except Exception as e:
-        print(f"致命的なエラー: {e}")
\ No newline at end of file
+        print(f"致命的なエラー: {e}")
@@ -0,0 +1,126 @@
+# 複数のGNSS受信機の測位結果をまとめる
+#
+# 以前はGNSSとGNSS_Softがそれぞれ1秒ごとにdataへ書き込み，それぞれがcalc_goalを呼んでいた．
+# ここでは全ての受信機(GNSSReceiver)の測位結果を1か所で受け取り，
+# 同じ時刻の測位結果が揃うのを少しだけ待ってから，HDOPと使用衛星数で重み付けした1つの測位結果にまとめる．
+# calc_goalはまとめた測位結果1つにつき1回だけ呼ぶ．
+
+from logging import getLogger, StreamHandler
+from threading import Condition
+import time
+
+import calc_goal
+
+
+class GNSSPipeline:
+    def __init__(self, receivers, keys=None, max_age=2.0, coalesce=0.2, update_goal=True, logger=None):
+        """
+        receivers: GNSSReceiverのリスト (GNSS, GNSS_Soft, GNSSReplay など)
+        keys: 受信機ごとの生の測位結果を書き込むdataの項目名 (lat, lon, datetime) のリスト
+              省略すると ("lat1", "lon1", "datetime_gnss1"), ("lat2", "lon2", "datetime_gnss2"), ...
+        max_age: これより古い[s]測位結果はまとめるときに使わない
+        coalesce: 最初の新しい測位結果が届いてから，他の受信機の測位結果を待つ時間[s]
+        update_goal: Trueならまとめた測位結果ごとにcalc_goalを呼ぶ (Navigatorがゴールの向きを計算する場合はFalse)
+        """
+        # ログ設定
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)  # DEBUGレベル
+        self._logger = logger
+
+        self._receivers = list(receivers)
+        if keys is None:
+            keys = [(f"lat{i}", f"lon{i}", f"datetime_gnss{i}") for i in range(1, len(self._receivers) + 1)]
+        self._keys = {receiver.name: key for receiver, key in zip(self._receivers, keys)}
+        self._numbers = {receiver.name: i for i, receiver in enumerate(self._receivers, 1)}  # フライトレコーダーでの受信機の番号
+        self._max_age = max_age
+        self._coalesce = coalesce
+        self._update_goal = update_goal
+
+        self._cond = Condition()
+        self._latest = {}  # 受信機の名前: 最新の測位結果
+        self._pending = set()  # まだまとめていない新しい測位結果を出した受信機の名前
+        for receiver in self._receivers:
+            receiver.add_listener(self._on_fix)
+
+        self.fused = None  # 最新のまとめた測位結果
+        self.fused_count = 0  # まとめた測位結果の数 (update_goal=Trueならcalc_goalを呼んだ回数と同じ)
+
+    def _on_fix(self, fix):
+        """受信機のスレッドから呼ばれる"""
+        with self._cond:
+            self._latest[fix["receiver"]] = fix
+            self._pending.add(fix["receiver"])
+            self._cond.notify_all()
+
+    @staticmethod
+    def fuse(fixes):
+        """測位結果をHDOPと使用衛星数で重み付けして平均する
+
+        重みは 使用衛星数 / HDOP^2  (HDOPが小さく，衛星が多い受信機ほど信頼する)
+        """
+        total = lat = lon = 0.0
+        for fix in fixes:
+            weight = max(fix["satellites"], 1) / max(fix["hdop"] or 5.0, 0.5) ** 2  # HDOPが未受信(0)なら悪めの値とみなす
+            total += weight
+            lat += weight * fix["lat"]
+            lon += weight * fix["lon"]
+        newest = max(fixes, key=lambda fix: fix["time"])
+        return {
+            "lat": lat / total,
+            "lon": lon / total,
+            "datetime_gnss": newest["datetime_gnss"],
+            "time": newest["time"],
+            "receivers": [fix["receiver"] for fix in fixes],
+        }
+
+    def _wait_fixes(self):
+        """新しい測位結果が届き，同じ時刻の他の受信機の結果が揃う(またはcoalesce秒経つ)まで待つ"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self._coalesce
+            now = time.monotonic()
+            # 最近測位できている受信機が全て新しい結果を出すまで待つ
+            active = {name for name, fix in self._latest.items() if now - fix["time"] < self._max_age}
+            while not active <= self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._pending.clear()
+            now = time.monotonic()
+            return [fix for fix in self._latest.values() if now - fix["time"] < self._max_age]
+
+    def get_forever(self, data, recorder=None):
+        """新しい測位結果をまとめてdataに書き込み，ゴールまでの距離と向きを計算し続ける
+
+        recorder: FlightRecorderを渡すと，まとめた値(受信機の番号0)と受信機ごとの値をバイナリでも記録する
+        """
+        stream = recorder.stream("gnss") if recorder is not None else None
+        while True:
+            try:
+                fixes = self._wait_fixes()
+                if not fixes:
+                    continue
+                fused = self.fuse(fixes)
+                self.fused = fused
+                self.fused_count += 1
+
+                values = {"lat": fused["lat"], "lon": fused["lon"], "datetime_gnss": fused["datetime_gnss"]}
+                for fix in fixes:
+                    lat_key, lon_key, datetime_key = self._keys[fix["receiver"]]
+                    values.update({lat_key: fix["lat"], lon_key: fix["lon"], datetime_key: fix["datetime_gnss"]})
+                data.update(values)
+                if stream is not None:
+                    stream.append(0, fused["lat"], fused["lon"])
+                    for fix in fixes:
+                        stream.append(self._numbers[fix["receiver"]], fix["lat"], fix["lon"], t=fix["time"])
+                self._logger.debug("lat: %s, lon: %s, gnss_datetime: %s, receivers: %s",
+                                   fused["lat"], fused["lon"], fused["datetime_gnss"], fused["receivers"])
+
+                # 目標地点までの計算 (まとめた測位結果1つにつき1回)
+                if self._update_goal:
+                    calc_goal.calc_goal(data)
+            except Exception as e:
+                self._logger.exception(f"Error in GNSS pipeline: {e}")
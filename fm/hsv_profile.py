@@ -0,0 +1,172 @@
+# 明るさ(露光時間・ゲイン)ごとの赤色のHSVの値域(プロファイル)
+#
+# 赤色の値域は fm/camera.py (S, V >= 117, 104) と testcode (S, V >= 50, 50) で別々に決め打ちされており，
+# testcode では明るさの違いに対応するために毎フレームCLAHE(ヒストグラム平坦化)をかけていた．
+# ここでは
+#   - 校正: コーンの部分を白く塗ったラベル画像付きのサンプル画像から，明るさごとに値域を学習してJSONに保存する
+#   - 実行時: カメラのメタデータ(ExposureTime, AnalogueGain)に最も近い明るさのプロファイルを選ぶ
+# とし，毎フレームの平坦化をしなくても日差しの変化に対応できるようにする．
+#
+# 校正の使い方:
+#   python hsv_profile.py サンプルのフォルダ [出力するJSON]
+#   フォルダには name.jpg (撮影した画像), name_mask.png (コーンの部分を白くした画像),
+#   name.json (picamera2のメタデータ  {"ExposureTime": 露光時間[us], "AnalogueGain": ゲイン, ...}) を置く
+
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+from color_lut import CAMERA_RED_HSV_RANGES
+
+
+# プロファイルのファイルがないときに使う値域 (これまでCamera.red_detectで使っていたもの)
+DEFAULT_PROFILE = {"name": "default", "exposure_time": None, "analogue_gain": None,
+                   "hsv_ranges": [list(map(list, hsv_range)) for hsv_range in CAMERA_RED_HSV_RANGES]}
+
+_HUE_SHIFT = 90  # 赤(H=0付近)が値域の真ん中に来るように色相をずらす
+_SV_STEP = 4  # S, Vのしきい値を探す刻み
+
+
+def brightness_key(exposure_time, analogue_gain):
+    """露光時間[us]とゲインから明るさの目安 log2(露光時間×ゲイン) を返す (暗い場面ほど大きい)"""
+    return math.log2(max(exposure_time, 1) * max(analogue_gain, 1e-3))
+
+
+def _hue_ranges(low, high):
+    """ずらした色相の範囲 [low, high] を，OpenCVの色相(0~179)の1つまたは2つの範囲に戻す"""
+    low = (low - _HUE_SHIFT) % 180
+    high = (high - _HUE_SHIFT) % 180
+    if low <= high:
+        return [(low, high)]
+    return [(0, high), (low, 179)]  # 0をまたぐ
+
+
+def learn_ranges(samples, hue_percentile=1.0, hue_margin=2):
+    """ラベル付きのサンプル [(BGR画像, マスク)] から赤色のHSVの値域を学習する
+
+    色相: コーンの画素の色相の hue_percentile ~ 100-hue_percentile % の範囲を，両側にhue_marginずつ広げたもの
+    彩度・明度の最小値: その色相の範囲で，コーンの画素とそれ以外の画素の分け方が最もよい(F値が最大の)組み合わせ
+    戻り値: (HSVの値域のリスト, 学習データでのF値)
+    """
+    hues, positives, negatives = [], [], []
+    for img, mask in samples:
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        label = mask.reshape(-1) > 127
+        hsv[:, 0] = (hsv[:, 0].astype(np.int32) + _HUE_SHIFT) % 180
+        hues.append(hsv[label, 0])
+        positives.append(hsv[label])
+        negatives.append(hsv[~label])
+    hues = np.concatenate(hues)
+    positives = np.concatenate(positives)
+    negatives = np.concatenate(negatives)
+    if len(hues) == 0:
+        raise ValueError("no labeled pixels in samples")
+
+    hue_low, hue_high = np.percentile(hues, [hue_percentile, 100 - hue_percentile]).astype(int)
+    hue_low, hue_high = max(hue_low - hue_margin, 0), min(hue_high + hue_margin, 179)
+
+    # 色相の範囲に入る画素の (S, V) の2次元ヒストグラムを作り，右上から累積すると
+    # 「S >= s かつ V >= v」に入る画素の数が全ての (s, v) について一度に求まる
+    bins = np.arange(0, 256 + _SV_STEP, _SV_STEP)
+
+    def counts(pixels):
+        in_hue = pixels[(pixels[:, 0] >= hue_low) & (pixels[:, 0] <= hue_high)]
+        hist, _, _ = np.histogram2d(in_hue[:, 1], in_hue[:, 2], bins=(bins, bins))
+        return hist[::-1, ::-1].cumsum(0).cumsum(1)[::-1, ::-1]
+
+    true_positive = counts(positives)
+    false_positive = counts(negatives)
+    f1 = 2 * true_positive / (len(positives) + true_positive + false_positive)
+    s_index, v_index = np.unravel_index(np.argmax(f1), f1.shape)
+    s_min, v_min = int(bins[s_index]), int(bins[v_index])
+
+    ranges = [((h_low, s_min, v_min), (h_high, 255, 255)) for h_low, h_high in _hue_ranges(hue_low, hue_high)]
+    return ranges, float(f1[s_index, v_index])
+
+
+def load_samples(directory):
+    """校正用のサンプルを読み込み，{明るさの目安(0.5刻み): [(画像, マスク, メタデータ)]} にまとめる"""
+    groups = {}
+    for name in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(name)
+        if ext.lower() not in (".jpg", ".jpeg", ".png") or base.endswith("_mask"):
+            continue
+        mask = cv2.imread(os.path.join(directory, f"{base}_mask.png"), cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            continue  # ラベルがない画像は使わない
+        img = cv2.imread(os.path.join(directory, name))
+        metadata = {}
+        metadata_path = os.path.join(directory, f"{base}.json")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        key = None
+        if "ExposureTime" in metadata and "AnalogueGain" in metadata:
+            key = round(brightness_key(metadata["ExposureTime"], metadata["AnalogueGain"]) * 2) / 2
+        groups.setdefault(key, []).append((img, mask, metadata))
+    return groups
+
+
+def calibrate(directory):
+    """サンプルのフォルダから明るさごとのプロファイルのリストを作る"""
+    profiles = []
+    for key, samples in sorted(load_samples(directory).items(), key=lambda item: (item[0] is None, item[0])):
+        ranges, f1 = learn_ranges([(img, mask) for img, mask, _ in samples])
+        metadata = [m for _, _, m in samples if "ExposureTime" in m and "AnalogueGain" in m]
+        profiles.append({
+            "name": "any" if key is None else f"b{key:.1f}",
+            "exposure_time": float(np.median([m["ExposureTime"] for m in metadata])) if metadata else None,
+            "analogue_gain": float(np.median([m["AnalogueGain"] for m in metadata])) if metadata else None,
+            "hsv_ranges": [[list(map(int, low)), list(map(int, high))] for low, high in ranges],
+            "samples": len(samples),
+            "f1": f1,
+        })
+    return profiles
+
+
+class ProfileStore:
+    """ファイルに保存したプロファイルを読み込み，カメラのメタデータに合うものを選ぶ"""
+    def __init__(self, path="hsv_profiles.json"):
+        self.path = path
+        self.profiles = [DEFAULT_PROFILE]
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                loaded = json.load(f)
+            if loaded:
+                self.profiles = loaded
+
+    def save(self, profiles):
+        """プロファイルを書き込む (書きかけのファイルを読まないように一時ファイルから置き換える)"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(profiles, f, indent=2)
+        os.replace(temp_path, self.path)
+        self.profiles = profiles
+
+    def select(self, metadata=None):
+        """メタデータの露光時間とゲインに最も近い明るさのプロファイルを返す (分からなければ最初のもの)"""
+        if not metadata or "ExposureTime" not in metadata or "AnalogueGain" not in metadata:
+            return self.profiles[0]
+        key = brightness_key(metadata["ExposureTime"], metadata["AnalogueGain"])
+        keyed = [p for p in self.profiles if p.get("exposure_time") and p.get("analogue_gain")]
+        if not keyed:
+            return self.profiles[0]
+        return min(keyed, key=lambda p: abs(brightness_key(p["exposure_time"], p["analogue_gain"]) - key))
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: python hsv_profile.py サンプルのフォルダ [出力するJSON]")
+        sys.exit(1)
+    profiles = calibrate(sys.argv[1])
+    store = ProfileStore(sys.argv[2] if len(sys.argv) > 2 else "hsv_profiles.json")
+    store.save(profiles)
+    for profile in profiles:
+        print(f"{profile['name']}: exposure {profile['exposure_time']} us, gain {profile['analogue_gain']}, "
+              f"ranges {profile['hsv_ranges']}, samples {profile['samples']}, f1 {profile['f1']:.3f}")
+    print(f"saved to {store.path}")
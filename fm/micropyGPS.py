@@ -24,7 +24,7 @@ except ImportError:
 
 class MicropyGPS(object):
     """GPS NMEA Sentence Parser. Creates object that stores all relevant GPS data and statistics.
-    Parses sentences one character at a time using update(). """
+    Parses sentences one character at a time using update(), or whole chunks of bytes using feed(). """
 
     # Max Number of Characters a valid sentence can be (based on GGA sentence)
     SENTENCE_LIMIT = 90
@@ -64,6 +64,7 @@ class MicropyGPS(object):
         self.crc_xor = 0
         self.char_count = 0
         self.fix_time = 0
+        self._feed_buffer = b''
 
         #####################
         # Sentence Statistics
@@ -119,7 +120,7 @@ class MicropyGPS(object):
             # if decimal_degrees == 0:
             #     raise(ValueError(f'latitude is abnormal: {decimal_degrees}'))
             
-            self._logger.debug(f'lat: {decimal_degrees}')  # 測地値を記録
+            self._logger.debug('lat: %s', decimal_degrees)  # 測地値を記録
             return [decimal_degrees, self._latitude[2]]
         elif self.coord_format == 'dms':
             minute_parts = modf(self._latitude[1])
@@ -138,7 +139,7 @@ class MicropyGPS(object):
             # if decimal_degrees == 0:
             #     raise(ValueError(f'longitude is abnormal: {decimal_degrees}'))
             
-            self._logger.debug(f'lon: {decimal_degrees}')  # 測地値を記録
+            self._logger.debug('lon: %s', decimal_degrees)  # 測地値を記録
             return [decimal_degrees, self._longitude[2]]
         elif self.coord_format == 'dms':
             minute_parts = modf(self._longitude[1])
@@ -653,6 +654,98 @@ class MicropyGPS(object):
         except Exception as e:
             self._logger.exception("An error occured!")
 
+    def feed(self, data):
+        """Process a chunk of received bytes. Whole sentences are cut out on '$' and line endings, validated by CRC
+        on the slice and passed to the same sentence functions as update(). An incomplete sentence at the end of the
+        chunk is kept until the next call. Returns a list of the sentence types parsed successfully"""
+
+        if isinstance(data, str):
+            data = data.encode('ascii', errors='ignore')
+
+        # Write received data to log file if enabled
+        if self.log_en:
+            self.write_log(data.decode('ascii', errors='ignore'))
+
+        buffer = self._feed_buffer + data
+        parsed = []
+        position = 0
+        while True:
+            start = buffer.find(b'$', position)
+            if start < 0:
+                # No sentence is starting, so everything left is garbage
+                buffer = b''
+                break
+
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                # Keep the incomplete sentence for the next chunk unless it is already too long to be valid
+                buffer = buffer[start:] if len(buffer) - start <= self.SENTENCE_LIMIT else b''
+                break
+            position = end + 1
+
+            # If a new sentence started before this line ended, the earlier one was cut off
+            sentence = buffer[start + 1:end]
+            restart = sentence.rfind(b'$')
+            if restart >= 0:
+                sentence = sentence[restart + 1:]
+
+            sentence_type = self._parse_sentence(sentence.rstrip(b'\r'))
+            if sentence_type is not None:
+                parsed.append(sentence_type)
+
+        self._feed_buffer = buffer
+        return parsed
+
+    def _parse_sentence(self, sentence):
+        """Validate the CRC of one sentence (the bytes between '$' and the line ending) and parse it.
+        Returns sentence type on successful parse, None otherwise"""
+        try:
+            self.char_count = len(sentence) + 1
+            if self.char_count > self.SENTENCE_LIMIT:
+                return None
+
+            # Split off the CRC after '*'
+            star = sentence.rfind(b'*')
+            if star < 0:
+                return None
+            crc_string = sentence[star + 1:star + 3]
+            if len(crc_string) != 2:
+                return None
+            try:
+                final_crc = int(crc_string, 16)
+            except ValueError:
+                return None  # CRC Value was deformed and could not have been correct
+
+            # CRC is the XOR of every byte between '$' and '*'
+            body = sentence[:star]
+            crc_xor = 0
+            for byte in body:
+                crc_xor ^= byte
+            self.crc_xor = crc_xor
+            if crc_xor != final_crc:
+                self.crc_fails += 1
+                return None
+
+            self.clean_sentences += 1  # Increment clean sentences received
+            try:
+                segments = body.decode('ascii').split(',')
+            except UnicodeDecodeError:
+                return None
+            self.gps_segments = segments + [crc_string.decode('ascii')]
+
+            if self.gps_segments[0] in self.supported_sentences:
+
+                # parse the Sentence Based on the message type, return True if parse is clean
+                if self.supported_sentences[self.gps_segments[0]](self):
+
+                    # Let host know that the GPS object was updated by returning parsed sentence type
+                    self.parsed_sentences += 1
+                    return self.gps_segments[0]
+
+            return None
+        except Exception as e:
+            self._logger.exception("An error occured!")
+
     def new_fix_time(self):
         """Updates a high resolution counter with current time when fix is updated. Currently only triggered from
         GGA, GSA and RMC sentences"""
@@ -835,7 +928,8 @@ class MicropyGPS(object):
                 else:  # Default date format
                     date_string = month + '/' + day + '/' + year
 
-            self._logger.debug(f'gnss_time: 20{self.date[2]:02}-{self.date[1]:02}-{self.date[0]:02}T{self.timestamp[0]:02}:{self.timestamp[1]:02}:{self.timestamp[2]:05.2f}{self.local_offset:+02}:00')  # 測定値を記録
+            self._logger.debug('gnss_time: 20%02d-%02d-%02dT%02d:%02d:%05.2f%+02d:00', self.date[2], self.date[1], self.date[0],
+                               self.timestamp[0], self.timestamp[1], self.timestamp[2], self.local_offset)  # 測定値を記録
             return date_string
         except Exception as e:
             self._logger.exception("An error occured!")
@@ -4,7 +4,8 @@ import pigpio
 import time
 
 class Motor:
-    def __init__(self, right_pin1=18, right_pin2=12, left_pin1=13, left_pin2=19, logger=None):
+    def __init__(self, right_pin1=18, right_pin2=12, left_pin1=13, left_pin2=19, logger=None, recorder=None):
+        """recorder: FlightRecorderを渡すと，左右のモーターへの指令値を変えるたびに記録する"""
         if logger is None:
             logger = getLogger(__name__)
             logger.addHandler(StreamHandler())
@@ -15,6 +16,10 @@ class Motor:
         self._right_pin2 = right_pin2
         self._left_pin1 = left_pin1
         self._left_pin2 = left_pin2
+
+        self._stream = recorder.stream("motor") if recorder is not None else None
+        self._right = 0.0  # 最後に設定した速度 (記録用)
+        self._left = 0.0
         
         self._pi = pigpio.pi()
 
@@ -37,6 +42,7 @@ class Motor:
         elif speed < 0:
             self._pi.hardware_PWM(self._right_pin1, 200000, 0)
             self._pi.hardware_PWM(self._right_pin2, 200000, -speed)
+        return speed / 1000000  # 実際に設定した速度 (記録用)
     
     def set_left(self, speed):
         """左モーターの速度を設定"""
@@ -51,6 +57,7 @@ class Motor:
         elif speed < 0:
             self._pi.hardware_PWM(self._left_pin1, 0, 200000)
             self._pi.hardware_PWM(self._left_pin2, -speed, 200000)
+        return speed / 1000000  # 実際に設定した速度 (記録用)
     
     def stop(self):
         """モーターを停止"""
@@ -58,22 +65,31 @@ class Motor:
         self._pi.hardware_PWM(self._right_pin2, 200000, 0)
         self._pi.hardware_PWM(self._left_pin1, 200000, 0)
         self._pi.hardware_PWM(self._left_pin2, 200000, 0)
+        self._record(0.0, 0.0)
+
+    def _record(self, right, left):
+        """左右の指令値をフライトレコーダーに記録 (1回の指令につき1回，左右を設定し終えてから呼ぶ)"""
+        self._right = right
+        self._left = left
+        if self._stream is not None:
+            self._stream.append(right, left)
 
     def turn(self, angle):
         """指定した角度だけ回転
         angle: 0~360度，0:前進，90:右旋回，...
         """
         angle %= 360  # 角度を0~360の範囲に正規化
-        self._logger.debug(f"Turning to angle: {angle}")
+        self._logger.debug("Turning to angle: %s", angle)
         if 0 <= angle and angle < 180:
-            self.set_right(1 - angle / 90)
-            self.set_left(1)
+            right = self.set_right(1 - angle / 90)
+            left = self.set_left(1)
         elif 180 <= angle and angle <= 360:
-            self.set_right(1)
-            self.set_left(1 - (angle - 180) / 90)
+            right = self.set_right(1)
+            left = self.set_left(1 - (angle - 180) / 90)
         else:
-            self.set_right(0)
-            self.set_left(0)
+            right = self.set_right(0)
+            left = self.set_left(0)
+        self._record(right, left)
     
     def __del__(self):
         """インスタンスが削除されるときにモーターを停止"""
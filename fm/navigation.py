@@ -0,0 +1,92 @@
+# ゴールの向きをIMUの更新周期で計算し直す
+#
+# calc_goalはGNSSの測位結果が出たとき(約1秒に1回)にしか呼ばれないため，機体が回転している間もgoal_angleは最大1秒古いままだった．
+# ゴールまでのベクトル(平面直角座標)は測位結果が出たときだけ計算してキャッシュしておき，
+# BNO055の地磁気(またはオイラー角)が更新されるたびに，そのベクトルを今の向きで回転させるだけにする．
+# 1回あたりは三角関数が数回だけなので，50~100Hzで計算してもほとんど負荷にならない．
+
+from logging import getLogger, StreamHandler
+import time
+
+import calc_goal
+
+
+class Navigator:
+    def __init__(self, heading_source="mag", logger=None):
+        """
+        heading_source: 機体の向きに使う値  "mag" (地磁気) または "euler" (BNO055のオイラー角のheading)
+        """
+        # もしloggerが渡されなかったら，ログの記録先を標準出力に設定
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)
+        self._logger = logger
+
+        if heading_source not in ("mag", "euler"):
+            raise ValueError(f"heading_source must be 'mag' or 'euler': {heading_source}")
+        self._heading_source = heading_source
+
+        self.goal_xy = None  # 最後の測位結果から求めたCanSat中心のゴールの座標[m]
+        self.goal_distance = None  # 最後の測位結果から求めたゴールまでの距離[m]
+        self.update_count = 0  # goal_angleを計算し直した回数
+
+    def update_fix(self, goal_lat, goal_lon, lat, lon):
+        """新しい測位結果からゴールまでのベクトルと距離を計算してキャッシュする"""
+        if goal_lat is None or goal_lon is None or lat is None or lon is None:
+            return
+        self.goal_xy = calc_goal.goal_vector(goal_lat, goal_lon, lat, lon)
+        self.goal_distance = calc_goal.goal_distance(self.goal_xy)
+
+    def north_angle(self, heading_value):
+        """地磁気[x, y, z]またはオイラー角[heading, roll, pitch]から，機体から見た北の向き[rad]を求める"""
+        if heading_value is None or heading_value[0] is None:
+            return None
+        if self._heading_source == "mag":
+            return calc_goal.north_angle_from_mag(heading_value)
+        return calc_goal.north_angle_from_heading(heading_value[0])
+
+    def goal_angle(self, heading_value):
+        """キャッシュしたゴールまでのベクトルを今の向きで回転させ，ゴールの向き[度]を返す"""
+        if self.goal_xy is None:
+            return None
+        north_angle_rad = self.north_angle(heading_value)
+        if north_angle_rad is None:
+            return None
+        return calc_goal.goal_angle(self.goal_xy, north_angle_rad)
+
+    def get_forever(self, data, log_interval=1.0):
+        """測位結果とIMUの値が更新されるたびに，goal_distanceとgoal_angleをdataに書き込み続ける"""
+        source = self._heading_source
+        names = ("goal_lat", "goal_lon", "lat", "lon", source)
+        seq = {name: data.seq(name) for name in ("lat", source)}
+        last_fix_seq = None
+        next_log_time = time.monotonic()
+        while True:
+            try:
+                data.wait(seq, timeout=1.0)
+                now = data.snapshot(names)
+                seq = {name: now.seq[name] for name in ("lat", source)}
+
+                # 新しい測位結果が出たときだけゴールまでのベクトルを計算し直す
+                values = {}
+                if now.seq["lat"] != last_fix_seq:
+                    last_fix_seq = now.seq["lat"]
+                    self.update_fix(now["goal_lat"], now["goal_lon"], now["lat"], now["lon"])
+                    if self.goal_distance is not None:
+                        values["goal_distance"] = self.goal_distance
+
+                # 向きはIMUの値が更新されるたびに計算し直す
+                angle = self.goal_angle(now[source])
+                if angle is not None:
+                    values["goal_angle"] = angle
+                    self.update_count += 1
+                if values:
+                    data.update(values)
+
+                if time.monotonic() >= next_log_time and angle is not None:
+                    self._logger.debug("goal_distance: %s, goal_angle: %s", self.goal_distance, angle)
+                    next_log_time = time.monotonic() + log_interval
+            except Exception as e:
+                self._logger.exception(f"An error occured in navigation: {e}")
+                time.sleep(0.1)
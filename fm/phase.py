@@ -0,0 +1,177 @@
+# フェーズの状態遷移を管理する
+#
+# 以前は各フェーズが while True + time.sleep(0.1) で条件を調べ，確認のために time.sleep(5) で止まっていたため，
+# 条件を満たしてから遷移するまで最大5.1秒遅れていた．
+# ここでは各フェーズが「どのデータを見て」「どの条件が」「何秒続いたら」終わるのかを宣言し，
+# PhaseMachineがTelemetryの更新通知を待ちながら条件を調べる．
+# 条件の判定は新しいデータが届くたび(または確認期限が来たとき)に行うので，遷移の遅れは1サンプル周期以内になる．
+# 全ての遷移は時刻付きで machine.transitions に残り，ログにも記録される(飛行後の遅れの解析用)．
+
+from logging import getLogger, StreamHandler
+import time
+
+
+class Transition:
+    """フェーズを終了させる条件
+
+    condition(now): 条件が成り立ち始めたかどうか  (nowはTelemetry.snapshot()の結果)
+    hold: 条件が成り立ち続ける必要がある秒数 (0なら成り立った瞬間に遷移)
+    hold_condition(now): hold秒の間ずっと成り立つ必要がある条件 (省略時はconditionと同じ)
+    confirm(start, now): hold秒経った時点で最後に確認する条件 (startは条件が成り立ち始めたときのsnapshot)
+    after: フェーズに入ってからこの秒数が経つまでは判定しない
+    """
+    def __init__(self, name, condition, hold=0.0, hold_condition=None, confirm=None, after=0.0):
+        self.name = name
+        self.condition = condition
+        self.hold = hold
+        self.hold_condition = hold_condition if hold_condition is not None else condition
+        self.confirm = confirm
+        self.after = after
+
+        self._start = None  # 条件が成り立ち始めたときのsnapshot
+        self._start_time = None
+
+    def reset(self):
+        self._start = None
+        self._start_time = None
+
+    def due(self):
+        """hold秒が経過する時刻 (条件が成り立っていなければNone)"""
+        if self._start_time is None:
+            return None
+        return self._start_time + self.hold
+
+    def check(self, now, elapsed):
+        """条件を判定し，遷移するなら遷移のきっかけになった時刻(time.monotonic())を返す"""
+        if elapsed < self.after:
+            return None
+
+        if self._start is None:
+            if not self.condition(now):
+                return None
+            # 条件を満たしたデータが届いた時刻から数え始める (データを見ないフェーズや，まだ一度も書き込まれていない項目だけなら今の時刻)
+            # フェーズに入る前(またはafter秒より前)に届いたデータでも，数え始めるのはafter秒が経ってから
+            stamps = [stamp for stamp in now.stamp.values() if stamp > 0]  # 0は一度も書き込まれていない項目
+            self._start = now
+            self._start_time = max(max(stamps), time.monotonic() - elapsed + self.after) if stamps else time.monotonic()
+        elif not self.hold_condition(now):
+            self.reset()
+            return self.check(now, elapsed)  # 今のデータで改めて数え始められるか確認
+
+        if time.monotonic() < self._start_time + self.hold:
+            return None
+        if self.confirm is not None and not self.confirm(self._start, now):
+            self.reset()
+            return None
+        return self._start_time + self.hold
+
+
+class Phase:
+    """1つのフェーズの定義
+
+    name: フェーズ名 (data["phase"] に書き込まれる)
+    watch: 更新を待つTelemetryの項目名 (どれかが更新されるたびに判定する)
+    transitions: フェーズを終了させるTransitionのリスト (どれか1つを満たせば終了)
+    period: watchの項目が更新されなくても判定する間隔[s]
+    on_enter(data) / on_exit(data, transition): フェーズの開始時・終了時に呼ばれる
+    on_sample(now): 判定のたびに呼ばれる (モーターの制御など)
+    on_error(e): フェーズ内で例外が起きたときに呼ばれる (NiCr線を止めるなど)
+    """
+    def __init__(self, name, watch=(), transitions=(), period=0.1,
+                 on_enter=None, on_exit=None, on_sample=None, on_error=None):
+        self.name = name
+        self.watch = tuple(watch)
+        self.transitions = list(transitions)
+        self.period = period
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self.on_sample = on_sample
+        self.on_error = on_error
+
+
+class PhaseMachine:
+    """Phaseを順番に実行し，遷移を記録する"""
+    def __init__(self, data, logger=None):
+        # もしloggerが渡されなかったら，ログの記録先を標準出力に設定
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)
+        self._logger = logger
+
+        self._data = data
+        self.transitions = []  # 遷移の記録 (dictのリスト)
+
+    def run(self, *phases):
+        """フェーズを順番に実行する (全て終わったら戻る)"""
+        for phase in phases:
+            self._run_phase(phase)
+
+    def _run_phase(self, phase):
+        data = self._data
+        try:
+            self._logger.info(f"Entered {phase.name} phase")
+            data["phase"] = phase.name
+            if phase.on_enter is not None:
+                phase.on_enter(data)
+        except Exception as e:
+            self._logger.exception(f"An error occured in entering {phase.name} phase: {e}")
+            self._on_error(phase, e)
+
+        for transition in phase.transitions:
+            transition.reset()
+        enter_time = time.monotonic()
+        seq = {name: data.seq(name) for name in phase.watch}
+
+        while True:
+            try:
+                # 次に判定すべき時刻まで，watchの項目の更新を待つ
+                timeout = phase.period
+                for transition in phase.transitions:
+                    due = transition.due()
+                    if due is not None:
+                        timeout = min(timeout, max(0.0, due - time.monotonic()))
+                if seq:
+                    data.wait(seq, timeout)
+                elif timeout > 0:
+                    time.sleep(timeout)
+
+                now = data.snapshot(phase.watch)
+                seq = {name: now.seq[name] for name in phase.watch}
+
+                if phase.on_sample is not None:
+                    phase.on_sample(now)
+
+                elapsed = time.monotonic() - enter_time
+                for transition in phase.transitions:
+                    trigger_time = transition.check(now, elapsed)
+                    if trigger_time is not None:
+                        self._record(phase, transition, enter_time, trigger_time)
+                        if phase.on_exit is not None:
+                            phase.on_exit(data, transition)
+                        self._logger.info(f"Ended {phase.name} phase")
+                        return
+            except Exception as e:
+                self._logger.exception(f"An error occured in {phase.name} phase: {e}")
+                self._on_error(phase, e)
+
+    def _record(self, phase, transition, enter_time, trigger_time):
+        """遷移を記録  latencyは条件を満たしてから遷移するまでの遅れ[s]"""
+        fired_time = time.monotonic()
+        record = {
+            "phase": phase.name,
+            "transition": transition.name,
+            "time": time.time(),  # ログと照らし合わせるためのUNIX時刻
+            "duration": fired_time - enter_time,
+            "latency": max(0.0, fired_time - trigger_time),
+        }
+        self.transitions.append(record)
+        self._logger.info(f"transition: {record['phase']} -> {record['transition']}, duration: {record['duration']:.3f} s, latency: {record['latency']*1000:.1f} ms")
+
+    def _on_error(self, phase, e):
+        if phase.on_error is None:
+            return
+        try:
+            phase.on_error(e)
+        except Exception:
+            self._logger.exception(f"An error occured in {phase.name} phase error handler")
@@ -0,0 +1,70 @@
+# 画像認識の結果を確認するためのプレビュー画像の書き出し
+#
+# 飛行中は画面に表示しない(headless)ので，every枚に1枚だけ認識結果を描き込んだ画像をJPEGにして書き出す．
+# JPEGへの変換と書き込みは別スレッドで行い，書き出しが追いつかなければ待たずに最新の1枚だけを残す．
+# 書き出しは一時ファイルに書いてから os.replace で置き換えるので，読み込む側が書きかけの画像を読むことはない．
+
+from logging import getLogger, StreamHandler
+from threading import Condition, Thread
+import os
+
+import cv2
+
+
+class PreviewSink:
+    def __init__(self, path="camera.jpg", every=10, quality=70, logger=None):
+        """
+        path: 書き出す画像のファイル名 (毎回同じファイルを置き換える)
+        every: 何枚に1枚書き出すか
+        quality: JPEGの画質 (0~100)
+        """
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)  # DEBUGレベル
+        self._logger = logger
+
+        self._path = path
+        self._temp_path = f"{path}.tmp"
+        self._every = max(int(every), 1)
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        self._count = 0
+        self._pending = None  # 書き出し待ちの最新の画像
+        self._cond = Condition()
+        self.written = 0  # 書き出した画像の数
+        self.skipped = 0  # 書き出しが追いつかず，新しい画像で置き換えた数
+
+        self._thread = Thread(target=self._write_forever, daemon=True)
+        self._thread.start()
+
+    def due(self):
+        """今の画像を書き出す番ならTrue (1枚ごとに1回呼ぶ)  Trueのときだけ認識結果を描き込めばよい"""
+        count = self._count
+        self._count += 1
+        return count % self._every == 0
+
+    def submit(self, frame):
+        """画像を書き出し待ちにする (待たずに戻る)"""
+        with self._cond:
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = frame
+            self._cond.notify()
+
+    def _write_forever(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                frame, self._pending = self._pending, None
+            try:
+                ok, jpeg = cv2.imencode(".jpg", frame, self._params)
+                if not ok:
+                    self._logger.error(f"Failed to encode preview {self._path}")
+                    continue
+                with open(self._temp_path, "wb") as f:
+                    f.write(jpeg.tobytes())
+                os.replace(self._temp_path, self._path)  # 読み込む側が書きかけの画像を読まないように置き換える
+                self.written += 1
+            except Exception as e:
+                self._logger.exception(f"An error occured in preview sink: {e}")
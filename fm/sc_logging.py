@@ -1,28 +1,388 @@
-from datetime import datetime
-from logging import getLogger, StreamHandler, Formatter, Logger, DEBUG, INFO, WARNING, ERROR, CRITICAL
+
+from logging import getLogger, StreamHandler, Filter, Formatter, Handler, Logger, LogRecord, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from logging.handlers import RotatingFileHandler
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+import atexit
 import os
+import re
+
+# ログを記録するフォルダ (SDカードのFAT32の領域)  なければ ./log に記録する
+LOG_DIR = '/boot/firmware/sc26_log'
+
+
+class _DeferredFlush:
+    """書き込みのたびのflushを止め，まとめ書きの最後に1回だけflushするためのmixin"""
+    deferred = False
+
+    def flush(self):
+        if not self.deferred:
+            super().flush()
+
+
+class BatchStreamHandler(_DeferredFlush, StreamHandler):
+    pass
+
+
+class BatchRotatingFileHandler(_DeferredFlush, RotatingFileHandler):
+    pass
+
+
+class DropQueueHandler(Handler):
+    """ログを書き込まずにキューに入れるだけのハンドラ (キューが一杯なら待たずに捨てて数える)
+
+    センサーやモーターのスレッドでファイルへの書き込みを待たないようにするためのもの
+    実際の書き込みは BatchWriter のスレッドが行う
+    """
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+        self.dropped = 0  # キューが一杯で捨てたログの数
+
+    def prepare(self, record):
+        # 引数を埋め込んだ文字列と例外の内容だけは，値が変わる前にここで作っておく (時刻などの整形は書き込み側で行う)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class BatchWriter:
+    """キューにたまったログをまとめて各ハンドラに書き込み，まとめて1回flushするスレッド"""
+    def __init__(self, queue_handler, handlers, batch_size=64):
+        self._queue_handler = queue_handler
+        self._handlers = handlers
+        self._batch_size = batch_size
+        self._reported = 0  # 捨てた数をログに書いたところまで
+        for handler in handlers:
+            handler.deferred = True
+        self._start()
+        # カメラなどを別のプロセス(fork)で動かすと書き込みのスレッドは引き継がれないので，子プロセスで作り直す
+        os.register_at_fork(after_in_child=self._start)
+        atexit.register(self.stop)
+
+    def _start(self):
+        self._queue_handler.queue = Queue(self._queue_handler.queue.maxsize)
+        self._queue_handler.dropped = 0
+        self._reported = 0
+        self._thread = Thread(target=self._write_forever, daemon=True)
+        self._thread.start()
+
+    def _write_forever(self):
+        queue = self._queue_handler.queue
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            stop = None in batch
+            for record in batch:
+                if record is not None:
+                    self._handle(record)
+            dropped = self._queue_handler.dropped
+            if dropped > self._reported:
+                self._handle(LogRecord(self._queue_handler.name or "sc_logging", WARNING, __file__, 0,
+                                       "%d log records dropped (queue full)", (dropped - self._reported,), None))
+                self._reported = dropped
+            for handler in self._handlers:
+                handler.deferred = False
+                handler.flush()
+                handler.deferred = True
+            if stop:
+                return
+
+    def _handle(self, record):
+        for handler in self._handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self, timeout=1.0):
+        """キューに残っているログを書き込んでからスレッドを止める"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue_handler.queue.put(None, timeout=timeout)
+        except Full:
+            return
+        self._thread.join(timeout=timeout)
+
+
+class SegmentFileHandler(Handler):
+    """電源が突然落ちても壊れにくいように，あらかじめ確保したファイル(セグメント)にまとめて書き込むハンドラ
+
+    - セグメント: sc26_000000.log, sc26_000001.log, ... を作るときに segment_bytes 全体を確保(fallocate)する
+      (書き込みのたびにファイルの大きさとFATを書き換えないので，SDカードの書き込みが減り，電源断でファイルが壊れにくい)
+    - 書き込み: 整形した行をためておき，flushのときにブロック(block_size)の境界から書き込む
+      最後の中途半端なブロックは次のflushで続きと一緒に同じ位置へ書き直す
+    - fsync: fsync_interval 秒ごとに別スレッドで行う (電源が落ちてもそれより前のログは残る)
+    - 古いセグメントは max_segments 個を超えたら消す
+    - 起動時の復旧: 前回の最後のセグメントの末尾に残った未使用の0の部分を切り詰める (新しいログは新しいセグメントに書く)
+    セグメントの番号はファイルを排他的に作って決めるので，forkした子プロセス(カメラ)は親と別のセグメントに書き込む
+    """
+    def __init__(self, directory=LOG_DIR, prefix="sc26", segment_bytes=1024 * 1024, max_segments=64, block_size=4096,
+                 fsync_interval=1.0):
+        os.makedirs(directory, exist_ok=True)  # 作れなければ(ハンドラとして登録する前に)OSError
+        super().__init__()
+        self._directory = directory
+        self._prefix = prefix
+        self._segment_bytes = segment_bytes
+        self._max_segments = max_segments
+        self._block_size = block_size
+        self._fsync_interval = fsync_interval
+        self.deferred = False  # Trueの間はemitで書き込まずにためておく (BatchWriterがまとめてflushする)
+
+        for _, path in self._segments()[-2:]:
+            self._trim(path)
+        self._open_segment()
+        self._stop = Event()
+        self._start_fsync()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _segments(self):
+        """[(番号, パス)] を番号の順に返す"""
+        segments = []
+        for name in os.listdir(self._directory):
+            match = re.fullmatch(re.escape(self._prefix) + r"_(\d{6})\.log", name)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(self._directory, name)))
+        return sorted(segments)
 
-def get_logger(name: str):
+    def _trim(self, path):
+        """セグメントの末尾の0(書き込まれなかった部分)を切り詰める"""
+        size = os.path.getsize(path)
+        end = size
+        with open(path, "rb") as f:
+            while end > 0:
+                start = max(end - self._block_size, 0)
+                f.seek(start)
+                data = f.read(end - start).rstrip(b"\0")
+                if data:
+                    end = start + len(data)
+                    break
+                end = start
+        if end < size:
+            os.truncate(path, end)
+
+    def _open_segment(self):
+        """新しいセグメントを作って全体を確保し，古いセグメントを消す"""
+        segments = self._segments()
+        index = segments[-1][0] + 1 if segments else 0
+        while True:
+            path = os.path.join(self._directory, f"{self._prefix}_{index:06d}.log")
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except FileExistsError:
+                index += 1  # 他のプロセスが先に作った
+        try:
+            os.posix_fallocate(fd, 0, self._segment_bytes)
+        except OSError:
+            pass  # fallocateに対応していないファイルシステムでは，書き込みながら大きくする
+        self._fd = fd
+        self._offset = 0  # 次に書き込むブロックの先頭の位置
+        self._tail = b""  # 書き込んだが，ブロックの途中までしかない部分 (次は続きと一緒に書き直す)
+        self._buffer = []
+        self._dirty = False
+        for _, old_path in self._segments()[:-self._max_segments]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def emit(self, record):
+        try:
+            self._buffer.append((self.format(record) + "\n").encode("utf-8"))
+            if not self.deferred:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """ためた行をブロックの境界から書き込む"""
+        if self.deferred or not self._buffer:
+            return
+        with self.lock:
+            data = b"".join(self._buffer)
+            self._buffer = []
+            if self._offset + len(self._tail) + len(data) > self._segment_bytes and self._offset + len(self._tail) > 0:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._open_segment()
+            data = self._tail + data
+            os.pwrite(self._fd, data, self._offset)
+            written = len(data) // self._block_size * self._block_size
+            self._offset += written
+            self._tail = data[written:]
+            self._dirty = True
+
+    def _start_fsync(self):
+        self._thread = Thread(target=self._fsync_forever, daemon=True)
+        self._thread.start()
+
+    def _fsync_forever(self):
+        while not self._stop.wait(self._fsync_interval):
+            self.sync()
+
+    def sync(self):
+        """書き込んだ内容をSDカードに書き出す"""
+        with self.lock:
+            if self._dirty:
+                os.fsync(self._fd)
+                self._dirty = False
+
+    def _after_fork(self):
+        # 親と同じファイルの同じ位置に書き込まないように，子プロセスは新しいセグメントに書き込む
+        os.close(self._fd)
+        self._open_segment()
+        self._start_fsync()
+
+    def close(self):
+        self._stop.set()
+        self.deferred = False
+        try:
+            self.flush()
+            self.sync()
+            os.close(self._fd)
+        except OSError:
+            pass
+        super().close()
+
+
+def read_log(directory=LOG_DIR, prefix="sc26"):
+    """セグメントを番号の順につないだログの文字列を返す (未使用の0の部分は除く)"""
+    texts = []
+    for name in sorted(os.listdir(directory)):
+        if re.fullmatch(re.escape(prefix) + r"_(\d{6})\.log", name):
+            with open(os.path.join(directory, name), "rb") as f:
+                texts.append(f.read().replace(b"\0", b"").decode("utf-8", errors="replace"))
+    return "".join(texts)
+
+
+def default_log_dir():
+    """LOG_DIRに書き込めればLOG_DIR，書き込めなければ(/boot/firmwareがない，rootでないなど) ./log"""
+    directory = LOG_DIR if os.path.isdir(LOG_DIR) else os.path.dirname(LOG_DIR)
+    return LOG_DIR if os.access(directory, os.W_OK) else "log"
+
+
+class RateLimitFilter(Filter):
+    """呼び出し箇所(ファイルと行)ごとに，1秒あたりrate行までしかログを通さないフィルタ
+
+    loggerに付けるとハンドラより先に判定されるので，捨てたログは文字列に整形されない
+    (メッセージは logger.debug("mag: %s", mag) のように%形式で渡すこと  f文字列だと捨てる場合も整形してしまう)
+    呼び出し箇所の代わりに extra={"rate_key": "名前"} で数える単位を指定できる
+    捨てた後に通したログには，その間に捨てた数を " [N suppressed]" として付け足す
+    """
+    def __init__(self, rate=2.0, burst=None, max_level=INFO):
+        """
+        rate: 1つの呼び出し箇所から1秒あたりに通すログの数
+        burst: 続けて通してよいログの数 (省略するとrateと同じ)
+        max_level: このレベル以下のログだけを間引く (WARNING以上は全て通す)
+        """
+        super().__init__()
+        self._rate = rate
+        self._burst = max(burst if burst is not None else rate, 1)
+        self._max_level = max_level
+        self._buckets = {}  # 呼び出し箇所: [通してよい残りの数, 最後に判定した時刻, 前回通してから捨てた数]
+        self._lock = Lock()
+        self.suppressed = {}  # 呼び出し箇所: これまでに捨てた数
+
+    def filter(self, record):
+        if record.levelno > self._max_level:
+            return True
+        key = getattr(record, "rate_key", None) or f"{record.filename}:{record.lineno}"
+        now = record.created
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self._burst, now, 0]
+            tokens = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} suppressed]"
+        return True
+
+
+def get_logger(name: str, queued=False, queue_size=1000, batch_size=64, rate_limit=None, log_dir=None):
+    """
+    queued: Trueならログはキューに入れるだけで，ファイルとコンソールへの書き込みは別のスレッドでまとめて行う
+            (キューが一杯ならそのログは捨て，捨てた数をあとでWARNINGとして記録する)
+    queue_size: キューに入れておけるログの数
+    batch_size: 1回のflushでまとめて書き込むログの最大数
+    rate_limit: 指定すると，INFO以下のログを呼び出し箇所ごとに1秒あたりこの行数までに間引く (RateLimitFilter)
+    log_dir: 指定すると，./sc26_log.log の代わりにこのフォルダのセグメントに記録する (SegmentFileHandler)
+    """
     # logger = getLogger(os.path.basename(os.getcwd()))
     logger = getLogger(name)
     logger.setLevel(DEBUG)  # 全ログデータの記録するレベル(DEBUG以上など)
     logger.propagate = False
 
-    s_handler = StreamHandler()
-    s_handler.setLevel(DEBUG)
-    logger.addHandler(s_handler)  # コンソールに出力するメッセージのレベル(INFO以上など)
+    s_handler = BatchStreamHandler() if queued else StreamHandler()
+    s_handler.setLevel(DEBUG)  # コンソールに出力するメッセージのレベル(INFO以上など)
 
-    now_timestamp = datetime.now().strftime("%m%dT%H%M")
     tsv_format = Formatter('%(asctime)s.%(msecs)d+09:00\t%(name)s\t%(filename)s\t%(lineno)d\t%(funcName)s\t%(levelname)s\t%(message)s', '%Y-%m-%dT%H:%M:%S')
     os.makedirs('log', exist_ok=True)
-    f_handler = RotatingFileHandler('./sc26_log.log', maxBytes=100*1000, encoding='utf-8')  # 最大で100kBまで記録
-    # f_handler = RotatingFileHandler('/boot/firmware/sc26_log/sc26_' + now_timestamp + '.log', maxBytes=100*1000, encoding='utf-8')  # 最大で100kBまで記録
+    log_dir_error = None
+    if log_dir is not None:
+        try:
+            f_handler = SegmentFileHandler(log_dir)  # 1MBのセグメントを64個まで (最大で64MBまで記録)
+        except OSError as e:
+            # 書き込めないフォルダでもログを残せるように ./log に記録する
+            log_dir_error = e
+            f_handler = SegmentFileHandler('log')
+    else:
+        file_handler_class = BatchRotatingFileHandler if queued else RotatingFileHandler
+        f_handler = file_handler_class('./sc26_log.log', maxBytes=100*1000, encoding='utf-8')  # 最大で100kBまで記録
     f_handler.setLevel(DEBUG)  # ファイルに記録するメッセージのレベル(INFO以上など)
     f_handler.setFormatter(tsv_format)
-    logger.addHandler(f_handler)
+
+    if queued:
+        q_handler = DropQueueHandler(Queue(queue_size))
+        q_handler.set_name(name)
+        q_handler.writer = BatchWriter(q_handler, [s_handler, f_handler], batch_size=batch_size)
+        logger.addHandler(q_handler)
+    else:
+        logger.addHandler(s_handler)
+        logger.addHandler(f_handler)
+    if rate_limit is not None:
+        logger.addFilter(RateLimitFilter(rate=rate_limit))
+    if log_dir_error is not None:
+        logger.warning(f"Could not log to {log_dir}, using ./log instead: {log_dir_error}")
     return logger
 
+
+def dropped_count(logger):
+    """キューが一杯で捨てたログの数 (queued=Falseなら0)"""
+    return sum(getattr(handler, "dropped", 0) for handler in logger.handlers)
+
+
+def suppressed_counts(logger):
+    """RateLimitFilterで間引いたログの数を {呼び出し箇所: 数} で返す"""
+    counts = {}
+    for log_filter in logger.filters:
+        for key, count in getattr(log_filter, "suppressed", {}).items():
+            counts[key] = counts.get(key, 0) + count
+    return counts
+
+
 if __name__ == "__main__":
     logger = get_logger(__name__)
     logger.debug("これはデバッグ時専用のメッセージです")
@@ -36,4 +396,4 @@ if __name__ == "__main__":
         logger.exception(f"なんかエラーが起きました")  # 👈except内はこれを使って
 
 # from log import logger  でloggerを読み込んで
-# logger.info("aiu")      のように記録してください
\ No newline at end of file
+# logger.info("aiu")      のように記録してください
@@ -0,0 +1,152 @@
+# I2Cのセンサーの読み込みを1つのスレッドで決まった時刻に行うスケジューラ
+#
+# 以前はBMP280(smbus2)とBNO055(pigpioのI2C)がそれぞれのスレッドで勝手な間隔(0.1 s, 0.01 s)で読み込んでおり，
+# 同じI2Cバス1を使う2つの読み込みがいつ重なるか分からず，読み込みの時刻もばらばらだった．
+# ここでは全てのセンサーの読み込みを1つのスレッドが受け持ち，
+#   - 各センサーを決めた周期(rate[Hz])と位相(offset[s])の時刻(deadline)に1回ずつ呼ぶ (バスを使うのは常に1つだけ)
+#   - 呼び出しには実際に読み込みを始めた時刻を渡す (Telemetryやフライトレコーダーの時刻をそろえるため)
+#   - deadlineからの遅れ(jitter)と処理時間を記録し，次のdeadlineまでに終わらなかった(overrun)回数と，
+#     そのために飛ばした周期の数(skipped)を数える (遅れを取り戻すためにまとめて呼ぶことはしない)
+# 統計は stats() で取り出せるほか，stats_interval 秒ごとにログに記録する．
+
+from logging import getLogger, StreamHandler
+from threading import Event
+import time
+
+
+class _Task:
+    """スケジューラに登録した1つの読み込み"""
+    def __init__(self, name, func, rate, offset):
+        self.name = name
+        self.func = func
+        self.period = 1.0 / rate
+        self.offset = offset
+        self.deadline = 0.0  # 次に呼ぶ予定の時刻
+        self.runs = 0
+        self.overruns = 0  # 次のdeadlineまでに終わらなかった回数
+        self.skipped = 0  # overrunのために飛ばした周期の数
+        self.errors = 0  # 例外が出た回数
+        self.reset_window()
+
+    def reset_window(self):
+        """ログに記録する区間の統計を0に戻す"""
+        self.window_runs = 0
+        self.window_jitter = 0.0
+        self.window_jitter_max = 0.0
+        self.window_duration = 0.0
+        self.window_duration_max = 0.0
+
+    def record(self, jitter, duration):
+        self.runs += 1
+        self.window_runs += 1
+        self.window_jitter += jitter
+        self.window_jitter_max = max(self.window_jitter_max, jitter)
+        self.window_duration += duration
+        self.window_duration_max = max(self.window_duration_max, duration)
+
+
+class SensorScheduler:
+    def __init__(self, stats_interval=10.0, logger=None):
+        """
+        stats_interval: 統計をログに記録する間隔[s]
+        """
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)  # DEBUGレベル
+        self._logger = logger
+
+        self._tasks = []
+        self._stats_interval = stats_interval
+        self._stop = Event()
+
+    def add(self, name, func, rate, offset=0.0):
+        """読み込みを登録する (run_foreverの前に呼ぶこと)
+
+        func(t): 1回分の読み込みを行う関数  tは読み込みを始めた時刻 (time.monotonic())
+        rate: 1秒あたりに呼ぶ回数[Hz]
+        offset: 周期の中で呼ぶ位置[s]  他のセンサーと同じ時刻にならないようにずらす
+        """
+        self._tasks.append(_Task(name, func, rate, offset))
+
+    def run_forever(self):
+        """登録した読み込みを，stopが呼ばれるまで決まった時刻に呼び続ける"""
+        start = time.monotonic()
+        for task in self._tasks:
+            task.deadline = start + task.offset
+        next_stats_time = start + self._stats_interval
+        while not self._stop.is_set():
+            task = min(self._tasks, key=lambda task: task.deadline)  # 次に呼ぶ予定の時刻が最も早いもの
+            delay = task.deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            started = time.monotonic()
+            try:
+                task.func(started)
+            except Exception as e:
+                task.errors += 1
+                self._logger.exception(f"An error occured in sensor scheduler {task.name}: {e}")
+            finished = time.monotonic()
+            task.record(started - task.deadline, finished - started)
+
+            # 次のdeadlineまでに終わらなかったら，間に合わなかった周期は飛ばす (周期の時刻の並びは変えない)
+            task.deadline += task.period
+            if finished > task.deadline:
+                task.overruns += 1
+                missed = int((finished - task.deadline) // task.period) + 1
+                task.skipped += missed
+                task.deadline += missed * task.period
+
+            if finished >= next_stats_time:
+                self._log_stats()
+                next_stats_time = finished + self._stats_interval
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """読み込みごとの統計を {名前: {...}} で返す (jitter, durationは前回ログに記録してからの値[s])"""
+        result = {}
+        for task in self._tasks:
+            runs = max(task.window_runs, 1)
+            result[task.name] = {
+                "rate": 1.0 / task.period,
+                "runs": task.runs,
+                "overruns": task.overruns,
+                "skipped": task.skipped,
+                "errors": task.errors,
+                "jitter_mean": task.window_jitter / runs,
+                "jitter_max": task.window_jitter_max,
+                "duration_mean": task.window_duration / runs,
+                "duration_max": task.window_duration_max,
+            }
+        return result
+
+    def _log_stats(self):
+        for name, stats in self.stats().items():
+            self._logger.info("scheduler %s: %.0f Hz, runs %d, jitter mean %.2f ms max %.2f ms, duration mean %.2f ms max %.2f ms, overruns %d, skipped %d, errors %d",
+                              name, stats["rate"], stats["runs"], stats["jitter_mean"] * 1e3, stats["jitter_max"] * 1e3,
+                              stats["duration_mean"] * 1e3, stats["duration_max"] * 1e3, stats["overruns"],
+                              stats["skipped"], stats["errors"])
+        for task in self._tasks:
+            task.reset_window()
+
+
+if __name__ == "__main__":
+    # センサーの代わりに決まった時間だけ待つ関数で，遅れと処理時間の統計を確認する
+    import sys
+    from threading import Thread
+
+    seconds = 3.0 if len(sys.argv) < 2 or sys.argv[1] == "--slow" else float(sys.argv[1])
+    scheduler = SensorScheduler(stats_interval=1.0)
+    scheduler.add("bno", lambda t: time.sleep(0.002), rate=100)
+    scheduler.add("bmp", lambda t: time.sleep(0.004), rate=10, offset=0.005)
+    if "--slow" in sys.argv:
+        # 周期より長くかかる読み込みがあると，他の読み込みもその間待たされてoverrunになる
+        scheduler.add("slow", lambda t: time.sleep(0.3), rate=5, offset=0.0025)
+    thread = Thread(target=scheduler.run_forever, daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    scheduler.stop()
+    thread.join()
@@ -0,0 +1,189 @@
+# 各センサのスレッドとフェーズの処理でデータを共有するための入れ物
+#
+# 以前はただのdictを全スレッドで共有していたため，BNO055が data["gyro"] の要素を1つずつ書き換えている途中に
+# fall_phaseが読み込むと，新旧の値が混ざったリストを読むことがあった(torn read)．
+# ここでは，あらかじめ確保した1本のarrayに全ての数値を並べ，項目ごとにシーケンス番号(seqlock)と時刻を持たせる．
+#   - 書き込み側: seqを奇数にする → 値を書く → seqを偶数に戻す
+#   - 読み込み側: arrayを1回コピーし，コピー前後でseqが変わっておらず偶数ならその値は一貫している
+# 読み込み側はロックを取らない．新しい値が来るまで待ちたいときは wait() / wait_new() を使う．
+
+from array import array
+import math
+from threading import Condition
+import time
+
+
+# 数値の項目 (名前, 要素数)  ここに並べた順にarrayに配置される
+FIELDS = (
+    ("alt", 1),
+    ("temp", 1),
+    ("press", 1),
+    ("accel", 3),
+    ("line_accel", 3),
+    ("mag", 3),
+    ("gyro", 3),
+    ("grav", 3),
+    ("euler", 3),  # (heading, roll, pitch)
+    ("lat", 1),  # 全受信機をまとめた緯度・経度
+    ("lon", 1),
+    ("lat1", 1),  # 受信機ごとの緯度・経度
+    ("lon1", 1),
+    ("lat2", 1),
+    ("lon2", 1),
+    ("goal_distance", 1),
+    ("goal_angle", 1),
+    ("goal_lat", 1),
+    ("goal_lon", 1),
+)
+
+# 文字列の項目 (arrayには入れず，seqと時刻だけ管理する)
+TEXT_FIELDS = ("phase", "datetime_gnss", "datetime_gnss1", "datetime_gnss2")
+
+_NAN = float("nan")
+
+
+def _to_float(value):
+    """Noneは未取得を表すNaNとして保存"""
+    return _NAN if value is None else float(value)
+
+
+def _to_value(value):
+    """NaNは未取得なのでNoneに戻す"""
+    return None if math.isnan(value) else value
+
+
+class Snapshot(dict):
+    """ある瞬間のデータのコピー
+
+    通常のdictとして値を読めるほか，項目ごとのシーケンス番号(seq)と書き込み時刻(stamp, time.monotonic())を持つ
+    """
+    def __init__(self, values, seq, stamp):
+        super().__init__(values)
+        self.seq = seq
+        self.stamp = stamp
+
+
+class Telemetry:
+    """固定レイアウトのテレメトリ置き場
+
+    今までのdictと同じように data["alt"] や data.update({...}) で読み書きできる．
+    ベクトルの項目(data["gyro"]など)は毎回一貫したコピーのリストが返るので，要素ごとに書き換えることはできない．
+    """
+    def __init__(self, fields=FIELDS, text_fields=TEXT_FIELDS):
+        self._layout = {}  # 名前: (項目番号, arrayの開始位置, 要素数)
+        offset = 0
+        for index, (name, length) in enumerate(fields):
+            self._layout[name] = (index, offset, length)
+            offset += length
+        for index, name in enumerate(text_fields, start=len(fields)):
+            self._layout[name] = (index, None, 1)
+
+        # 起動時に全て確保しておき，以降は大きさを変えない
+        self._buf = array('d', [_NAN] * offset)
+        self._seq = array('q', [0] * len(self._layout))
+        self._stamp = array('d', [0.0] * len(self._layout))
+        self._text = {name: None for name in text_fields}
+
+        # 書き込みの直列化と「新しい値が来た」ことの通知に使う (読み込み側は待つとき以外は取らない)
+        self._cond = Condition()
+
+    # ---------- 書き込み ----------
+    def _write(self, name, value):
+        index, offset, length = self._layout[name]
+        self._seq[index] += 1  # 奇数: 書き込み中
+        if offset is None:
+            self._text[name] = value
+        elif length == 1:
+            self._buf[offset] = _to_float(value)
+        else:
+            if value is None:
+                value = (None,) * length
+            if len(value) != length:
+                raise ValueError(f"{name} needs {length} values, got {len(value)}")
+            self._buf[offset:offset + length] = array('d', map(_to_float, value))
+        self._stamp[index] = time.monotonic()
+        self._seq[index] += 1  # 偶数: 書き込み完了
+
+    def __setitem__(self, name, value):
+        with self._cond:
+            self._write(name, value)
+            self._cond.notify_all()
+
+    def update(self, values=(), **kwargs):
+        """複数の項目をまとめて書き込む (通知は1回だけ)"""
+        values = dict(values, **kwargs)
+        with self._cond:
+            for name, value in values.items():
+                self._write(name, value)
+            self._cond.notify_all()
+
+    # ---------- 読み込み ----------
+    def _value(self, buf, name):
+        _, offset, length = self._layout[name]
+        if offset is None:
+            return self._text[name]
+        if length == 1:
+            return _to_value(buf[offset])
+        return [_to_value(v) for v in buf[offset:offset + length]]
+
+    def snapshot(self, names=None):
+        """指定した項目(Noneなら全項目)の一貫したコピーをSnapshotとして返す"""
+        if names is None:
+            names = self._layout.keys()
+        indexes = [self._layout[name][0] for name in names]
+        while True:
+            seq_before = self._seq[:]
+            buf = self._buf[:]  # 全数値を1回でコピー
+            values = {name: self._value(buf, name) for name in names}
+            stamp = self._stamp[:]
+            seq_after = self._seq[:]
+            # 書き込み中(奇数)の項目や，コピー中に書き換えられた項目があれば読み直す
+            if all(seq_before[i] == seq_after[i] and not seq_before[i] & 1 for i in indexes):
+                break
+            time.sleep(0)  # 書き込み側に処理を譲る
+        return Snapshot(values,
+                        {name: seq_before[i] for name, i in zip(names, indexes)},
+                        {name: stamp[i] for name, i in zip(names, indexes)})
+
+    def __getitem__(self, name):
+        return self.snapshot((name,))[name]
+
+    def get(self, name, default=None):
+        if name not in self._layout:
+            return default
+        return self[name]
+
+    def __contains__(self, name):
+        return name in self._layout
+
+    def keys(self):
+        return self._layout.keys()
+
+    def seq(self, name):
+        """項目のシーケンス番号 (書き込まれるたびに2ずつ増える)"""
+        return self._seq[self._layout[name][0]]
+
+    def stamp(self, name):
+        """項目が最後に書き込まれた時刻 (time.monotonic())"""
+        return self._stamp[self._layout[name][0]]
+
+    # ---------- 待機 ----------
+    def wait(self, last_seq, timeout=None):
+        """last_seq({名前: seq})のどれかの項目が更新されるまで待つ
+
+        更新されたらTrue，timeout秒経っても更新されなければFalseを返す
+        """
+        indexes = [(self._layout[name][0], seq) for name, seq in last_seq.items()]
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: any(self._seq[i] > seq and not self._seq[i] & 1 for i, seq in indexes),
+                timeout)
+
+    def wait_new(self, name, last_seq, timeout=None):
+        """項目nameがlast_seqより新しくなるまで待ち，新しいseqを返す (タイムアウトしたらNone)"""
+        if self.wait({name: last_seq}, timeout):
+            return self.seq(name)
+        return None
+
+    def __repr__(self):
+        return f"Telemetry({dict(self.snapshot())})"
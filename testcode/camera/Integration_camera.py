@@ -3,6 +3,8 @@ import cv2
 import time
 import numpy as np
 import matplotlib.pyplot as plt
+from pyramid_detect import PyramidDetector
+from frame_archiver import FrameArchiver
 
 #赤色は色相範囲において2つの領域またぐ（174～6で180をまたぐため174～180，0~6で設定）
 low_color1 = np.array([0, 50, 50])  # 各最小値を指定
@@ -10,49 +12,29 @@ high_color1 = np.array([6, 255, 255])  # 各最大値を指定
 low_color2 = np.array([174, 50, 50]) #第2領域の各最小値を指定
 high_color2 = np.array([180, 255, 255])  # 第2領域の各最大値を指定
 
+detector = PyramidDetector(hsv_ranges=((low_color1, high_color1), (low_color2, high_color2)))
+
 picam2 = Picamera2()
 picam2.configure(picam2.create_still_configuration())
-conf = picam2.create_preview_configuration(main = {"size": (640, 480)}) # プレビューの設定
+conf = picam2.create_preview_configuration(main = {"size": (640, 480), "format": "RGB888"}) # プレビューの設定 (RGB888はOpenCVと同じBGRの並び)
 picam2.configure(conf)
 picam2.start()
 number = 0
 
-def detect_cone(img_name,color_number):#仮引数をimg_nameに設定（後に引数にカラーコーンの引数を渡す）
-    img = cv2.imread(img_name)#画像を読み込む
-    
-    img_yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV) # RGB => YUV(YCbCr)
-    clahe = cv2.createCLAHE(clipLimit = 2.0, tileGridSize = (8, 8)) # claheオブジェクトを生成
-    img_yuv[:,:,0] = clahe.apply(img_yuv[:,:,0]) # 輝度にのみヒストグラム平坦化
-    img = cv2.cvtColor(img_yuv, cv2.COLOR_YUV2BGR) # YUV => RGB
-    
-    img_blur = cv2.blur(img, (15, 15)) # 平滑化フィルタを適用
-     
-    hsv = cv2.cvtColor(img_blur, cv2.COLOR_BGR2HSV) # BGRからHSVに変換
-    
-    bin_img1 = cv2.inRange(hsv, low_color1, high_color1) # マスクを作成
-    bin_img2 = cv2.inRange(hsv, low_color2, high_color2)
-    mask = bin_img1 + bin_img2 # 必要ならマスクを足し合わせる
-    masked_img = cv2.bitwise_and(img_blur, img_blur, mask= mask) # 元画像から特定の色を抽出
+def detect_cone(img,color_number,archiver=None):#imgはcapture_arrayで撮影した画像(numpyの配列) 画像ファイル名を渡してもよい
+    if isinstance(img, str):
+        img = cv2.imread(img)#画像を読み込む
+    percentage_image = 0
 
-    num_labels, label_img, stats, centroids = cv2.connectedComponentsWithStats(mask) # 連結成分でラベリングする
-    # 背景のラベルを削除
-    num_labels = num_labels - 1
-    stats = np.delete(stats, 0, 0)
-    centroids = np.delete(centroids, 0, 0)
+    # 1/4に縮小した画像で赤い領域の候補を探し，候補の周りだけを元の解像度で
+    # CLAHE → 平滑化 → 2値化 → ラベリング する (処理時間が画像の大きさではなくコーンの大きさで決まる)
+    result = detector.detect(img)
 
-    if num_labels >= 1: # ラベルの有無で場合分け
-        max_index = np.argmax(stats[:, 4]) # 最大面積のインデックスを取り出す
+    if result is not None: # 赤い領域の有無で場合分け
         # 以下最大面積のラベルについて考える
-        x = stats[max_index][0]
-        y = stats[max_index][1]
-        w = stats[max_index][2]
-        h = stats[max_index][3]
-        s = stats[max_index][4]
-        h1, w1 = img.shape[:2] # 画像の高さと幅を取得
-        total_pixel = h1 * w1 # 画像の総ピクセル数を計算
-        percentage_image = (s / total_pixel) * 100 # 画像中のコーンの占有率を計算
-        mx = int(centroids[max_index][0]) # 重心のX座標
-        my = int(centroids[max_index][1]) # 重心のY座標
+        x, y, w, h = result["rect"]
+        percentage_image = result["occupancy"] # 画像中のコーンの占有率
+        mx, my = result["centroid"] # 重心の座標
         cv2.rectangle(img, (x, y), (x+w, y+h), (255, 0, 255)) # ラベルを四角で囲む
         cv2.putText(img, "%d,%d"%(mx, my), (x-15, y+h+15), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 0)) # 重心を表示
         cv2.putText(img, "%d"%(percentage_image), (x, y+h+30), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 0)) # 面積の占有率を表示
@@ -60,20 +42,26 @@ def detect_cone(img_name,color_number):#仮引数をimg_nameに設定（後に
         cv2.waitKey(0)
 
     
-    cv2.imwrite(f"cone_colored_{color_number}.jpg", img) # 書き出す
+    if archiver is not None:
+        archiver.submit(img, color_number) # 別スレッドでcone_colored_{color_number}.jpgに書き出す
     if percentage_image > 80:
         print("ゴールしました")
         return True # ゴールした場合にはTrueを返す
-    if num_labels < 1:
+    if result is None:
         print("目標物が見当たりません！！")
 
 if __name__ == "__main__":
+    # 撮影した画像はファイルを経由せずにそのまま画像認識に渡し，保存は別スレッドで行う
+    raw_archiver = FrameArchiver(prefix="cone", every=5) # 撮影した画像 (5枚に1枚だけcone_0,5,10.jpgとして保存)
+    colored_archiver = FrameArchiver(prefix="cone_colored", every=5) # 認識結果を書き込んだ画像
     try:
         while True:
-            picam2.capture_file(f"cone_{number}.jpg") # 画像を撮影後cone_0,1,2.jpgという連番の名前で保存
-            print("画像を保存しました")
-            if detect_cone(f"cone_{number}.jpg",number):
+            frame = picam2.capture_array() # 画像を撮影
+            raw_archiver.submit(frame, number)
+            if detect_cone(frame,number,colored_archiver):
                 picam2.stop()
+                raw_archiver.close()
+                colored_archiver.close()
                 cv2.destroyAllWindows()
                 exit()
             time.sleep(1) # 5秒待機
@@ -82,6 +70,8 @@ if __name__ == "__main__":
     except KeyboardInterrupt: #ctrl+cで安全に終了
         print("撮影を終了します")
         picam2.stop()
+        raw_archiver.close()
+        colored_archiver.close()
         cv2.destroyAllWindows() # ウィンドウを閉じる
         print("終了しました")
         exit()
\ No newline at end of file
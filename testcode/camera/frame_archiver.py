@@ -0,0 +1,81 @@
+from logging import getLogger, StreamHandler
+from queue import Queue, Full
+from threading import Thread
+import os
+import cv2
+
+
+class FrameArchiver:
+    """撮影した画像を別スレッドでJPEGに変換して保存する
+
+    画像認識のループでは submit() で画像を渡すだけにして，JPEGへの変換とSDカードへの書き込みを待たないようにする．
+    every枚に1枚だけ保存し，保存が追いつかずキューがいっぱいのときは保存せずに捨てる (画像認識を遅らせないため)．
+    """
+    def __init__(self, directory=".", prefix="cone", every=1, max_queue=4, quality=90, logger=None):
+        """
+        directory: 保存先のフォルダ
+        prefix: ファイル名の先頭 (prefix_番号.jpg)
+        every: 何枚に1枚保存するか
+        max_queue: 保存待ちにできる画像の数
+        quality: JPEGの画質 (0~100)
+        """
+        # もしloggerが渡されなかったら，ログの記録先を標準出力に設定
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(StreamHandler())
+            logger.setLevel(10)
+        self._logger = logger
+
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._prefix = prefix
+        self._every = max(int(every), 1)
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        self._queue = Queue(maxsize=max_queue)
+        self._count = 0  # submitされた画像の数
+        self.saved = 0  # 保存した画像の数
+        self.dropped = 0  # キューがいっぱいで保存しなかった画像の数
+
+        self._thread = Thread(target=self._write_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, frame, number=None):
+        """画像を保存待ちに入れる (待たずに戻る)  保存待ちに入れたらTrueを返す
+
+        frameは保存が終わるまで書き換えないこと (capture_arrayが返す配列なら毎回新しいのでそのまま渡してよい)
+        """
+        count = self._count
+        self._count += 1
+        if count % self._every != 0:
+            return False
+        if number is None:
+            number = count
+        try:
+            self._queue.put_nowait((number, frame))
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def _write_forever(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                number, frame = item
+                path = os.path.join(self._directory, f"{self._prefix}_{number}.jpg")
+                if cv2.imwrite(path, frame, self._params):
+                    self.saved += 1
+                else:
+                    self._logger.error(f"Failed to save {path}")
+            except Exception as e:
+                self._logger.exception(f"An error occured in frame archiver: {e}")
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """保存待ちの画像を全て保存してからスレッドを止める"""
+        self._queue.put(None)
+        self._thread.join()
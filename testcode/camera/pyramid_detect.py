@@ -0,0 +1,203 @@
+# 画像ピラミッドによるカラーコーンの検出 (粗い画像で候補を探し，候補の周りだけを元の解像度で調べ直す)
+#
+# Color_detect.py, Integration_camera.py の検出器は以前
+#   CLAHE(輝度の平坦化) → 15x15の平滑化 → HSVの値域で2値化 → connectedComponentsWithStats
+# を全て元の解像度で行っていたため，コーンが小さくても画像全体の画素数に比例した時間がかかっていた．
+# ここでは
+#   1. 1/4に縮小した画像で同じ処理をして，赤い領域の候補を探す
+#   2. 候補の外接矩形の周りだけを元の解像度で同じ処理をして，重心・面積・占有率を求める
+# とすることで，1枚あたりの処理時間をコーンの大きさに比例させる．
+# 調べ直す範囲はCLAHEのタイルの境目に揃え，周りにタイル1枚分と平滑化の半径以上の余白を付けて処理するので，
+# 結果は画像全体で処理した場合と一致する (縮小した画像で見えないほど小さい領域(数十px以下)は見逃す)．
+
+import cv2
+import numpy as np
+
+
+# 赤色のHSVの値域 (Color_detect.py, Integration_camera.py と同じ)  赤は色相0をまたぐので2つに分ける
+TESTCODE_RED_HSV_RANGES = (
+    ((0, 50, 50), (6, 255, 255)),
+    ((174, 50, 50), (180, 255, 255)),
+)
+
+
+def _equalize(img, clahe):
+    """輝度にのみヒストグラム平坦化(CLAHE)をかける"""
+    img_yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)  # RGB => YUV(YCbCr)
+    img_yuv[:, :, 0] = clahe.apply(img_yuv[:, :, 0])
+    return cv2.cvtColor(img_yuv, cv2.COLOR_YUV2BGR)  # YUV => RGB
+
+
+def _red_mask(img_blur, hsv_ranges):
+    """平滑化した画像をHSVの値域で2値化する"""
+    hsv = cv2.cvtColor(img_blur, cv2.COLOR_BGR2HSV)
+    mask = np.zeros(img_blur.shape[:2], np.uint8)
+    for low, high in hsv_ranges:
+        mask |= cv2.inRange(hsv, np.array(low), np.array(high))
+    return mask
+
+
+def _biggest_label(mask):
+    """背景以外で最大の連結成分の (外接矩形, 面積, 重心, ラベルの数) を返す (なければNone)"""
+    num_labels, _, stats, centroids = cv2.connectedComponentsWithStats(mask)
+    if num_labels <= 1:
+        return None
+    max_index = np.argmax(stats[1:, 4]) + 1  # 背景(ラベル0)を除いて最大面積のもの
+    x, y, w, h, s = (int(v) for v in stats[max_index])
+    return (x, y, w, h), s, tuple(centroids[max_index]), num_labels - 1
+
+
+def _result(rect, area, centroid, labels, total_pixel):
+    """testcodeの検出器と同じ値 (重心, 面積, 占有率[%]) をまとめる"""
+    return {
+        "rect": rect,
+        "area": area,
+        "centroid": (int(centroid[0]), int(centroid[1])),
+        "occupancy": area / total_pixel * 100,
+        "labels": labels,
+    }
+
+
+def detect_full(img, hsv_ranges=TESTCODE_RED_HSV_RANGES, blur=15, clip_limit=2.0, tile_grid=(8, 8)):
+    """以前の検出器と同じ処理を画像全体に行う (比較用)"""
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid)
+    img_blur = cv2.blur(_equalize(img, clahe), (blur, blur))
+    found = _biggest_label(_red_mask(img_blur, hsv_ranges))
+    if found is None:
+        return None
+    return _result(*found, img.shape[0] * img.shape[1])
+
+
+class PyramidDetector:
+    """1/scaleの画像で候補を探し，候補の周りだけを元の解像度で調べ直す検出器"""
+    def __init__(self, hsv_ranges=TESTCODE_RED_HSV_RANGES, scale=4, blur=15, clip_limit=2.0, tile_grid=(8, 8),
+                 max_candidates=3, min_coarse_area=2, full_ratio=0.6):
+        """
+        hsv_ranges: 赤色のHSVの値域 (最小値, 最大値) のリスト
+        scale: 候補を探す画像の縮小率
+        blur: 元の解像度での平滑化の大きさ (testcodeは15x15)
+        clip_limit, tile_grid: CLAHEの設定 (testcodeと同じ)
+        max_candidates: 元の解像度で調べ直す候補の数 (面積の大きい順)
+        min_coarse_area: 縮小した画像でこれより小さい[px]領域は候補にしない
+        full_ratio: 調べ直す範囲が画像のこの割合以上になる場合は画像全体をそのまま処理する
+        """
+        self._hsv_ranges = tuple(hsv_ranges)
+        self._scale = scale
+        self._blur = blur
+        self._coarse_blur = max(blur // scale, 1)  # 縮小で平均された分を除いた残りの平滑化
+        self._tile_grid = tile_grid
+        self._clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid)
+        self._clip_limit = clip_limit
+        self._max_candidates = max_candidates
+        self._min_coarse_area = min_coarse_area
+        self.full_ratio = full_ratio
+
+        # 直近の画像で元の解像度で調べ直した画素数 (処理量の目安)
+        self.refined_pixels = 0
+
+    def candidates(self, img):
+        """縮小した画像で赤い領域を探し，元の解像度での外接矩形を面積の大きい順に返す"""
+        scale = self._scale
+        height, width = img.shape[:2]
+        small = cv2.resize(img, (width // scale, height // scale), interpolation=cv2.INTER_AREA)
+        small_blur = cv2.blur(_equalize(small, self._clahe), (self._coarse_blur, self._coarse_blur))
+        mask = _red_mask(small_blur, self._hsv_ranges)
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        stats = stats[1:]
+        stats = stats[stats[:, 4] >= self._min_coarse_area]
+        stats = stats[np.argsort(stats[:, 4])[::-1][:self._max_candidates]]
+        return [(int(x) * scale, int(y) * scale, int(w) * scale, int(h) * scale) for x, y, w, h, _ in stats]
+
+    def _tile_aligned(self, rect, shape):
+        """矩形を平滑化の半径+余白だけ広げ，CLAHEのタイルの境目に揃えた範囲 (x0, y0, x1, y1) を返す"""
+        height, width = shape[:2]
+        tile_w, tile_h = self._tile_size(shape)
+        pad = self._blur // 2 + self._scale
+        x, y, w, h = rect
+        x0 = max(x - pad, 0) // tile_w * tile_w
+        y0 = max(y - pad, 0) // tile_h * tile_h
+        x1 = min(-(-(x + w + pad) // tile_w) * tile_w, width)
+        y1 = min(-(-(y + h + pad) // tile_h) * tile_h, height)
+        return x0, y0, x1, y1
+
+    def _tile_size(self, shape):
+        """画像全体で処理したときのCLAHEのタイル1枚の大きさ[px]"""
+        height, width = shape[:2]
+        return -(-width // self._tile_grid[0]), -(-height // self._tile_grid[1])
+
+    def refine(self, img, rect):
+        """候補の周りを元の解像度で処理し，(最大の連結成分, 調べた範囲) を画像全体の座標で返す
+
+        CLAHEはタイルの間を補間するため，調べる範囲(core)の周りにタイル1枚分を足して処理する．
+        見つかった領域がcoreからはみ出していれば，範囲を広げて調べ直す．
+        """
+        height, width = img.shape[:2]
+        tile_w, tile_h = self._tile_size(img.shape)
+        while True:
+            core = self._tile_aligned(rect, img.shape)
+            x0, y0 = max(core[0] - tile_w, 0), max(core[1] - tile_h, 0)
+            x1, y1 = min(core[2] + tile_w, width), min(core[3] + tile_h, height)
+            if (x1 - x0) * (y1 - y0) >= width * height * self.full_ratio:
+                # 画像の大部分を調べることになるなら，画像全体を1回で処理した方が速い
+                self.refined_pixels += width * height
+                found = detect_full(img, self._hsv_ranges, self._blur, self._clip_limit, self._tile_grid)
+                return found, (0, 0, width, height)
+
+            roi = img[y0:y1, x0:x1]
+            self.refined_pixels += roi.shape[0] * roi.shape[1]
+            # 範囲の中のタイルの数を合わせて，画像全体で処理したときと同じ大きさのタイルでCLAHEをかける
+            clahe = cv2.createCLAHE(clipLimit=self._clip_limit,
+                                    tileGridSize=(-(-(x1 - x0) // tile_w), -(-(y1 - y0) // tile_h)))
+            roi_blur = cv2.blur(_equalize(roi, clahe), (self._blur, self._blur))
+            found = _biggest_label(_red_mask(roi_blur, self._hsv_ranges))
+            if found is None:
+                return None, core
+            (x, y, w, h), area, (cx, cy), labels = found
+            full_rect = (x + x0, y + y0, w, h)
+            inside = (full_rect[0] >= core[0] and full_rect[1] >= core[1]
+                      and full_rect[0] + w <= core[2] and full_rect[1] + h <= core[3])
+            if inside:
+                return _result(full_rect, area, (cx + x0, cy + y0), labels, width * height), core
+            # coreの外まで続いているので，今の範囲と見つかった領域を合わせた範囲で調べ直す (範囲は広がる一方なので必ず終わる)
+            left, top = min(rect[0], full_rect[0]), min(rect[1], full_rect[1])
+            right = max(rect[0] + rect[2], full_rect[0] + w)
+            bottom = max(rect[1] + rect[3], full_rect[1] + h)
+            rect = (left, top, right - left, bottom - top)
+
+    def detect(self, img):
+        """最大の赤い領域の {rect, area, centroid, occupancy, labels} を返す (見つからなければNone)
+
+        labelsは調べた範囲の中の連結成分の数 (画像全体の数とは一致しない)
+        """
+        self.refined_pixels = 0
+        best = None
+        searched = []  # 調べ終わった範囲 (この中に入る候補は調べ直さない)
+        for x, y, w, h in self.candidates(img):
+            if any(x0 <= x and y0 <= y and x + w <= x1 and y + h <= y1 for x0, y0, x1, y1 in searched):
+                continue
+            found, core = self.refine(img, (x, y, w, h))
+            searched.append(core)
+            if found is not None and (best is None or found["area"] > best["area"]):
+                best = found
+        return best
+
+
+if __name__ == "__main__":
+    # testcodeの検出器と同じ処理(detect_full)と結果・速さを比べる
+    import sys
+    import time
+
+    paths = sys.argv[1:] or ["cone_1.jpg", "S__15155209_0.jpg", "S__15155210_0.jpg"]
+    detector = PyramidDetector()
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        img = cv2.resize(img, (640, 480))
+        for name, func in (("full", detect_full), ("pyramid", detector.detect)):
+            start = time.perf_counter()
+            for _ in range(20):
+                result = func(img)
+            elapsed = (time.perf_counter() - start) / 20
+            print(f"{path} {name}: {elapsed * 1e3:.2f} ms {result}")
+        print(f"  refined pixels: {detector.refined_pixels} / {img.shape[0] * img.shape[1]}")